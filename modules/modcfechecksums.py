@@ -1,13 +1,12 @@
-from functools import cache
 from collections.abc import Iterable
 
 import requests
 
-from modlib import ModBase, now, respond_with_severity, TAG_REGEX
+from modlib import ModBase, now, respond_with_severity, TAG_REGEX, ttl_cache
 
 RELEASES_URL = "https://cfengine.com/release-data/enterprise/releases.json"
 
-@cache
+@ttl_cache(ttl=3600, negative_ttl=300, is_negative=lambda data: not data)
 def download_and_extract(url):
     assert url != RELEASES_URL
     data = {}
@@ -23,7 +22,7 @@ def download_and_extract(url):
             data[url] = checksum
     return data
 
-@cache
+@ttl_cache(ttl=3600, negative_ttl=300, is_negative=lambda data: not data)
 def get_all_checksums(url):
     assert url == RELEASES_URL
     r = requests.get(url)
@@ -43,7 +42,7 @@ def get_all_checksums(url):
         all.update(r)
     return all
 
-@cache
+@ttl_cache(ttl=3600, maxsize=4096, negative_ttl=300, is_negative=lambda checksum: checksum is None)
 def get_checksum(url):
     all = get_all_checksums(RELEASES_URL)
     if not url in all:
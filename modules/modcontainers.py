@@ -5,19 +5,27 @@ import json
 import os
 import subprocess
 import tempfile
-from functools import cache
-from time import sleep
 from collections.abc import Iterable
 
-import requests
+from modlib import (
+    ModBase,
+    now,
+    respond_with_severity,
+    rate_limiter,
+    rate_limited_get,
+    TAG_REGEX,
+    ttl_cache,
+)
 
-from modlib import ModBase, now, respond_with_severity, TAG_REGEX
+# Registries are strict about rate limits, especially Docker Hub:
+rate_limiter.set_rate("docker.io", 1.0)
+rate_limiter.set_rate("hub.docker.com", 2.0)
 
 
-@cache
+@ttl_cache(ttl=3600, negative_ttl=300, is_negative=lambda result: not result[1])
 def skopeo_list_tags(image: str) -> tuple[int, list[str]]:
     """List all tags for a container image using skopeo."""
-    sleep(1)
+    rate_limiter.wait(image.split("/")[0])
     try:
         result = subprocess.run(
             ["skopeo", "list-tags", f"docker://{image}"],
@@ -112,16 +120,15 @@ def skopeo_sync_with_digests(image: str, tags: list[str]) -> dict[str, str]:
     return digests
 
 
-@cache
+@ttl_cache(ttl=3600, negative_ttl=300, is_negative=lambda result: not result[1])
 def dockerhub_list_repositories(namespace: str) -> tuple[int, list[str]]:
     """List all repositories for an organization/user on Docker Hub."""
-    sleep(1)
     repositories = []
     url = f"https://hub.docker.com/v2/repositories/{namespace}/"
 
     try:
         while url:
-            r = requests.get(url, timeout=30)
+            r = rate_limited_get(url, timeout=30)
             if r.status_code != 200:
                 return (now(), [])
             data = r.json()
@@ -130,8 +137,6 @@ def dockerhub_list_repositories(namespace: str) -> tuple[int, list[str]]:
                 if repo_name:
                     repositories.append(repo_name)
             url = data.get("next")
-            if url:
-                sleep(0.5)
         return (now(), sorted(repositories))
     except Exception:
         return (now(), [])
@@ -1,13 +1,22 @@
 import socket
-import time
-from functools import cache
 from collections.abc import Iterable
-from modlib import ModBase, now, normalize_hostname, respond_with_severity
+from modlib import (
+    ModBase,
+    now,
+    normalize_hostname,
+    respond_with_severity,
+    rate_limiter,
+    ttl_cache,
+)
 
+# All lookups go to the same resolver, limit them together:
+rate_limiter.set_rate("dns", 10.0, burst=10)
 
-@cache
+
+# getaddrinfo() doesn't tell us the TTL of the records, so use a default:
+@ttl_cache(ttl=300, negative_ttl=60, is_negative=lambda result: not result[1])
 def dns_lookup(hostname: str) -> tuple[int, list[str]]:
-    time.sleep(1)
+    rate_limiter.wait("dns")
     try:
         results = socket.getaddrinfo(hostname, 443, type=socket.SOCK_STREAM)
         return (now(), sorted([str(x[4][0]) for x in results]))
@@ -16,6 +25,8 @@ def dns_lookup(hostname: str) -> tuple[int, list[str]]:
 
 
 class ModDNS(ModBase):
+    workers = 16
+
     def example_requests(self):
         return [
             {
@@ -1,11 +1,10 @@
 import datetime
-from functools import cache
 from collections.abc import Iterable
-from modlib import ModBase, strip_prefix, now, TAG_REGEX
+from modlib import ModBase, strip_prefix, now, TAG_REGEX, ttl_cache
 import os
 import json
 
-@cache
+@ttl_cache(ttl=None, maxsize=4096)
 def normalize_github(url: str) -> str:
     while url.endswith("/"):
         url = url[0:-1]
@@ -1,6 +1,4 @@
 import re
-from time import sleep
-from functools import cache
 from collections.abc import Iterable
 
 import requests
@@ -12,6 +10,9 @@ from modlib import (
     url_to_hostname,
     is_root_url,
     respond_with_severity,
+    rate_limited_get,
+    ttl_cache,
+    http_cache_ttl,
 )
 
 
@@ -85,6 +86,7 @@ class Response:
         self.redirect_location = r.headers.get("Location", None)
         self.body = r.text
         self.timestamp = now()
+        self.cache_ttl = http_cache_ttl(r.headers, 300)
         self.notable_headers = {}
 
         for header in [
@@ -102,26 +104,25 @@ class Response:
             self.notable_headers[key] = value
 
 
-@cache
+@ttl_cache(
+    ttl=300,
+    maxsize=256,
+    negative_ttl=30,
+    is_negative=lambda response: response.status_code >= 500,
+    ttl_of=lambda response: response.cache_ttl,
+)
 def http_get(url: str):
     while True:
         try:
-            r = requests.get(url, allow_redirects=False)
+            # Throttled per host to be nice, reducing network load and
+            # avoiding rate limits, backing off on errors like 429 / 500:
+            r = rate_limited_get(url, allow_redirects=False)
             # from_cache is a special thing added by requests-cache, not a part of the normal Response type
             if getattr(r, "from_cache", False):
                 print("CACHE HIT: " + url)
-            else:
-                # Real HTTP request made, throttle to be nice,
-                # reducing network load and avoiding rate limits:
-                sleep(0.2)
-                if r.status_code not in (200, 301, 404):
-                    # If we encounter other unexpected codes,
-                    # like 500 for example, slow down further:
-                    sleep(0.8)
             return Response(r)
-        except:
+        except requests.exceptions.RequestException:
             print(f"GET failed unexpectedly: {url}")
-            sleep(2)
             continue
 
 
@@ -159,6 +160,8 @@ def process_html(url: str, r: Response) -> Iterable[dict]:
 
 
 class ModHTTP(ModBase):
+    workers = 8
+
     def example_requests(self):
         return [
             {
@@ -9,9 +9,24 @@ from collections.abc import Iterable
 import requests_cache
 from datetime import timedelta
 import re
+import time
+import threading
+import functools
+from contextlib import contextmanager
+from collections import OrderedDict, deque
+from email.utils import parsedate_to_datetime
+from concurrent.futures import ThreadPoolExecutor
+
+# Re-exported for the modules, which share one rate_limiter:
+from ratelimit import rate_limiter, rate_limited_get
 
 TAG_REGEX = re.compile(r"v?\d+\.\d+\.\d+(-\d+)?")
 
+# Sent by the updater after a batch of requests in worker mode,
+# echoed back by the module when all requests in the batch are handled:
+END_OF_BATCH = {"operation": "end_of_batch"}
+
+
 def now() -> int:
     return int(datetime.datetime.now().timestamp())
 
@@ -61,9 +76,187 @@ def respond_with_severity(request: dict, severity: str) -> Iterable[dict]:
     yield request
 
 
+def http_cache_ttl(headers, default: float) -> float:
+    """Seconds a response may be reused according to its Cache-Control
+    and Expires headers, default when they don't say."""
+    directives = [d.strip() for d in headers.get("Cache-Control", "").lower().split(",")]
+    if "no-store" in directives or "no-cache" in directives:
+        return 0
+    for directive in directives:
+        if directive.startswith("max-age="):
+            try:
+                return max(0.0, float(directive[len("max-age=") :]))
+            except ValueError:
+                break
+    expires = headers.get("Expires")
+    if expires:
+        try:
+            return max(0.0, parsedate_to_datetime(expires).timestamp() - time.time())
+        except (TypeError, ValueError):
+            return 0  # Invalid dates, like "0", mean already expired
+    return default
+
+
+class TTLCache:
+    """Results of a function by arguments, each kept for a number of
+    seconds, and at most maxsize of them (least recently used are evicted
+    first). See ttl_cache()."""
+
+    def __init__(self, name, maxsize, ttl, negative_ttl, is_negative, ttl_of):
+        self.name = name
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.is_negative = is_negative
+        self.ttl_of = ttl_of
+        self.hits = 0
+        self.misses = 0
+        self.negative = 0
+        self.evictions = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        # Per key lock, and how many threads hold or wait for it:
+        self._computing = {}
+
+    def get(self, key, count=True) -> tuple[bool, object]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                expires, value = entry
+                if expires is None or expires > time.monotonic():
+                    self._entries.move_to_end(key)
+                    if count:
+                        self.hits += 1
+                    return (True, value)
+                del self._entries[key]
+            if count:
+                self.misses += 1
+            return (False, None)
+
+    @contextmanager
+    def computing(self, key):
+        """Held while computing the result for key, so other threads which
+        miss the same key wait for that result instead of computing it too."""
+        with self._lock:
+            lock, users = self._computing.get(key, (None, 0))
+            if lock is None:
+                lock = threading.Lock()
+            self._computing[key] = (lock, users + 1)
+        try:
+            with lock:
+                yield
+        finally:
+            with self._lock:
+                lock, users = self._computing[key]
+                if users == 1:
+                    del self._computing[key]
+                else:
+                    self._computing[key] = (lock, users - 1)
+
+    def _ttl(self, value) -> float | None:
+        if self.is_negative is not None and self.is_negative(value):
+            self.negative += 1
+            return self.negative_ttl
+        if self.ttl_of is not None and self.ttl is not None:
+            # The result's own ttl (from HTTP headers) can be far longer
+            # than we want to keep it:
+            return min(self.ttl_of(value), self.ttl)
+        if self.ttl_of is not None:
+            return self.ttl_of(value)
+        return self.ttl
+
+    def put(self, key, value):
+        with self._lock:
+            ttl = self._ttl(value)
+            if ttl is not None and ttl <= 0:
+                return
+            expires = None if ttl is None else time.monotonic() + ttl
+            self._entries[key] = (expires, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def info(self) -> dict:
+        with self._lock:
+            return {
+                "name": self.name,
+                "size": len(self._entries),
+                "maxsize": self.maxsize,
+                "hits": self.hits,
+                "misses": self.misses,
+                "negative": self.negative,
+                "evictions": self.evictions,
+            }
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+# All caches made by ttl_cache(), for the statistics:
+caches = []
+
+
+def ttl_cache(ttl=300, maxsize=1024, negative_ttl=60, is_negative=None, ttl_of=None):
+    """Like functools.cache, for long-running workers: results expire after
+    ttl seconds (None keeps them), or ttl_of(result) seconds up to ttl, and
+    at most maxsize are kept. Results for which is_negative(result) is true
+    (lookup failures) are kept for negative_ttl seconds instead.
+    Exceptions are not cached. Threads which miss the same key at the same
+    time wait for the first one's result, instead of all doing the lookup."""
+
+    def decorator(function):
+        cache = TTLCache(function.__name__, maxsize, ttl, negative_ttl, is_negative, ttl_of)
+        caches.append(cache)
+
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            key = (args, tuple(sorted(kwargs.items())))
+            found, value = cache.get(key)
+            if found:
+                return value
+            with cache.computing(key):
+                # Computed by another thread while waiting:
+                found, value = cache.get(key, count=False)
+                if found:
+                    return value
+                value = function(*args, **kwargs)
+                cache.put(key, value)
+                return value
+
+        wrapper.cache = cache
+        wrapper.cache_info = cache.info
+        wrapper.cache_clear = cache.clear
+        return wrapper
+
+    return decorator
+
+
+def print_cache_stats():
+    for cache in caches:
+        info = cache.info()
+        if not info["hits"] and not info["misses"]:
+            continue
+        print(
+            f"Cache {info['name']}: {info['hits']} hits, {info['misses']} misses, "
+            + f"{info['negative']} negative, {info['evictions']} evictions, "
+            + f"{info['size']}/{info['maxsize']} entries"
+        )
+
+
 class ModBase:
+    # How many requests to handle at the same time, overridden by modules
+    # which spend their time waiting on the network, and by the
+    # PAINTDRY_MODULE_WORKERS environment variable (workers in config.json):
+    workers = 1
+    # How many requests for the same host to handle at the same time:
+    max_per_host = 1
+
     def __init__(self):
         self.cache_folder = None
+        if os.getenv("PAINTDRY_MODULE_WORKERS"):
+            self.workers = int(os.environ["PAINTDRY_MODULE_WORKERS"])
 
     def example_requests(self):
         return []
@@ -91,6 +284,47 @@ class ModBase:
             return self.change(request)
         return []
 
+    def request_host(self, request: dict) -> str:
+        """Host which the request talks to, for politeness limits."""
+        return url_to_hostname(request["resource"])
+
+    def _handle_host_queue(self, queue: deque, results: list):
+        """Handle requests for one host, one after another, until its queue
+        is empty. results[index] gets the responses to requests[index]."""
+        while True:
+            try:
+                index, request = queue.popleft()
+            except IndexError:
+                return
+            results[index] = list(self.handle_request(request))
+
+    def handle_requests(self, requests: list[dict]) -> list[dict]:
+        """Handle many requests, concurrently if there are multiple workers.
+        The results are in the same order as the requests."""
+        if self.workers <= 1 or len(requests) <= 1:
+            results = []
+            for request in requests:
+                results.extend(self.handle_request(request))
+            return results
+        # Each host gets its own queue, drained by at most max_per_host
+        # threads, so threads never sit waiting for their turn at a host
+        # while requests for other hosts are pending:
+        queues = {}
+        for index, request in enumerate(requests):
+            host = self.request_host(request)
+            queues.setdefault(host, deque()).append((index, request))
+        per_request = [None] * len(requests)
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            futures = [
+                executor.submit(self._handle_host_queue, queue, per_request)
+                for lane in range(self.max_per_host)
+                for queue in queues.values()
+                if lane < len(queue)
+            ]
+            for future in futures:
+                future.result()
+        return [result for results in per_request for result in results]
+
     def handle_line(self, line):
         request = json.loads(line)
         assert type(request) is dict
@@ -117,17 +351,37 @@ class ModBase:
             # Actually handle request and output results:
             self.handle_line(line)
 
+    def handle_worker(self):
+        """Long-running worker, reading NDJSON requests from stdin and
+        writing NDJSON responses to stdout, one batch at a time."""
+        out = sys.stdout
+        # Module code prints progress, keep that out of the responses:
+        sys.stdout = sys.stderr
+        batch = []
+        for line in sys.stdin:
+            line = line.strip()
+            if not line:
+                continue
+            request = json.loads(line)
+            assert type(request) is dict
+            if request != END_OF_BATCH:
+                batch.append(request)
+                continue
+            for result in self.handle_requests(batch):
+                out.write(json.dumps(result) + "\n")
+            out.write(json.dumps(END_OF_BATCH) + "\n")
+            out.flush()
+            batch = []
+            print_cache_stats()
+
     def handle_single_file(self, input_dir, name, output_dir):
         input_file = Path(input_dir, name)
         output_file = Path(output_dir, name)
         with open(input_dir + "/" + name, "r") as f:
             data = json.loads(f.read())
-        results = []
         if type(data) is dict:
-            results = self.handle_request(data)
-        else:
-            for element in data:
-                results.extend(self.handle_request(element))
+            data = [data]
+        results = self.handle_requests(data)
         assert type(results) is list
         with open(output_file, "w") as f:
             f.write(json.dumps(results))
@@ -171,6 +425,12 @@ class ModBase:
         if len(sys.argv) == 2 and sys.argv[1] == "example":
             self.run_example()
             return
+        if len(sys.argv) == 3 and sys.argv[1] == "worker":
+            self.cache_folder = sys.argv[2]
+            if cache:
+                self.install_cache()
+            self.handle_worker()
+            return
         if len(sys.argv) == 4:
             self.cache_folder = sys.argv[3]
             if cache:
@@ -1,12 +1,11 @@
-from functools import cache
 from collections.abc import Iterable
 
 import requests
 
-from modlib import ModBase, now, respond_with_severity, normalize_url
+from modlib import ModBase, now, respond_with_severity, normalize_url, ttl_cache
 
 
-@cache
+@ttl_cache(ttl=3600, negative_ttl=300, is_negative=lambda data: not data)
 def download_and_parse_checksums(url):
     """Download a checksums.txt file and parse it into a dict of filename -> checksum."""
     data = {}
@@ -37,6 +36,8 @@ def download_and_parse_checksums(url):
 
 
 class ModSimpleChecksums(ModBase):
+    workers = 4
+
     def example_requests(self):
         return [
             {
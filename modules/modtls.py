@@ -1,32 +1,37 @@
 import ssl
-from functools import cache
 from datetime import datetime, timezone
-from time import sleep
 from collections.abc import Iterable
 
 from cryptography import x509
 from cryptography.hazmat.backends import default_backend
-import requests
 
-from modlib import ModBase, now, normalize_url, url_to_hostname, respond_with_severity
+from modlib import (
+    ModBase,
+    now,
+    normalize_url,
+    url_to_hostname,
+    respond_with_severity,
+    rate_limiter,
+    rate_limited_get,
+    ttl_cache,
+)
 
 
-@cache
+@ttl_cache(ttl=3600, negative_ttl=300, is_negative=lambda result: result[1] == "invalid")
 def cert_checks(url: str):
     url = normalize_url(url)
     try:
-        r = requests.get(url, allow_redirects=False)
+        r = rate_limited_get(url, allow_redirects=False)
         if getattr(r, "from_cache", False):
             print("CACHE HIT: " + url)
-        else:
-            sleep(0.2)
+            # No request was made, the cert lookup below is the first one:
+            rate_limiter.wait(url_to_hostname(url))
     except:
         print(f"Exception encountered when looking up cert for {url}")
         return ("critical", "invalid")
     url = url[len("https://") : -1]
     print(f"Looking up TLS cert for {url}")
     r = ssl.get_server_certificate((url, 443)).encode("utf-8")
-    sleep(1)
     cert = x509.load_pem_x509_certificate(r, default_backend())
     expires = datetime.fromisoformat(str(cert.not_valid_after_utc))
     delta = expires - datetime.now(timezone.utc)
@@ -44,6 +49,8 @@ def cert_checks(url: str):
 
 
 class ModTLS(ModBase):
+    workers = 8
+
     def example_requests(self):
         return [
             {
@@ -0,0 +1,159 @@
+import time
+import threading
+from urllib.parse import urlparse
+from email.utils import parsedate_to_datetime
+
+import requests
+
+# Rate limiting of outgoing HTTP requests, shared by the modules (through
+# modlib) and the GitHub downloader. Kept next to modlib, so the modules
+# still run on their own, without the paintdry package.
+
+
+class TokenBucket:
+    """Allows rate requests per second on average, and bursts of burst."""
+
+    def __init__(self, rate: float, burst: int = 1):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+
+    def take(self) -> float:
+        """Take a token, returns how long to wait before using it."""
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        self.tokens -= 1
+        if self.tokens >= 0:
+            return 0.0
+        return -self.tokens / self.rate
+
+    def give_back(self):
+        self.tokens = min(self.burst, self.tokens + 1)
+
+
+def parse_retry_after(value: str | None) -> float | None:
+    """Seconds to wait according to a Retry-After header (seconds or date)."""
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        date = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    return max(0.0, date.timestamp() - time.time())
+
+
+def parse_int_header(value: str | None) -> int | None:
+    """Integer header value, None when missing or malformed."""
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return None
+
+
+class RateLimiter:
+    """Token buckets per host (or API), backing off when the host tells us
+    to slow down. Requests to different hosts don't wait for each other."""
+
+    def __init__(self, rate: float = 5.0, burst: int = 1, max_backoff: float = 300.0):
+        self.rate = rate
+        self.burst = burst
+        # Only limits the exponential backoff, waits the host asked for
+        # (Retry-After, X-RateLimit-Reset) are respected however long:
+        self.max_backoff = max_backoff
+        self._rates = {}
+        self._buckets = {}
+        self._backoff = {}
+        self._blocked_until = {}
+        self._lock = threading.Lock()
+
+    def set_rate(self, key: str, rate: float, burst: int = 1):
+        with self._lock:
+            self._rates[key] = (rate, burst)
+            self._buckets.pop(key, None)
+
+    def _bucket(self, key: str) -> TokenBucket:
+        if key not in self._buckets:
+            rate, burst = self._rates.get(key, (self.rate, self.burst))
+            self._buckets[key] = TokenBucket(rate, burst)
+        return self._buckets[key]
+
+    def wait(self, key: str):
+        with self._lock:
+            delay = self._bucket(key).take()
+            blocked = self._blocked_until.get(key, 0.0) - time.monotonic()
+            delay = max(delay, blocked)
+        if delay > 0:
+            time.sleep(delay)
+
+    def refund(self, key: str):
+        """Give back the token, when no request was actually made (cache hit)."""
+        with self._lock:
+            self._bucket(key).give_back()
+
+    def block(self, key: str, seconds: float):
+        with self._lock:
+            until = time.monotonic() + seconds
+            self._blocked_until[key] = max(self._blocked_until.get(key, 0.0), until)
+
+    def failure(self, key: str, retry_after: float | None = None):
+        """Back off exponentially, or as long as the host asked us to."""
+        with self._lock:
+            backoff = min(self.max_backoff, max(1.0, 2 * self._backoff.get(key, 0.0)))
+            self._backoff[key] = backoff
+        if retry_after is not None:
+            backoff = retry_after
+        print(f"Backing off {key} for {backoff:.1f}s")
+        self.block(key, backoff)
+
+    def success(self, key: str):
+        with self._lock:
+            self._backoff.pop(key, None)
+
+    def update(self, key: str, r):
+        """Adapt to a response from requests (or requests-cache)."""
+        # from_cache is a special thing added by requests-cache, not a part of the normal Response type
+        if getattr(r, "from_cache", False):
+            self.refund(key)
+            return
+        # GitHub (and others) tell us how many requests we have left:
+        remaining = parse_int_header(r.headers.get("X-RateLimit-Remaining"))
+        reset = parse_int_header(r.headers.get("X-RateLimit-Reset"))
+        until_reset = None
+        if reset is not None:
+            until_reset = max(0.0, reset - time.time())
+        retry_after = parse_retry_after(r.headers.get("Retry-After"))
+        if r.status_code == 429 or r.status_code >= 500:
+            self.failure(key, retry_after)
+            return
+        if r.status_code == 403 and remaining == 0:
+            # GitHub's primary rate limit is a 403, not a 429:
+            self.failure(key, retry_after if retry_after is not None else until_reset)
+            return
+        self.success(key)
+        if remaining is not None and until_reset is not None and remaining <= 1:
+            print(f"Rate limit for {key} almost used up, waiting {until_reset:.0f}s")
+            self.block(key, until_reset)
+
+
+# Shared by all requests made by a process:
+rate_limiter = RateLimiter()
+
+
+def rate_limited_get(url: str, key: str | None = None, **kwargs):
+    """requests.get(), waiting for its turn for the host (or key)."""
+    if key is None:
+        key = urlparse(url).netloc or url
+    rate_limiter.wait(key)
+    try:
+        r = requests.get(url, **kwargs)
+    except requests.exceptions.RequestException:
+        rate_limiter.failure(key)
+        raise
+    rate_limiter.update(key, r)
+    return r
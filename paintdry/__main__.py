@@ -1,24 +1,36 @@
 import sys
 from paintdry import server
 from paintdry import update
+from paintdry import migrate
 
 
 def main():
     print(sys.argv)
     if len(sys.argv) != 2 or sys.argv[1] not in (
         "serve",
+        "serve-dev",
+        "migrate",
         "update-once",
         "update-forever",
+        "worker",
     ):
-        print("Usage: python3 -m paintdry <serve | update-once | update-forever>")
+        print("Usage: python3 -m paintdry <serve | serve-dev | migrate | update-once | update-forever | worker>")
         sys.exit(1)
     match sys.argv[1]:
         case "serve":
             return server.start_server("0.0.0.0", "8000")
+        case "serve-dev":
+            return server.start_dev_server("0.0.0.0", "8000")
+        case "migrate":
+            applied = migrate.migrate()
+            print(f"Applied {len(applied)} migration(s), the schema is up to date")
+            return
         case "update-once":
             return update.once()
         case "update-forever":
             return update.forever()  # TODO: Deprecate
+        case "worker":
+            return update.worker()
 
 
 if __name__ == "__main__":
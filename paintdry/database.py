@@ -1,83 +1,390 @@
+import os
+import select
+import threading
 from time import sleep
+from contextlib import contextmanager
 import json
+import base64
+import uuid
+import datetime
+from collections.abc import Iterator
 
 import psycopg2
+import psycopg2.extras
+import psycopg2.pool
+from psycopg2.extensions import make_dsn, TRANSACTION_STATUS_IDLE
 
 from paintdry.lib import Observation, Resource, Change
 
 
 def _to_json(value):
-    """Convert dict or list to JSON string for storage."""
+    """Adapt a value for the JSONB columns. Other scalars are stored as
+    strings, like they were in the TEXT columns, so 200 and "200" are the
+    same value, and don't cause a change. Strings holding JSON lists and
+    objects are parsed, like text_to_jsonb() did for the existing rows in
+    0007_jsonb_values, so they're stored the same way as before."""
+    if isinstance(value, str) and value[:1] in ("[", "{"):
+        try:
+            value = json.loads(value)
+        except json.JSONDecodeError:
+            pass
     if value is None:
-        return ""
-    if isinstance(value, (dict, list)):
-        return json.dumps(value)
-    return value
+        value = ""
+    elif isinstance(value, bool):
+        value = "true" if value else "false"
+    elif not isinstance(value, (dict, list, str)):
+        value = str(value)
+    return psycopg2.extras.Json(value)
+
+
+# Columns returned by the list endpoints, per table:
+LIST_COLUMNS = {
+    "resources": ["id", "resource", "module", "source", "first_seen", "last_seen"],
+    "observations": [
+        "id",
+        "resource",
+        "module",
+        "attribute",
+        "value",
+        "first_seen",
+        "last_changed",
+        "last_seen",
+        "severity",
+    ],
+    "history": ["id", "resource", "module", "attribute", "value", "timestamp"],
+    "changes": [
+        "id",
+        "resource",
+        "module",
+        "attribute",
+        "old_value",
+        "new_value",
+        "timestamp",
+        "severity",
+    ],
+}
+
+# Columns which can be filtered on with exact matches:
+FILTER_COLUMNS = ("module", "resource", "attribute", "severity", "source")
+
+# Columns which can be sorted on (all the ones which aren't JSON):
+SORT_COLUMNS = (
+    "id",
+    "resource",
+    "module",
+    "source",
+    "attribute",
+    "severity",
+    "first_seen",
+    "last_changed",
+    "last_seen",
+    "timestamp",
+)
+
+# Column used for time range filters, and default sort order:
+TIME_COLUMNS = {
+    "resources": "last_seen",
+    "observations": "last_seen",
+    "history": "timestamp",
+    "changes": "timestamp",
+}
+
 
+# Tables with a seq column, which can be followed with rows_since():
+FEED_TABLES = ("changes", "history")
 
-def _from_json(value):
-    """Try to parse JSON string back to dict/list, return original if not JSON."""
-    if not isinstance(value, str):
-        return value
+
+# Sort columns which hold timestamps, the only ones which can be NULL:
+TIMESTAMP_COLUMNS = ("first_seen", "last_changed", "last_seen", "timestamp")
+
+
+def encode_cursor(sort: str, value, id) -> str:
+    """Position after a row in list_rows(), with its value of the sort
+    column (None for NULL) and its id."""
+    if isinstance(value, datetime.datetime):
+        value = value.isoformat()
+    elif value is not None:
+        value = str(value)
+    data = json.dumps([sort, value, str(id)])
+    return base64.urlsafe_b64encode(data.encode("utf-8")).decode("ascii")
+
+
+def decode_cursor(cursor: str, sort: str) -> tuple:
+    """The (value, id) of a cursor from encode_cursor(), converted to the
+    types of the sort column and id. Raises ValueError for cursors which
+    are invalid, or were made for another sort column."""
     try:
-        parsed = json.loads(value)
-        if isinstance(parsed, (dict, list)):
-            return parsed
-    except (json.JSONDecodeError, TypeError):
-        pass
-    return value
+        values = json.loads(base64.urlsafe_b64decode(cursor.encode("ascii")))
+    except ValueError:
+        raise ValueError("Invalid cursor")
+    if type(values) is not list or len(values) != 3:
+        raise ValueError("Invalid cursor")
+    cursor_sort, value, id = values
+    if cursor_sort != sort:
+        raise ValueError(f"Cursor is not for sorting on '{sort}'")
+    if type(id) is not str:
+        raise ValueError("Invalid cursor")
+    id = uuid.UUID(id)
+    if value is None and sort in TIMESTAMP_COLUMNS:
+        return (None, str(id))
+    if type(value) is not str:
+        raise ValueError("Invalid cursor")
+    if sort in TIMESTAMP_COLUMNS:
+        value = datetime.datetime.fromisoformat(value)
+    elif sort == "id":
+        value = str(uuid.UUID(value))
+    return (value, str(id))
+
+
+def connection_string() -> str:
+    """Connection details from the usual libpq environment variables."""
+    return make_dsn(
+        host=os.getenv("PGHOST", "postgres"),
+        port=os.getenv("PGPORT", "5432"),
+        dbname=os.getenv("PGDATABASE", "postgres"),
+        user=os.getenv("PGUSER", "postgres"),
+        password=os.getenv("PGPASSWORD", "postgres"),
+        # Let TCP notice dead connections sitting idle in the pool:
+        keepalives=1,
+        keepalives_idle=30,
+    )
 
 
-def connect_loop():
+def connect_loop(minconn: int, maxconn: int):
     while True:
         try:
-            conn = psycopg2.connect(
-                "host='postgres' dbname='postgres' user='postgres' host='postgres' password='postgres'"
+            pool = psycopg2.pool.ThreadedConnectionPool(
+                minconn, maxconn, connection_string()
             )
             print("Connected to PG")
-            return conn
-        except:
+            return pool
+        except psycopg2.OperationalError:
             print("Database not ready, waiting...")
             sleep(2)
 
 
-class Database:
-    def __init__(self):
-        self.connection = connect_loop()
+def listen(channels: list[str], timeout: float = 60.0) -> Iterator[str]:
+    """Yield the channel name of every NOTIFY sent on channels.
 
-    def _query(self, query, args=None):
-        conn = self.connection
-        cur = conn.cursor()
-        if args:
-            cur.execute(query, args)
-        else:
-            cur.execute(query)
-        result = []
+    Uses its own connection, in autocommit mode, the pooled connections
+    are only borrowed for one transaction at a time."""
+    conn = psycopg2.connect(connection_string())
+    conn.autocommit = True
+    try:
+        with conn.cursor() as cur:
+            for channel in channels:
+                cur.execute(f"LISTEN {channel};")
         while True:
+            if select.select([conn], [], [], timeout) == ([], [], []):
+                continue
+            conn.poll()
+            while conn.notifies:
+                yield conn.notifies.pop(0).channel
+    finally:
+        conn.close()
+
+
+def _is_healthy(conn) -> bool:
+    return not conn.closed and conn.get_transaction_status() == TRANSACTION_STATUS_IDLE
+
+
+def _connection_lost(conn, error: psycopg2.Error) -> bool:
+    """Whether error is the connection failing (class 08), rather than
+    the statement (lock / statement timeouts, deadlocks, ...)."""
+    return bool(conn.closed) or (error.pgcode or "").startswith("08")
+
+
+def _is_uuid(string: str) -> bool:
+    try:
+        uuid.UUID(string)
+        return True
+    except ValueError:
+        return False
+
+
+def _uuid_range(prefix: str) -> tuple[str, str] | tuple[None, None]:
+    """Lowest and highest UUID starting with prefix, so an id can be
+    searched for by the start of it with the primary key index. None, None
+    (matching nothing) if no UUID starts with prefix."""
+    template = "00000000-0000-0000-0000-000000000000"
+    prefix = prefix.lower()
+    if len(prefix) > len(template):
+        return None, None
+    for char, expected in zip(prefix, template):
+        if (char == "-") != (expected == "-"):
+            return None, None
+        if char != "-" and char not in "0123456789abcdef":
+            return None, None
+    rest = template[len(prefix):]
+    return prefix + rest, prefix + rest.replace("0", "f")
+
+
+def _row_to_dict(columns: list[str], row) -> dict:
+    return dict(zip(columns, row))
+
+
+def _feed_cursor(xid, seq: int) -> str:
+    """Position of a row in rows_since(), the seq of rows without an xid."""
+    if xid is None:
+        return str(seq)
+    return f"{xid}.{seq}"
+
+
+# Rows are only rewritten when the value or severity changed, or to bump
+# last_seen once it's more than last_seen_resolution seconds old. Unchanged
+# observations are upserted on every update, rewriting each of them every
+# time is what causes most of the WAL and dead rows.
+UPSERT_OBSERVATIONS = """
+    INSERT INTO observations (module, attribute, resource, value, first_seen, last_changed, last_seen, severity)
+    VALUES %s
+    ON CONFLICT ON CONSTRAINT observations_constraint
+    DO UPDATE SET last_seen = EXCLUDED.last_seen,
+    value = EXCLUDED.value,
+    severity = EXCLUDED.severity,
+    last_changed = CASE
+    WHEN observations.value_hash IS DISTINCT FROM EXCLUDED.value_hash THEN EXCLUDED.last_changed
+    ELSE observations.last_changed END
+    WHERE observations.value_hash IS DISTINCT FROM EXCLUDED.value_hash
+    OR observations.severity IS DISTINCT FROM EXCLUDED.severity
+    OR observations.last_seen <= EXCLUDED.last_seen - make_interval(secs => {resolution})
+    RETURNING module, resource, last_changed = last_seen;
+"""
+
+# Work items which failed this many times are given up on until the next
+# update:
+MAX_WORK_ATTEMPTS = 3
+
+UPSERT_SCHEDULE = """
+    INSERT INTO schedule (module, resource, interval_seconds, next_due)
+    VALUES %s
+    ON CONFLICT (module, resource)
+    DO UPDATE SET interval_seconds = EXCLUDED.interval_seconds,
+    next_due = EXCLUDED.next_due;
+"""
+
+
+class Database:
+    def __init__(
+        self,
+        itersize: int = 2000,
+        maxconn: int | None = None,
+        last_seen_resolution: int = 0,
+    ):
+        if maxconn is None:
+            maxconn = int(os.getenv("PAINTDRY_DB_POOL_SIZE", "10"))
+        self.pool = connect_loop(1, maxconn)
+        # ThreadedConnectionPool raises when it runs out, wait instead:
+        self._available = threading.BoundedSemaphore(maxconn)
+        # How many rows to fetch at a time when streaming results:
+        self.itersize = itersize
+        # Seconds, how stale last_seen of an unchanged observation may get:
+        self.last_seen_resolution = last_seen_resolution
+
+    @contextmanager
+    def _connection(self):
+        """Borrow a connection from the pool, for one transaction.
+
+        The transaction is committed when the block finishes, and rolled
+        back if it raises. Lost connections are closed instead of being
+        put back into the pool."""
+        with self._available:
+            conn = self.pool.getconn()
+            if not _is_healthy(conn):
+                self.pool.putconn(conn, close=True)
+                conn = self.pool.getconn()
+            broken = False
             try:
-                row = cur.fetchone()
-            except:
-                break
-            if not row:
-                break
-            result.append(row)
-        conn.commit()
-        cur.close()
-        return result
+                yield conn
+                conn.commit()
+            except psycopg2.Error as e:
+                broken = _connection_lost(conn, e)
+                if not broken:
+                    conn.rollback()
+                raise
+            except BaseException:
+                conn.rollback()
+                raise
+            finally:
+                self.pool.putconn(conn, close=broken or bool(conn.closed))
+
+    def _run(self, function):
+        """Run function(cursor) in a transaction, retrying once with a new
+        connection if the connection turns out to be broken. Other errors
+        (timeouts, deadlocks, constraint violations) are raised as is."""
+        for attempt in (1, 2):
+            conn = None
+            try:
+                with self._connection() as conn:
+                    with conn.cursor() as cur:
+                        return function(cur)
+            except psycopg2.Error as e:
+                if attempt == 2 or conn is None or not _connection_lost(conn, e):
+                    raise
+                print("Lost connection to PG, reconnecting...")
+
+    def _query(self, query, args=None):
+        def execute(cur):
+            cur.execute(query, args or None)
+            # No result set for INSERT / UPDATE without RETURNING:
+            return cur.fetchall() if cur.description is not None else []
+
+        return self._run(execute)
+
+    def _iter_query(self, query, args=None):
+        """Yield rows from a server-side cursor, fetching itersize rows at a
+        time, so memory use doesn't grow with the size of the result.
+
+        Holds on to a connection from the pool until the iteration is done,
+        stopping early rolls back, which also closes the cursor."""
+        with self._connection() as conn:
+            cur = conn.cursor(name=f"paintdry_{uuid.uuid4().hex}")
+            cur.itersize = self.itersize
+            cur.execute(query, args or None)
+            yield from cur
+            cur.close()
+
+    def update_changes(self, changes: list[Change]):
+        """Write the severities of classified changes, with one UPDATE
+        matching on the primary key."""
+        rows = {}
+        for change in changes:
+            if change.id is None:
+                # From requests written before changes were sent with ids
+                self.update_change(change)
+                continue
+            rows[str(change.id)] = (str(change.id), change.severity)
+        if not rows:
+            return
+        self._run(
+            lambda cur: psycopg2.extras.execute_values(
+                cur,
+                """
+                UPDATE changes SET severity = classified.severity
+                FROM (VALUES %s) AS classified (id, severity)
+                WHERE changes.id = classified.id::UUID
+                AND changes.severity IN ('', 'unknown');
+                """,
+                list(rows.values()),
+                page_size=1000,
+            )
+        )
 
     def update_change(self, change: Change):
+        # Modules get and return the values as text, see Change.to_request()
+        request = change.to_request()
         return self._query(
             """
             UPDATE changes
             SET severity=%s
-            WHERE (severity='' OR severity='unknown') AND resource=%s AND attribute=%s AND old_value=%s AND new_value=%s
+            WHERE (severity='' OR severity='unknown') AND resource=%s AND attribute=%s
+            AND old_value #>> '{}' = %s AND new_value #>> '{}' = %s
             """,
             (
                 change.severity,
                 change.resource,
                 change.attribute,
-                _to_json(change.old_value),
-                _to_json(change.new_value),
+                request["old_value"],
+                request["new_value"],
             ),
         )
 
@@ -87,43 +394,50 @@ class Database:
             INSERT INTO resources (module, resource, source)
             VALUES(%s, %s, %s)
             ON CONFLICT ON CONSTRAINT resources_constraint
-            DO UPDATE SET last_seen = NOW()
+            DO UPDATE SET last_seen = NOW(),
+            missed_updates = 0,
+            stale = CASE WHEN EXCLUDED.source = '' THEN resources.stale ELSE NULL END
             """,
             (resource.module, resource.resource, source),
         )
 
-    def upsert_observations(self, observation: Observation):
-        module = observation.module
-        attribute = observation.attribute
-        resource = observation.resource
-        value = _to_json(observation.value)
-        timestamp = observation.timestamp
-        severity = observation.severity
-        return self._query(
-            """
-            INSERT INTO observations (module, attribute, resource, value, first_seen, last_changed, last_seen, severity)
-            VALUES(%s, %s, %s, %s, %s, %s, %s, %s)
-            ON CONFLICT ON CONSTRAINT observations_constraint
-            DO UPDATE SET last_seen = %s,
-            value = EXCLUDED.value,
-            severity = EXCLUDED.severity,
-            last_changed = CASE
-            WHEN observations.value IS DISTINCT FROM EXCLUDED.value THEN %s
-            ELSE observations.last_changed END;
-            """,
-            (
-                module,
-                attribute,
-                resource,
-                value,
-                timestamp,
-                timestamp,
+    def upsert_observations(self, observation: Observation) -> set[tuple[str, str]]:
+        return self.upsert_observations_batch([observation])
+
+    def upsert_observations_batch(
+        self, observations: list[Observation]
+    ) -> set[tuple[str, str]]:
+        """Upsert many observations with one multi-row INSERT and one commit.
+
+        Observations which haven't changed are left alone, unless their
+        last_seen is older than last_seen_resolution. Returns the (module,
+        resource) pairs with new or changed values."""
+        # ON CONFLICT DO UPDATE cannot touch the same row twice in one
+        # statement, so only keep the last observation per key:
+        rows = {}
+        for observation in observations:
+            key = (observation.module, observation.attribute, observation.resource)
+            timestamp = observation.timestamp
+            rows[key] = (
+                *key,
+                _to_json(observation.value),
                 timestamp,
-                severity,
                 timestamp,
                 timestamp,
-            ),
+                observation.severity,
+            )
+        if not rows:
+            return set()
+        written = self._run(
+            lambda cur: psycopg2.extras.execute_values(
+                cur,
+                UPSERT_OBSERVATIONS.format(resolution=int(self.last_seen_resolution)),
+                list(rows.values()),
+                page_size=1000,
+                fetch=True,
+            )
         )
+        return {(module, resource) for module, resource, changed in written if changed}
 
     def get_resource(self, id: str) -> Resource | None:
         rows = self._query(
@@ -151,18 +465,17 @@ class Database:
             return results[0]
         return None
 
-    def get_resources(self) -> list[Resource]:
-        rows = self._query(
-            """
+    def iter_resources(self, live_only: bool = False) -> Iterator[Resource]:
+        where_part = "WHERE stale IS NULL" if live_only else ""
+        rows = self._iter_query(
+            f"""
             SELECT id, resource, module, source, first_seen, last_seen
-            FROM resources;
+            FROM resources
+            {where_part};
             """
         )
-        if not rows:
-            return []
-        results = []
         for row in rows:
-            resource = Resource(
+            yield Resource(
                 id=row[0],
                 resource=row[1],
                 module=row[2],
@@ -170,12 +483,17 @@ class Database:
                 first_seen=row[4],
                 last_seen=row[5],
             )
-            results.append(resource)
-        return results
 
-    def _select(
+    def get_resources(self) -> list[Resource]:
+        return list(self.iter_resources())
+
+    def get_live_resources(self) -> list[Resource]:
+        """The resources which aren't stale, the ones the updater observes."""
+        return list(self.iter_resources(live_only=True))
+
+    def _iter_select(
         self, table: str, columns: list[str], where: dict | None = None
-    ) -> list[dict]:
+    ) -> Iterator[dict]:
         where_part = ""
         where_statements = []
         where_values = []
@@ -201,22 +519,147 @@ class Database:
         ;
         """
 
-        rows = self._query(query, where_values) if where else self._query(query)
-        if not rows:
-            return []
+        rows = self._iter_query(query, where_values if where else None)
+        for row in rows:
+            yield _row_to_dict(columns, row)
+
+    def _select(
+        self, table: str, columns: list[str], where: dict | None = None
+    ) -> list[dict]:
+        return list(self._iter_select(table, columns, where))
+
+    def list_rows(
+        self,
+        table: str,
+        filters: dict | None = None,
+        sort: str | None = None,
+        descending: bool = False,
+        limit: int = 100,
+        cursor: str | None = None,
+        since=None,
+        until=None,
+    ) -> dict:
+        """One page of rows, using keyset pagination on (sort column, id).
+
+        Filter values can be lists, to match any of them. Pass the
+        next_cursor of the previous page to get the next one."""
+        columns = LIST_COLUMNS[table]
+        time_column = TIME_COLUMNS[table]
+        if sort is None:
+            sort = time_column
+        if sort not in SORT_COLUMNS or sort not in columns:
+            raise ValueError(f"Cannot sort {table} on '{sort}'")
+
+        where_statements = []
+        where_values = []
+        for key, value in (filters or {}).items():
+            if key not in FILTER_COLUMNS or key not in columns:
+                raise ValueError(f"Cannot filter {table} on '{key}'")
+            if type(value) is not list:
+                value = [value]
+            where_statements.append(f"{key} IN %s")
+            where_values.append(tuple(value))
+        if since is not None:
+            where_statements.append(f"{time_column} >= %s")
+            where_values.append(since)
+        if until is not None:
+            where_statements.append(f"{time_column} < %s")
+            where_values.append(until)
+        direction = "DESC" if descending else "ASC"
+        # NULLs sort after everything else ascending, and before everything
+        # else descending. Instead of OR-ing them into the keyset condition,
+        # which stops it from using the indexes, they're queried separately
+        # when the page continues into / out of them:
+        conditions = [(None, [])]
+        if cursor is not None:
+            value, id = decode_cursor(cursor, sort)
+            operator = "<" if descending else ">"
+            if value is None:
+                conditions = [(f"{sort} IS NULL AND id {operator} %s", [id])]
+                if descending:
+                    conditions.append((f"{sort} IS NOT NULL", []))
+            else:
+                conditions = [(f"({sort}, id) {operator} (%s, %s)", [value, id])]
+                if not descending and sort in TIMESTAMP_COLUMNS:
+                    conditions.append((f"{sort} IS NULL", []))
+
+        # Fetch one extra row, to know whether there is a next page:
+        rows = []
+        for condition, condition_values in conditions:
+            statements = where_statements + ([condition] if condition else [])
+            where_part = ""
+            if statements:
+                where_part = "WHERE " + " AND ".join(statements)
+            query = f"""
+            SELECT {', '.join(columns)}
+            FROM {table}
+            {where_part}
+            ORDER BY {sort} {direction}, id {direction}
+            LIMIT %s;
+            """
+            args = (*where_values, *condition_values, limit + 1 - len(rows))
+            rows.extend(self._query(query, args))
+            if len(rows) > limit:
+                break
+        results = [_row_to_dict(columns, row) for row in rows[0:limit]]
+        next_cursor = None
+        if len(rows) > limit:
+            last = results[-1]
+            next_cursor = encode_cursor(sort, last[sort], last["id"])
+        return {"results": results, "limit": limit, "next_cursor": next_cursor}
+
+    def rows_since(self, table: str, since: str | None = None, limit: int = 100) -> dict:
+        """Rows added to changes or history after since, in the order they
+        were committed.
+
+        since is the next_cursor of a previous call (or the cursor of a
+        row), the id of a row, or an ISO timestamp. Timestamps come from the
+        modules, and seq is assigned on insert, so neither is the order in
+        which rows become visible. Rows are ordered by the transaction which
+        inserted them, and the rows of transactions which may still be
+        running are held back until they're done. So following next_cursor
+        returns every row exactly once, though a long transaction delays
+        the rows after it."""
+        assert table in FEED_TABLES
+        columns = ["seq", *LIST_COLUMNS[table]]
+        where_part = "(xid IS NULL OR xid < pg_snapshot_xmin(pg_current_snapshot()))"
+        where_values = []
+        if since is not None and _is_uuid(since):
+            rows = self._query(f"SELECT xid, seq FROM {table} WHERE id=%s;", (since,))
+            if not rows:
+                raise ValueError(f"No row in {table} with id '{since}'")
+            since = _feed_cursor(*rows[0])
+        if since is not None and since.isdigit():
+            # Rows from before the xid column was added, or after them:
+            where_part += " AND seq > %s"
+            where_values.append(int(since))
+        elif since is not None and since.replace(".", "", 1).isdigit():
+            xid, seq = since.split(".")
+            where_part += " AND xid IS NOT NULL AND (xid, seq) > (%s::xid8, %s)"
+            where_values.extend([xid, int(seq)])
+        elif since is not None:
+            where_part += " AND timestamp >= %s"
+            where_values.append(datetime.datetime.fromisoformat(since))
+        rows = self._query(
+            f"""
+            SELECT xid, {', '.join(columns)}
+            FROM {table}
+            WHERE {where_part}
+            ORDER BY xid NULLS FIRST, seq
+            LIMIT %s;
+            """,
+            (*where_values, limit),
+        )
         results = []
-        json_columns = {"value", "old_value", "new_value"}
         for row in rows:
-            d = {}
-            for key, value in zip(columns, row):
-                if key in json_columns:
-                    value = _from_json(value)
-                d[key] = value
-            results.append(d)
-        return results
+            result = _row_to_dict(columns, row[1:])
+            result["cursor"] = _feed_cursor(row[0], result["seq"])
+            results.append(result)
+        next_cursor = results[-1]["cursor"] if results else since
+        return {"results": results, "limit": limit, "next_cursor": next_cursor}
 
-    def get_observations(self) -> list[Observation]:
-        objects = self._select(
+    def iter_observations(self) -> Iterator[Observation]:
+        objects = self._iter_select(
             "observations",
             [
                 "id",
@@ -230,13 +673,11 @@ class Database:
                 "severity",
             ],
         )
-        if not objects:
-            return []
-        results = []
         for object in objects:
-            result = Observation(**object)
-            results.append(result)
-        return results
+            yield Observation(**object)
+
+    def get_observations(self) -> list[Observation]:
+        return list(self.iter_observations())
 
     def get_observation(self, id: str) -> Observation | None:
         rows = self._query(
@@ -256,7 +697,7 @@ class Database:
                 resource=row[1],
                 module=row[2],
                 attribute=row[3],
-                value=_from_json(row[4]),
+                value=row[4],
                 first_seen=row[5],
                 last_changed=row[6],
                 last_seen=row[7],
@@ -267,9 +708,9 @@ class Database:
             return results[0]
         return None
 
-    def get_history(self, id: str | None = None) -> list[dict]:
+    def iter_history(self, id: str | None = None) -> Iterator[dict]:
         singular = id is not None
-        objects = self._select(
+        return self._iter_select(
             "history",
             [
                 "id",
@@ -281,16 +722,13 @@ class Database:
             ],
             {"id": id} if singular else None,
         )
-        if not objects:
-            return []
-        results = []
-        for object in objects:
-            results.append(object)
-        return results
 
-    def get_changes(self, id: str | None = None) -> list[dict]:
+    def get_history(self, id: str | None = None) -> list[dict]:
+        return list(self.iter_history(id))
+
+    def iter_changes(self, id: str | None = None) -> Iterator[dict]:
         singular = id is not None
-        objects = self._select(
+        return self._iter_select(
             "changes",
             [
                 "id",
@@ -303,12 +741,9 @@ class Database:
             ],
             {"id": id} if singular else None,
         )
-        if not objects:
-            return []
-        results = []
-        for object in objects:
-            results.append(object)
-        return results
+
+    def get_changes(self, id: str | None = None) -> list[dict]:
+        return list(self.iter_changes(id))
 
     def get_new_changes(self) -> list[Change]:
         objects = self._select(
@@ -331,8 +766,319 @@ class Database:
             results.append(Change(**object))
         return results
 
-    def search(self, search_string: str, page: int = 1) -> dict:
-        """Search across resources, observations, and changes tables with pagination."""
+    def maintain_partitions(self, retention_months: int | None = None, months_ahead: int = 2):
+        """Create the monthly partitions of history and changes for the
+        coming months, and drop the ones older than retention_months."""
+        for table in FEED_TABLES:
+            self._query(
+                """
+                SELECT create_month_partition(%s, (NOW() + make_interval(months => i))::DATE)
+                FROM generate_series(0, %s) AS i;
+                """,
+                (table, months_ahead),
+            )
+            if retention_months is not None:
+                self._drop_old_partitions(table, retention_months)
+
+    def _drop_old_partitions(self, table: str, retention_months: int):
+        """Detach the partitions older than retention_months concurrently,
+        then drop them, so reads and writes of the table don't wait for it.
+        Rows of those months in the default partition are deleted."""
+        rows = self._query(
+            "SELECT partition, attached, detach_pending FROM old_partitions(%s, %s);",
+            (table, retention_months),
+        )
+        for partition, attached, detach_pending in rows:
+            if detach_pending:
+                self._execute_autocommit(
+                    f"ALTER TABLE {table} DETACH PARTITION {partition} FINALIZE;"
+                )
+            elif attached:
+                self._execute_autocommit(
+                    f"ALTER TABLE {table} DETACH PARTITION {partition} CONCURRENTLY;"
+                )
+            self._query(f"DROP TABLE IF EXISTS {partition};")
+        self._query(
+            f"""
+            DELETE FROM {table}_default
+            WHERE timestamp < date_trunc('month', NOW()) - make_interval(months => %s);
+            """,
+            (retention_months,),
+        )
+
+    def _execute_autocommit(self, statement: str):
+        """Run a statement which can't run in a transaction, on a pooled
+        connection, in autocommit mode until it's done."""
+
+        def execute(cur):
+            cur.connection.autocommit = True
+            try:
+                cur.execute(statement)
+            finally:
+                if not cur.connection.closed:
+                    cur.connection.autocommit = False
+
+        self._run(execute)
+
+    def get_schedule(self) -> dict[tuple[str, str], dict]:
+        """Interval and whether it's due, per (module, resource)."""
+        rows = self._query(
+            "SELECT module, resource, interval_seconds, next_due <= NOW() FROM schedule;"
+        )
+        return {
+            (module, resource): {"interval": interval, "due": due}
+            for module, resource, interval, due in rows
+        }
+
+    def update_schedule(self, intervals: list[tuple[str, str, int]]):
+        """Set the intervals of (module, resource, seconds), due that many
+        seconds from now."""
+        if not intervals:
+            return
+        self._run(
+            lambda cur: psycopg2.extras.execute_values(
+                cur,
+                UPSERT_SCHEDULE,
+                [(*entry, entry[2]) for entry in intervals],
+                template="(%s, %s, %s, NOW() + make_interval(secs => %s))",
+                page_size=1000,
+            )
+        )
+
+    def enqueue_work(self, items: list[tuple[str, str, dict, int]]) -> int:
+        """Queue (module, key, request, depth) work items, skipping the ones
+        already queued (or completed) in this update. Returns how many
+        were queued."""
+        if not items:
+            return 0
+        rows = [
+            (module, key, _to_json(request), depth)
+            for module, key, request, depth in items
+        ]
+        queued = self._run(
+            lambda cur: psycopg2.extras.execute_values(
+                cur,
+                """
+                INSERT INTO work_items (module, key, request, depth) VALUES %s
+                ON CONFLICT ON CONSTRAINT work_items_constraint DO NOTHING
+                RETURNING id
+                """,
+                rows,
+                page_size=1000,
+                fetch=True,
+            )
+        )
+        return len(queued)
+
+    def claim_work(self, worker: str, limit: int, lease: int) -> list[tuple[int, str, dict, int]]:
+        """Lease up to limit pending work items for lease seconds, returns
+        (id, module, request, depth) tuples. SKIP LOCKED lets many workers claim
+        at the same time without waiting for, or getting, each other's
+        items."""
+        return self._query(
+            """
+            UPDATE work_items
+            SET leased_by = %s,
+            lease_expires = NOW() + make_interval(secs => %s),
+            attempts = attempts + 1
+            WHERE id IN (
+                SELECT id FROM work_items
+                WHERE completed IS NULL
+                AND (lease_expires IS NULL OR lease_expires < NOW())
+                AND attempts < %s
+                ORDER BY id
+                LIMIT %s
+                FOR UPDATE SKIP LOCKED
+            )
+            RETURNING id, module, request, depth;
+            """,
+            (worker, lease, MAX_WORK_ATTEMPTS, limit),
+        )
+
+    def complete_work(self, ids: list[int], worker: str):
+        """Mark work items as done, unless their lease expired and another
+        worker claimed them in the meantime."""
+        if not ids:
+            return
+        self._query(
+            """
+            UPDATE work_items SET completed = NOW(), leased_by = NULL, lease_expires = NULL
+            WHERE id = ANY(%s) AND leased_by = %s;
+            """,
+            (list(ids), worker),
+        )
+
+    def pending_work(self) -> int:
+        """Work items which aren't done yet, and will be worked on (by
+        this or another worker) before they're given up on."""
+        rows = self._query(
+            """
+            SELECT COUNT(*) FROM work_items
+            WHERE completed IS NULL
+            AND (attempts < %s OR lease_expires >= NOW());
+            """,
+            (MAX_WORK_ATTEMPTS,),
+        )
+        return rows[0][0]
+
+    def failed_observations(self) -> list[tuple[str, str]]:
+        """(module, resource) of the observation work items which were
+        given up on in this update."""
+        return self._query(
+            """
+            SELECT module, request->>'resource' FROM work_items
+            WHERE completed IS NULL AND attempts >= %s
+            AND request->>'operation' = 'observation';
+            """,
+            (MAX_WORK_ATTEMPTS,),
+        )
+
+    def purge_work(self) -> int:
+        """Delete the work items of the previous update, completed or given
+        up on. Returns how many were left unfinished."""
+        rows = self._query(
+            """
+            WITH purged AS (
+                DELETE FROM work_items
+                WHERE completed IS NOT NULL
+                OR (lease_expires < NOW() AND attempts >= %s)
+                RETURNING completed
+            )
+            SELECT COUNT(*) FILTER (WHERE completed IS NULL) FROM purged;
+            """,
+            (MAX_WORK_ATTEMPTS,),
+        )
+        return rows[0][0]
+
+    def work_discoveries(self) -> list[tuple[str, str, bool]]:
+        """(module, source, completed) of the discovery work items of this
+        update."""
+        return self._query(
+            """
+            SELECT DISTINCT module, request->>'source', completed IS NOT NULL
+            FROM work_items
+            WHERE request->>'operation' = 'discovery';
+            """
+        )
+
+    def now(self) -> datetime.datetime:
+        """Current time of the database, which the NOW() defaults use."""
+        return self._query("SELECT LOCALTIMESTAMP;")[0][0]
+
+    def expire_resources(
+        self,
+        observed: list[tuple[str, str]],
+        since: datetime.datetime,
+        stale_after: int,
+        dry_run: bool = False,
+        sources: set[str] | None = None,
+    ) -> list[tuple[str, str, int]]:
+        """Count an update missed for the observed (module, resource) pairs
+        which weren't discovered again since the start of the update, and
+        mark the ones which missed stale_after updates stale, archiving
+        their observations.
+
+        Only discoveries with a source count, a module confirming its own
+        resource (source '') doesn't tell whether it still exists. Misses
+        are only counted for the sources which ran all of their discoveries
+        in this update, a source which didn't run (schedule, failure) isn't
+        a reason to think its resources are gone. Returns (module, resource,
+        number of observations) of the stale resources, with dry_run they're
+        only reported."""
+        if not observed or not sources:
+            return []
+        modules = [module for module, _ in observed]
+        resources = [resource for _, resource in observed]
+
+        def expire(cur):
+            cur.execute(
+                """
+                UPDATE resources
+                SET missed_updates = CASE WHEN last_seen >= %s THEN 0
+                ELSE missed_updates + 1 END
+                FROM unnest(%s::TEXT[], %s::TEXT[]) AS observed (module, resource)
+                WHERE resources.module = observed.module
+                AND resources.resource = observed.resource
+                AND resources.source = ANY(%s) AND resources.stale IS NULL;
+                """,
+                (since, modules, resources, sorted(sources)),
+            )
+            cur.execute(
+                """
+                CREATE TEMPORARY TABLE expired ON COMMIT DROP AS
+                SELECT module, resource FROM resources
+                WHERE stale IS NULL AND (module, resource) IN (
+                    SELECT * FROM unnest(%s::TEXT[], %s::TEXT[])
+                )
+                GROUP BY module, resource
+                HAVING bool_and(source = '' OR missed_updates >= %s)
+                AND bool_or(source != '');
+                """,
+                (modules, resources, stale_after),
+            )
+            cur.execute(
+                """
+                SELECT expired.module, expired.resource, COUNT(observations.id)
+                FROM expired LEFT JOIN observations USING (module, resource)
+                GROUP BY expired.module, expired.resource
+                ORDER BY expired.module, expired.resource;
+                """
+            )
+            stale = cur.fetchall()
+            if dry_run or not stale:
+                return stale
+            cur.execute(
+                """
+                UPDATE resources SET stale = NOW()
+                FROM expired
+                WHERE resources.module = expired.module
+                AND resources.resource = expired.resource;
+                """
+            )
+            cur.execute(
+                """
+                WITH archived AS (
+                    DELETE FROM observations USING expired
+                    WHERE observations.module = expired.module
+                    AND observations.resource = expired.resource
+                    RETURNING observations.id, observations.resource,
+                    observations.module, observations.attribute,
+                    observations.value, observations.first_seen,
+                    observations.last_changed, observations.last_seen,
+                    observations.severity
+                )
+                INSERT INTO observations_archive
+                (id, resource, module, attribute, value, first_seen, last_changed, last_seen, severity)
+                SELECT * FROM archived
+                ON CONFLICT (id) DO NOTHING;
+                """
+            )
+            cur.execute(
+                """
+                DELETE FROM schedule USING expired
+                WHERE schedule.module = expired.module
+                AND schedule.resource = expired.resource;
+                """
+            )
+            return stale
+
+        return self._run(expire)
+
+    def get_table_version(self, table: str) -> tuple[int, datetime.datetime]:
+        """Version number and time of the last modification of a table,
+        bumped by the statement triggers in the migrations."""
+        rows = self._query(
+            "SELECT version, updated FROM table_versions WHERE name=%s;", (table,)
+        )
+        assert rows, f"No version for table '{table}'"
+        return rows[0]
+
+    def search(self, search_string: str, page: int = 1, estimate: bool = False) -> dict:
+        """Search across resources, observations, and changes tables with pagination.
+
+        Every predicate can use the trigram (GIN) indexes on these tables.
+        With estimate=True, total_results is the planner's estimate instead
+        of an exact count, which is much cheaper for broad searches."""
         if not search_string:
             return {
                 "query": search_string,
@@ -343,58 +1089,80 @@ class Database:
                 "total_pages": 0,
             }
 
-        search_pattern = f"%{search_string}%"
         if page < 1:
             page = 1
         per_page = 50
         offset = (page - 1) * per_page
+        id_from, id_to = _uuid_range(search_string)
+        args = {
+            "pattern": f"%{search_string}%",
+            "id_from": id_from,
+            "id_to": id_to,
+            "limit": per_page,
+            "offset": offset,
+        }
 
-        # Search resources
+        matches = """
+            SELECT 'resource' AS type, id, resource, module, NULL AS attribute,
+                json_build_object(
+                    'first_seen', first_seen,
+                    'last_seen', last_seen,
+                    'source', source)
+                AS expanded_data
+            FROM resources
+            WHERE resource LIKE %(pattern)s
+                  OR module LIKE %(pattern)s
+                  OR source LIKE %(pattern)s
+                  OR 'resource' LIKE %(pattern)s
+                  OR id BETWEEN %(id_from)s AND %(id_to)s
+            UNION ALL
+            SELECT 'observation' AS type, id, resource, module, attribute,
+                json_build_object(
+                    'first_seen', first_seen,
+                    'last_seen', last_seen,
+                    'value', value #>> '{}',
+                    'severity', severity)
+                AS expanded_data
+            FROM observations
+            WHERE resource LIKE %(pattern)s
+                  OR module LIKE %(pattern)s
+                  OR attribute LIKE %(pattern)s
+                  OR value #>> '{}' LIKE %(pattern)s
+                  OR severity LIKE %(pattern)s
+                  OR 'observation' LIKE %(pattern)s
+                  OR id BETWEEN %(id_from)s AND %(id_to)s
+            UNION ALL
+            SELECT 'change' AS type, id, resource, module, attribute,
+                json_build_object(
+                    'timestamp', timestamp,
+                    'old_value', old_value #>> '{}',
+                    'new_value', new_value #>> '{}',
+                    'severity', severity)
+                AS expanded_data
+            FROM changes
+            WHERE resource LIKE %(pattern)s
+                  OR module LIKE %(pattern)s
+                  OR attribute LIKE %(pattern)s
+                  OR old_value #>> '{}' LIKE %(pattern)s
+                  OR new_value #>> '{}' LIKE %(pattern)s
+                  OR severity LIKE %(pattern)s
+                  OR 'change' LIKE %(pattern)s
+                  OR id BETWEEN %(id_from)s AND %(id_to)s
+        """
+
+        if estimate:
+            total_count = "0"
+        else:
+            total_count = "COUNT(*) OVER()"
         raw_results = self._query(
-            """
-            WITH all_results AS (
-                SELECT 'resource' AS type, id, resource, module, NULL AS attribute,
-                    json_build_object(
-                        'first_seen', first_seen,
-                        'last_seen', last_seen,
-                        'source', source)
-                    AS expanded_data
-                FROM resources
-                UNION ALL
-                SELECT 'observation' AS type, id, resource, module, attribute,
-                    json_build_object(
-                        'first_seen', first_seen,
-                        'last_seen', last_seen,
-                        'value', value,
-                        'severity', severity)
-                    AS expanded_data
-                FROM observations
-                UNION ALL
-                SELECT 'change' AS type, id, resource, module, attribute,
-                    json_build_object(
-                        'timestamp', timestamp,
-                        'old_value', old_value,
-                        'new_value', new_value,
-                        'severity', severity)
-                    AS expanded_data
-                FROM changes
-            ),
-            filtered_results AS (
-                SELECT *, COUNT(*) OVER() AS total_count
-                FROM all_results
-                WHERE resource LIKE %s
-                      OR attribute LIKE %s
-                      OR id::VARCHAR LIKE %s
-                      OR type LIKE %s
-                      OR module LIKE %s
-                      OR expanded_data::VARCHAR LIKE %s
-            )
-            SELECT total_count, id, resource, attribute, type, module, expanded_data
-            FROM filtered_results
+            f"""
+            WITH matches AS ({matches})
+            SELECT {total_count} AS total_count, id, resource, attribute, type, module, expanded_data
+            FROM matches
             ORDER BY resource, attribute, type, module, id
-            LIMIT %s OFFSET %s;
+            LIMIT %(limit)s OFFSET %(offset)s;
             """,
-            6 * (search_pattern, ) + (per_page, offset),
+            args,
         )
 
         results = []
@@ -414,6 +1182,10 @@ class Database:
                 result[key] = value
             results.append(result)
 
+        if estimate:
+            plan = self._query(f"EXPLAIN (FORMAT JSON) {matches}", args)
+            total_results = plan[0][0][0]["Plan"]["Plan Rows"]
+
         total_pages = 1 + total_results // per_page
 
         return {
@@ -423,4 +1195,5 @@ class Database:
             "per_page": per_page,
             "total_results": total_results,
             "total_pages": total_pages,
+            "estimated": estimate,
         }
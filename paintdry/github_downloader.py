@@ -1,18 +1,20 @@
 import os
 import json
 import sys
-import requests
 import requests_cache
 import subprocess
 from datetime import timedelta, datetime
 from time import sleep
 
+from modules.ratelimit import rate_limited_get
+
 token = None
 
 
 def github_get(url):
     print("GET: " + url)
-    r = requests.get(
+    # Waits when X-RateLimit-Remaining runs out, and backs off on 429 / 5xx:
+    r = rate_limited_get(
         url,
         headers={
             "Authorization": f"token {token}",
@@ -21,12 +23,9 @@ def github_get(url):
     )
     if getattr(r, "from_cache", False):
         print("CACHE HIT: " + url)
-    else:
-        sleep(0.2)
-        if r.status_code != 200:
-            print(str(r.text))
-            print(str(r.status_code))
-            sleep(0.8)
+    elif r.status_code != 200:
+        print(str(r.text))
+        print(str(r.status_code))
     assert r.status_code == 200
     result = r.json()
     # print(result)
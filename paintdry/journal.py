@@ -0,0 +1,92 @@
+import os
+import json
+import datetime
+
+from paintdry.lib import Discovery
+
+
+class Journal:
+    """Append-only log of the progress of an update, in its snapshot folder.
+
+    Records the batches of requests sent to modules, and the ones whose
+    responses were ingested, so an update which was interrupted (crash,
+    restart) can pick up where it stopped, instead of redoing every
+    request."""
+
+    def __init__(self, folder: str):
+        self.path = os.path.join(folder, "journal.jsonl")
+        # Request keys (see request_key()) of ingested batches:
+        self.completed = set()
+        self.dispatched = set()
+        # (module, resource) pairs which changed, for the schedule:
+        self.changed = set()
+        # Database time the update started, for expire_resources():
+        self.started = None
+        # Resources suggested to other modules, not in the resources table:
+        self.suggestions = []
+        self.resumed = os.path.exists(self.path)
+        if self.resumed:
+            self._load()
+        self._file = open(self.path, "a")
+
+    def _load(self):
+        good = 0
+        with open(self.path, "rb") as f:
+            for line in f:
+                if not line.endswith(b"\n"):
+                    break  # Last line torn by the crash
+                try:
+                    entry = json.loads(line)
+                except json.JSONDecodeError:
+                    break
+                good += len(line)
+                keys = {tuple(key) for key in entry.get("requests", [])}
+                match entry["event"]:
+                    case "started":
+                        self.started = datetime.datetime.fromisoformat(entry["time"])
+                    case "dispatched":
+                        self.dispatched.update(keys)
+                    case "completed":
+                        self.completed.update(keys)
+                        self.changed.update(tuple(pair) for pair in entry.get("changed", []))
+                    case "suggested":
+                        self.suggestions.append(
+                            Discovery(entry["resource"], entry["module"], entry["source"])
+                        )
+        # Cut off the torn line, so new entries start on a line of their own:
+        os.truncate(self.path, good)
+
+    def _append(self, entry: dict):
+        self._file.write(json.dumps(entry) + "\n")
+        self._file.flush()
+        os.fsync(self._file.fileno())
+
+    def in_flight(self) -> int:
+        """Requests which were sent, but whose responses weren't ingested."""
+        return len(self.dispatched - self.completed)
+
+    def start(self, started: datetime.datetime):
+        self.started = started
+        self._append({"event": "started", "time": started.isoformat()})
+
+    def dispatch(self, module: str, keys: list[tuple]):
+        self._append({"event": "dispatched", "module": module, "requests": keys})
+
+    def complete(self, module: str, keys: list[tuple], changed=()):
+        entry = {"event": "completed", "module": module, "requests": keys}
+        if changed:
+            entry["changed"] = sorted(changed)
+        self._append(entry)
+
+    def suggest(self, discovery: Discovery):
+        self._append(
+            {
+                "event": "suggested",
+                "resource": discovery.resource,
+                "module": discovery.module,
+                "source": discovery.source,
+            }
+        )
+
+    def close(self):
+        self._file.close()
@@ -22,6 +22,7 @@ class ModuleRequest(dict):
         attribute: str | None = None,
         old_value: str | None = None,
         new_value: str | None = None,
+        id: str | None = None,
     ):
         dict.__init__(
             self,
@@ -30,6 +31,8 @@ class ModuleRequest(dict):
             module=module,
             timestamp=timestamp,
         )
+        if id is not None:
+            self["id"] = id
         if source is not None:
             self["source"] = source
         if attribute is not None:
@@ -55,6 +58,7 @@ class ModuleRequest(dict):
             assert type(self["source"]) is str
             return
         if self["operation"] == "observation":
+            assert "id" not in self
             assert "source" not in self
             assert "attribute" not in self
             assert "old_value" not in self
@@ -346,15 +350,22 @@ class Change:
         self.timestamp = int(timestamp)
 
     def to_request(self) -> ModuleRequest:
+        # Modules get the values as text, lists and objects as JSON:
+        def text(value):
+            return value if type(value) is str else json.dumps(value)
+
         data = {
             "operation": "change",
             "resource": self.resource,
             "module": self.module,
             "attribute": self.attribute,
-            "old_value": self.old_value,
-            "new_value": self.new_value,
+            "old_value": text(self.old_value),
+            "new_value": text(self.new_value),
             "timestamp": self.timestamp,
         }
+        # The id comes back with the severity, to update the right row:
+        if self.id is not None:
+            data["id"] = str(self.id)
         return ModuleRequest(**data)
 
 
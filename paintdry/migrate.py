@@ -0,0 +1,200 @@
+"""Versioned schema migrations.
+
+Migrations are the SQL files in paintdry/migrations, named NNNN_name.sql,
+applied in order of their number. The numbers of the applied ones are
+recorded in the schema_version table, so each migration runs only once.
+
+Each migration runs in a transaction, unless its first line is the
+NO_TRANSACTION marker. Then the statements run one at a time outside of a
+transaction, which CREATE INDEX CONCURRENTLY needs. Such migrations
+should only use idempotent statements (IF NOT EXISTS), since they are
+run again from the start if one of them fails.
+
+Partitioned tables don't support CREATE INDEX CONCURRENTLY, in a
+no-transaction migration it's run as create_partitioned_index() instead.
+"""
+
+import os
+import re
+import time
+
+import psycopg2
+
+from paintdry.database import connection_string
+
+MIGRATIONS_FOLDER = os.path.join(os.path.dirname(os.path.abspath(__file__)), "migrations")
+NO_TRANSACTION = "-- paintdry: no-transaction"
+# Only one process migrates at a time, others wait for it to finish:
+ADVISORY_LOCK = 7_000_001
+# Fail rather than queue up every API query behind a migration waiting on
+# a busy table, run it again later:
+LOCK_TIMEOUT = "10s"
+
+
+def find_migrations(folder: str = MIGRATIONS_FOLDER) -> list[tuple[int, str, str]]:
+    """(version, name, path) of each migration, in order."""
+    migrations = []
+    for filename in sorted(os.listdir(folder)):
+        match = re.fullmatch(r"(\d{4})_(\w+)\.sql", filename)
+        if not match:
+            continue
+        path = os.path.join(folder, filename)
+        migrations.append((int(match.group(1)), filename[0:-4], path))
+    versions = [version for version, _, _ in migrations]
+    assert len(versions) == len(set(versions)), f"Duplicate migration numbers in {folder}"
+    return migrations
+
+
+def split_statements(sql: str) -> list[str]:
+    """Split SQL on semicolons, except inside quotes, dollar quoted
+    function bodies and comments."""
+    statements = []
+    start = 0
+    i = 0
+    while i < len(sql):
+        if sql.startswith("--", i):
+            end = sql.find("\n", i)
+            i = len(sql) if end == -1 else end + 1
+        elif sql[i] == "'":
+            end = sql.find("'", i + 1)
+            # '' is an escaped quote, and is skipped over as two strings
+            i = len(sql) if end == -1 else end + 1
+        elif match := re.match(r"\$\w*\$", sql[i:]):
+            tag = match.group(0)
+            end = sql.find(tag, i + len(tag))
+            i = len(sql) if end == -1 else end + len(tag)
+        elif sql[i] == ";":
+            statements.append(sql[start:i].strip())
+            i += 1
+            start = i
+        else:
+            i += 1
+    statements.append(sql[start:].strip())
+    return [s for s in statements if s and not _only_comments(s)]
+
+
+def _only_comments(statement: str) -> bool:
+    return all(
+        not line.strip() or line.strip().startswith("--")
+        for line in statement.splitlines()
+    )
+
+
+def _is_partitioned(cur, table: str) -> bool:
+    cur.execute("SELECT relkind = 'p' FROM pg_class WHERE oid = to_regclass(%s);", (table,))
+    row = cur.fetchone()
+    return bool(row and row[0])
+
+
+def create_partitioned_index(cur, parent: str, name: str, definition: str):
+    """Index a partitioned table without blocking writes to it.
+
+    The index is created on the parent only (new partitions get it when
+    they're created), then each existing partition is indexed concurrently
+    and attached to it. The index of the parent is valid once all of them
+    are attached. The partition indexes are named after the partition, like
+    changes_2025_01_search_index for changes_search_index.
+    """
+    cur.execute(f"CREATE INDEX IF NOT EXISTS {name} ON ONLY {parent} {definition};")
+    cur.execute(
+        """
+        SELECT relname FROM pg_inherits JOIN pg_class ON pg_class.oid = pg_inherits.inhrelid
+        WHERE inhparent = %(parent)s::REGCLASS
+        -- Already indexed, by an earlier run or when the partition was created:
+        AND NOT EXISTS (
+            SELECT 1 FROM pg_inherits AS attached
+            JOIN pg_index ON pg_index.indexrelid = attached.inhrelid
+            WHERE attached.inhparent = %(name)s::REGCLASS
+            AND pg_index.indrelid = pg_class.oid
+        )
+        ORDER BY relname;
+        """,
+        {"parent": parent, "name": name},
+    )
+    for (partition,) in cur.fetchall():
+        index_name = partition + name[len(parent):]
+        cur.execute(f"CREATE INDEX CONCURRENTLY IF NOT EXISTS {index_name} ON {partition} {definition};")
+        cur.execute(f"ALTER INDEX {name} ATTACH PARTITION {index_name};")
+
+
+def _execute(cur, statement: str):
+    # The comments before a statement are part of it:
+    match = re.fullmatch(
+        r"(?:--[^\n]*\n\s*)*CREATE INDEX CONCURRENTLY IF NOT EXISTS (\w+) ON (\w+) (.*)",
+        statement,
+        flags=re.DOTALL,
+    )
+    if match and _is_partitioned(cur, match.group(2)):
+        name, parent, definition = match.groups()
+        create_partitioned_index(cur, parent, name, definition)
+        return
+    cur.execute(statement)
+
+
+def _apply(cur, version: int, name: str, path: str):
+    with open(path, "r") as f:
+        sql = f.read()
+    if sql.startswith(NO_TRANSACTION):
+        for statement in split_statements(sql):
+            _execute(cur, statement)
+        cur.execute(
+            "INSERT INTO schema_version (version, name) VALUES (%s, %s);",
+            (version, name),
+        )
+        return
+    cur.execute("BEGIN;")
+    try:
+        cur.execute(sql)
+        cur.execute(
+            "INSERT INTO schema_version (version, name) VALUES (%s, %s);",
+            (version, name),
+        )
+        cur.execute("COMMIT;")
+    except psycopg2.Error:
+        cur.execute("ROLLBACK;")
+        raise
+
+
+def _wait_for_lock(cur):
+    # Polling, rather than blocking in pg_advisory_lock(), since CREATE INDEX
+    # CONCURRENTLY in the process holding the lock waits for the statements
+    # of every other session to finish, including a blocked lock request.
+    while True:
+        cur.execute("SELECT pg_try_advisory_lock(%s);", (ADVISORY_LOCK,))
+        if cur.fetchone()[0]:
+            return
+        print("Waiting for another process to finish migrating...")
+        time.sleep(1)
+
+
+def migrate(folder: str = MIGRATIONS_FOLDER) -> list[str]:
+    """Apply the pending migrations, returns the names of the ones applied."""
+    conn = psycopg2.connect(connection_string())
+    # Transactions are handled by _apply(), per migration:
+    conn.autocommit = True
+    applied = []
+    try:
+        with conn.cursor() as cur:
+            _wait_for_lock(cur)
+            cur.execute(f"SET lock_timeout = '{LOCK_TIMEOUT}';")
+            cur.execute(
+                """
+                CREATE TABLE IF NOT EXISTS schema_version (
+                    version INTEGER PRIMARY KEY,
+                    name TEXT NOT NULL,
+                    applied TIMESTAMP WITHOUT TIME ZONE DEFAULT NOW()
+                );
+                """
+            )
+            cur.execute("SELECT version FROM schema_version;")
+            done = set(row[0] for row in cur.fetchall())
+            for version, name, path in find_migrations(folder):
+                if version in done:
+                    continue
+                print(f"Applying migration {name}")
+                _apply(cur, version, name, path)
+                applied.append(name)
+            cur.execute("SELECT pg_advisory_unlock(%s);", (ADVISORY_LOCK,))
+    finally:
+        conn.close()
+    return applied
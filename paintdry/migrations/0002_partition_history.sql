@@ -0,0 +1,164 @@
+-- history and changes grow forever, they are partitioned by month so
+-- old months can be dropped (see 0015_detach_old_partitions), and queries on
+-- recent rows only touch recent partitions. Their indexes are built by
+-- 0013_history_indexes.
+--
+-- This is downtime, on purpose: the rows of a database created by the old
+-- schema.sql are copied into the partitioned tables in this migration's
+-- transaction, which holds an exclusive lock on history and changes (and
+-- blocks writes to observations, whose triggers insert into them) until
+-- it commits. Copying in batches instead would leave the API serving
+-- half the history, and the feed handing out the old rows after the new
+-- ones. Stop the API before migrating a big database, the copy takes
+-- about as long as writing both tables once. For a new database there's
+-- nothing to copy.
+
+CREATE OR REPLACE FUNCTION create_month_partition(parent TEXT, month DATE) RETURNS VOID AS $$
+DECLARE
+    start_date DATE := date_trunc('month', month);
+    end_date DATE := date_trunc('month', month) + INTERVAL '1 month';
+    partition TEXT := parent || '_' || to_char(month, 'YYYY_MM');
+BEGIN
+    IF to_regclass(partition) IS NOT NULL THEN
+        RETURN;
+    END IF;
+    -- Rows for this month may have ended up in the default partition, move
+    -- them over before attaching, or the attach fails:
+    EXECUTE format('CREATE TABLE %I (LIKE %I INCLUDING DEFAULTS)', partition, parent);
+    EXECUTE format(
+        'WITH moved AS (DELETE FROM %I WHERE timestamp >= %L AND timestamp < %L RETURNING *) '
+        'INSERT INTO %I SELECT * FROM moved',
+        parent || '_default', start_date, end_date, partition);
+    EXECUTE format(
+        'ALTER TABLE %I ATTACH PARTITION %I FOR VALUES FROM (%L) TO (%L)',
+        parent, partition, start_date, end_date);
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE OR REPLACE FUNCTION drop_old_partitions(parent TEXT, keep_months INT) RETURNS VOID AS $$
+DECLARE
+    cutoff DATE := date_trunc('month', NOW()) - make_interval(months => keep_months);
+    partition TEXT;
+BEGIN
+    FOR partition IN
+        SELECT c.relname FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid
+        WHERE i.inhparent = parent::regclass AND c.relname ~ '_[0-9]{4}_[0-9]{2}$'
+    LOOP
+        IF to_date(right(partition, 7), 'YYYY_MM') < cutoff THEN
+            EXECUTE format('DROP TABLE %I', partition);
+        END IF;
+    END LOOP;
+    EXECUTE format('DELETE FROM %I WHERE timestamp < %L', parent || '_default', cutoff);
+END;
+$$ LANGUAGE plpgsql;
+
+-- Converting the tables created by 0001_initial, in two steps. First the
+-- old table, and its indexes, are renamed out of the way:
+CREATE OR REPLACE FUNCTION begin_partitioning(parent TEXT) RETURNS VOID AS $$
+DECLARE
+    old TEXT := parent || '_unpartitioned';
+    index_name TEXT;
+BEGIN
+    RAISE NOTICE 'Converting % to a partitioned table', parent;
+    EXECUTE format('ALTER TABLE %I RENAME TO %I', parent, old);
+    FOR index_name IN SELECT indexname FROM pg_indexes WHERE tablename = old LOOP
+        EXECUTE format('ALTER INDEX %I RENAME TO %I', index_name, index_name || '_unpartitioned');
+    END LOOP;
+END;
+$$ LANGUAGE plpgsql;
+
+-- Then, once the partitioned table exists, the rows are copied over:
+CREATE OR REPLACE FUNCTION finish_partitioning(parent TEXT) RETURNS VOID AS $$
+DECLARE
+    old TEXT := parent || '_unpartitioned';
+    month DATE;
+    columns TEXT;
+BEGIN
+    FOR month IN EXECUTE format('SELECT DISTINCT date_trunc(''month'', timestamp)::DATE FROM %I', old) LOOP
+        PERFORM create_month_partition(parent, month);
+    END LOOP;
+    -- Every column but seq, which numbers the old rows in timestamp order:
+    SELECT string_agg(quote_ident(column_name), ', ' ORDER BY ordinal_position) INTO columns
+    FROM information_schema.columns
+    WHERE table_name = old AND table_schema = current_schema();
+    EXECUTE format(
+        'INSERT INTO %I (%s) SELECT %s FROM %I ORDER BY timestamp',
+        parent, columns, columns, old);
+    EXECUTE format('DROP TABLE %I', old);
+END;
+$$ LANGUAGE plpgsql;
+
+DROP VIEW history_pretty;
+SELECT begin_partitioning('history');
+
+-- The partition key has to be part of the primary key and unique constraints
+CREATE TABLE history (
+    id UUID NOT NULL DEFAULT uuid_generate_v4(),
+    resource TEXT NOT NULL,
+    module TEXT NOT NULL,
+    attribute TEXT NOT NULL,
+    value TEXT NOT NULL,
+    timestamp TIMESTAMP WITHOUT TIME ZONE NOT NULL DEFAULT NOW(),
+    -- Insertion order, timestamps come from the modules so they can arrive late:
+    seq BIGSERIAL,
+    PRIMARY KEY (id, timestamp),
+    CONSTRAINT history_constraint UNIQUE (module, attribute, resource, timestamp)
+) PARTITION BY RANGE (timestamp);
+
+CREATE TABLE history_default PARTITION OF history DEFAULT;
+SELECT finish_partitioning('history');
+SELECT create_month_partition('history', (NOW() + make_interval(months => i))::DATE)
+FROM generate_series(0, 2) AS i;
+
+CREATE VIEW history_pretty AS
+SELECT module, resource, attribute, json_to_string(value) AS value, timestamp
+FROM history;
+
+DROP VIEW changes_pretty;
+DROP VIEW changes_severity;
+SELECT begin_partitioning('changes');
+
+CREATE TABLE changes (
+    id UUID NOT NULL DEFAULT uuid_generate_v4(),
+    resource TEXT NOT NULL,
+    module TEXT NOT NULL,
+    attribute TEXT NOT NULL,
+    old_value TEXT NOT NULL,
+    new_value TEXT NOT NULL,
+    timestamp TIMESTAMP WITHOUT TIME ZONE NOT NULL DEFAULT NOW(),
+    severity TEXT NOT NULL DEFAULT '',
+    seq BIGSERIAL,
+    PRIMARY KEY (id, timestamp),
+    CONSTRAINT changes_constraint UNIQUE (module, attribute, resource, timestamp, old_value, new_value)
+) PARTITION BY RANGE (timestamp);
+
+CREATE TABLE changes_default PARTITION OF changes DEFAULT;
+SELECT finish_partitioning('changes');
+SELECT create_month_partition('changes', (NOW() + make_interval(months => i))::DATE)
+FROM generate_series(0, 2) AS i;
+
+CREATE VIEW changes_pretty AS
+SELECT module, resource, attribute, json_to_string(old_value) AS old_value, json_to_string(new_value) AS new_value, severity, timestamp
+FROM changes;
+
+CREATE VIEW changes_severity AS
+SELECT * FROM
+(
+  SELECT DISTINCT ON (module, resource, attribute)
+    id, module, resource, attribute, old_value, new_value, timestamp, severity
+  FROM changes
+  ORDER BY module, resource, attribute, timestamp DESC
+)
+WHERE severity != 'none'
+ORDER BY
+CASE severity
+    WHEN 'critical' THEN 5
+    WHEN 'high' THEN 4
+    WHEN 'medium' THEN 3
+    WHEN 'low' THEN 2
+    WHEN 'recommendation' THEN 1
+    WHEN 'notice' THEN 0
+ELSE 10 END DESC, timestamp DESC;
+
+DROP FUNCTION begin_partitioning(TEXT);
+DROP FUNCTION finish_partitioning(TEXT);
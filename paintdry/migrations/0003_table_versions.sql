@@ -0,0 +1,112 @@
+-- A version number per table, bumped by every statement which modifies its rows,
+-- so the API can cheaply tell whether its cached responses are still fresh.
+CREATE TABLE IF NOT EXISTS table_versions (
+    name TEXT PRIMARY KEY,
+    version BIGINT NOT NULL DEFAULT 0,
+    updated TIMESTAMP WITH TIME ZONE NOT NULL DEFAULT NOW()
+);
+
+INSERT INTO table_versions (name)
+VALUES ('resources'), ('observations'), ('history'), ('changes')
+ON CONFLICT DO NOTHING;
+
+CREATE OR REPLACE FUNCTION bump_table_version_function()
+RETURNS TRIGGER AS $bump_table_version_function$
+BEGIN
+    -- Statements which didn't change any rows, like the upserts of
+    -- unchanged observations, leave the cached responses fresh. Nested,
+    -- since the transition table of the other events doesn't exist:
+    IF TG_OP IN ('INSERT', 'UPDATE') THEN
+        IF NOT EXISTS (SELECT 1 FROM new_rows) THEN
+            RETURN NULL;
+        END IF;
+    ELSIF TG_OP = 'DELETE' THEN
+        IF NOT EXISTS (SELECT 1 FROM old_rows) THEN
+            RETURN NULL;
+        END IF;
+    END IF;
+    UPDATE table_versions
+    SET version = version + 1, updated = NOW()
+    WHERE name = TG_TABLE_NAME;
+    RETURN NULL;
+END;
+$bump_table_version_function$ LANGUAGE plpgsql;
+
+-- Transition tables can't be used by a trigger for more than one event,
+-- so there's a trigger per event, and TRUNCATE has none.
+
+CREATE OR REPLACE TRIGGER resources_inserted_version_trigger
+    AFTER INSERT ON resources
+    REFERENCING NEW TABLE AS new_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION bump_table_version_function();
+
+CREATE OR REPLACE TRIGGER resources_updated_version_trigger
+    AFTER UPDATE ON resources
+    REFERENCING NEW TABLE AS new_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION bump_table_version_function();
+
+CREATE OR REPLACE TRIGGER resources_deleted_version_trigger
+    AFTER DELETE ON resources
+    REFERENCING OLD TABLE AS old_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION bump_table_version_function();
+
+CREATE OR REPLACE TRIGGER resources_truncated_version_trigger
+    AFTER TRUNCATE ON resources
+    FOR EACH STATEMENT EXECUTE FUNCTION bump_table_version_function();
+
+CREATE OR REPLACE TRIGGER observations_inserted_version_trigger
+    AFTER INSERT ON observations
+    REFERENCING NEW TABLE AS new_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION bump_table_version_function();
+
+CREATE OR REPLACE TRIGGER observations_updated_version_trigger
+    AFTER UPDATE ON observations
+    REFERENCING NEW TABLE AS new_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION bump_table_version_function();
+
+CREATE OR REPLACE TRIGGER observations_deleted_version_trigger
+    AFTER DELETE ON observations
+    REFERENCING OLD TABLE AS old_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION bump_table_version_function();
+
+CREATE OR REPLACE TRIGGER observations_truncated_version_trigger
+    AFTER TRUNCATE ON observations
+    FOR EACH STATEMENT EXECUTE FUNCTION bump_table_version_function();
+
+CREATE OR REPLACE TRIGGER history_inserted_version_trigger
+    AFTER INSERT ON history
+    REFERENCING NEW TABLE AS new_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION bump_table_version_function();
+
+CREATE OR REPLACE TRIGGER history_updated_version_trigger
+    AFTER UPDATE ON history
+    REFERENCING NEW TABLE AS new_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION bump_table_version_function();
+
+CREATE OR REPLACE TRIGGER history_deleted_version_trigger
+    AFTER DELETE ON history
+    REFERENCING OLD TABLE AS old_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION bump_table_version_function();
+
+CREATE OR REPLACE TRIGGER history_truncated_version_trigger
+    AFTER TRUNCATE ON history
+    FOR EACH STATEMENT EXECUTE FUNCTION bump_table_version_function();
+
+CREATE OR REPLACE TRIGGER changes_inserted_version_trigger
+    AFTER INSERT ON changes
+    REFERENCING NEW TABLE AS new_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION bump_table_version_function();
+
+CREATE OR REPLACE TRIGGER changes_updated_version_trigger
+    AFTER UPDATE ON changes
+    REFERENCING NEW TABLE AS new_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION bump_table_version_function();
+
+CREATE OR REPLACE TRIGGER changes_deleted_version_trigger
+    AFTER DELETE ON changes
+    REFERENCING OLD TABLE AS old_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION bump_table_version_function();
+
+CREATE OR REPLACE TRIGGER changes_truncated_version_trigger
+    AFTER TRUNCATE ON changes
+    FOR EACH STATEMENT EXECUTE FUNCTION bump_table_version_function();
@@ -0,0 +1,28 @@
+-- Wake up /api/history/stream and /api/changes/stream when rows are added,
+-- identical notifications are sent once per transaction.
+
+CREATE OR REPLACE FUNCTION observations_to_history_function()
+RETURNS TRIGGER AS $observations_to_history_function$
+BEGIN
+    IF (TG_OP = 'INSERT' OR TG_OP = 'UPDATE' AND NEW.value != OLD.value) THEN
+        INSERT INTO history(resource, module, attribute, value, timestamp)
+        VALUES (NEW.resource, NEW.module, NEW.attribute, NEW.value, NEW.last_changed)
+        ON CONFLICT DO NOTHING;
+        PERFORM pg_notify('paintdry_history', '');
+    END IF;
+    RETURN NULL;
+END;
+$observations_to_history_function$ LANGUAGE plpgsql;
+
+CREATE OR REPLACE FUNCTION observations_to_changes_function()
+RETURNS TRIGGER AS $observations_to_changes_function$
+BEGIN
+    IF (NEW.value != OLD.value) THEN
+        INSERT INTO changes(resource, module, attribute, old_value, new_value, timestamp)
+        VALUES (NEW.resource, NEW.module, NEW.attribute, OLD.value, NEW.value, NEW.last_changed)
+        ON CONFLICT DO NOTHING;
+        PERFORM pg_notify('paintdry_changes', '');
+    END IF;
+    RETURN NULL;
+END;
+$observations_to_changes_function$ LANGUAGE plpgsql;
@@ -0,0 +1,57 @@
+-- Record history and changes with one set-based INSERT per statement on
+-- observations, instead of one per row. Transition tables can't be used by
+-- a trigger for more than one event, so INSERT and UPDATE are separate.
+
+DROP TRIGGER IF EXISTS observations_to_history_trigger ON observations;
+DROP TRIGGER IF EXISTS observations_to_changes_trigger ON observations;
+DROP FUNCTION IF EXISTS observations_to_history_function();
+DROP FUNCTION IF EXISTS observations_to_changes_function();
+
+CREATE OR REPLACE FUNCTION observations_inserted_function()
+RETURNS TRIGGER AS $observations_inserted_function$
+BEGIN
+    INSERT INTO history(resource, module, attribute, value, timestamp)
+    SELECT resource, module, attribute, value, last_changed
+    FROM new_rows
+    ON CONFLICT DO NOTHING;
+    IF FOUND THEN
+        -- Wakes up /api/history/stream:
+        PERFORM pg_notify('paintdry_history', '');
+    END IF;
+    RETURN NULL;
+END;
+$observations_inserted_function$ LANGUAGE plpgsql;
+
+CREATE OR REPLACE FUNCTION observations_updated_function()
+RETURNS TRIGGER AS $observations_updated_function$
+BEGIN
+    INSERT INTO history(resource, module, attribute, value, timestamp)
+    SELECT n.resource, n.module, n.attribute, n.value, n.last_changed
+    FROM new_rows n JOIN old_rows o ON o.id = n.id
+    WHERE n.value != o.value
+    ON CONFLICT DO NOTHING;
+    IF FOUND THEN
+        PERFORM pg_notify('paintdry_history', '');
+    END IF;
+
+    INSERT INTO changes(resource, module, attribute, old_value, new_value, timestamp)
+    SELECT n.resource, n.module, n.attribute, o.value, n.value, n.last_changed
+    FROM new_rows n JOIN old_rows o ON o.id = n.id
+    WHERE n.value != o.value
+    ON CONFLICT DO NOTHING;
+    IF FOUND THEN
+        PERFORM pg_notify('paintdry_changes', '');
+    END IF;
+    RETURN NULL;
+END;
+$observations_updated_function$ LANGUAGE plpgsql;
+
+CREATE OR REPLACE TRIGGER observations_inserted_trigger
+    AFTER INSERT ON observations
+    REFERENCING NEW TABLE AS new_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION observations_inserted_function();
+
+CREATE OR REPLACE TRIGGER observations_updated_trigger
+    AFTER UPDATE ON observations
+    REFERENCING OLD TABLE AS old_rows NEW TABLE AS new_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION observations_updated_function();
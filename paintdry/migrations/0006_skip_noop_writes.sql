@@ -0,0 +1,41 @@
+-- Unchanged observations are only rewritten now and then, to bump
+-- last_seen (see last_seen_resolution). Leave room in each page so those
+-- new row versions can stay on the same page, as HOT updates which don't
+-- touch the indexes. Applies to newly written pages, existing ones are
+-- repacked by the next VACUUM FULL / pg_repack.
+ALTER TABLE observations SET (fillfactor = 80);
+
+-- PL/pgSQL caches the plan of the join between the transition tables the
+-- first time the trigger runs in a session, and the row counts of that
+-- first statement decide the plan. A nested loop chosen for a tiny first
+-- statement is quadratic for the big batches after it, EXECUTE plans the
+-- join for the actual number of rows every time.
+CREATE OR REPLACE FUNCTION observations_updated_function()
+RETURNS TRIGGER AS $observations_updated_function$
+DECLARE
+    inserted INTEGER;
+BEGIN
+    EXECUTE '
+        INSERT INTO history(resource, module, attribute, value, timestamp)
+        SELECT n.resource, n.module, n.attribute, n.value, n.last_changed
+        FROM new_rows n JOIN old_rows o ON o.id = n.id
+        WHERE n.value != o.value
+        ON CONFLICT DO NOTHING';
+    GET DIAGNOSTICS inserted = ROW_COUNT;
+    IF inserted > 0 THEN
+        PERFORM pg_notify('paintdry_history', '');
+    END IF;
+
+    EXECUTE '
+        INSERT INTO changes(resource, module, attribute, old_value, new_value, timestamp)
+        SELECT n.resource, n.module, n.attribute, o.value, n.value, n.last_changed
+        FROM new_rows n JOIN old_rows o ON o.id = n.id
+        WHERE n.value != o.value
+        ON CONFLICT DO NOTHING';
+    GET DIAGNOSTICS inserted = ROW_COUNT;
+    IF inserted > 0 THEN
+        PERFORM pg_notify('paintdry_changes', '');
+    END IF;
+    RETURN NULL;
+END;
+$observations_updated_function$ LANGUAGE plpgsql;
@@ -0,0 +1,121 @@
+-- Store observation values as JSONB instead of JSON in TEXT columns.
+-- Rewrites observations, history and changes, so it holds an exclusive
+-- lock on them for as long as that takes, once.
+
+DROP VIEW IF EXISTS observations_pretty;
+DROP VIEW IF EXISTS observations_severity;
+DROP VIEW IF EXISTS history_pretty;
+DROP VIEW IF EXISTS changes_pretty;
+DROP VIEW IF EXISTS changes_severity;
+
+-- The same rules as the old _from_json() in database.py, JSON lists and
+-- objects are parsed, anything else is a string:
+CREATE OR REPLACE FUNCTION text_to_jsonb(value TEXT) RETURNS JSONB AS $$
+BEGIN
+    IF left(value, 1) IN ('[', '{') THEN
+        RETURN value::JSONB;
+    END IF;
+    RETURN to_jsonb(value);
+EXCEPTION
+    WHEN invalid_text_representation THEN
+        RETURN to_jsonb(value);
+END;
+$$ LANGUAGE plpgsql IMMUTABLE;
+
+ALTER TABLE observations ALTER COLUMN value TYPE JSONB USING text_to_jsonb(value);
+ALTER TABLE history ALTER COLUMN value TYPE JSONB USING text_to_jsonb(value);
+ALTER TABLE changes
+    ALTER COLUMN old_value TYPE JSONB USING text_to_jsonb(old_value),
+    ALTER COLUMN new_value TYPE JSONB USING text_to_jsonb(new_value);
+
+DROP FUNCTION text_to_jsonb(TEXT);
+
+-- For cheap comparisons of values, which can be big:
+ALTER TABLE observations
+    ADD COLUMN value_hash UUID GENERATED ALWAYS AS (md5(value::TEXT)::UUID) STORED;
+
+DROP FUNCTION IF EXISTS json_to_string(TEXT);
+CREATE OR REPLACE FUNCTION json_to_string(value JSONB) RETURNS TEXT AS $$
+SELECT CASE
+    WHEN value = '[]' THEN '(Empty list)'
+    WHEN value = '""' THEN '(Empty string)'
+    WHEN value = '{}' THEN '(Empty object)'
+    WHEN jsonb_typeof(value) = 'array' THEN
+        (SELECT string_agg(element, ', ') FROM jsonb_array_elements_text(value) AS element)
+    ELSE value #>> '{}'
+END;
+$$ LANGUAGE SQL IMMUTABLE;
+
+CREATE VIEW observations_pretty AS
+SELECT module, resource, attribute, json_to_string(value) AS value, severity, first_seen, last_changed, last_seen
+FROM observations;
+
+CREATE VIEW observations_severity AS
+SELECT * FROM observations
+WHERE severity != '' AND severity != 'none'
+ORDER BY
+    CASE severity WHEN 'none' THEN 0
+                  WHEN 'recommendation' THEN 1
+                  WHEN 'low' THEN 2
+                  WHEN 'medium' THEN 3
+                  WHEN 'high' THEN 4
+                  WHEN 'critical' THEN 5
+    ELSE 10 END DESC;
+
+CREATE VIEW history_pretty AS
+SELECT module, resource, attribute, json_to_string(value) AS value, timestamp
+FROM history;
+
+CREATE VIEW changes_pretty AS
+SELECT module, resource, attribute, json_to_string(old_value) AS old_value, json_to_string(new_value) AS new_value, severity, timestamp
+FROM changes;
+
+CREATE VIEW changes_severity AS
+SELECT * FROM
+(
+  SELECT DISTINCT ON (module, resource, attribute)
+    id, module, resource, attribute, old_value, new_value, timestamp, severity
+  FROM changes
+  ORDER BY module, resource, attribute, timestamp DESC
+)
+WHERE severity != 'none'
+ORDER BY
+CASE severity
+    WHEN 'critical' THEN 5
+    WHEN 'high' THEN 4
+    WHEN 'medium' THEN 3
+    WHEN 'low' THEN 2
+    WHEN 'recommendation' THEN 1
+    WHEN 'notice' THEN 0
+ELSE 10 END DESC, timestamp DESC;
+
+-- Compare the hashes rather than the values:
+CREATE OR REPLACE FUNCTION observations_updated_function()
+RETURNS TRIGGER AS $observations_updated_function$
+DECLARE
+    inserted INTEGER;
+BEGIN
+    EXECUTE '
+        INSERT INTO history(resource, module, attribute, value, timestamp)
+        SELECT n.resource, n.module, n.attribute, n.value, n.last_changed
+        FROM new_rows n JOIN old_rows o ON o.id = n.id
+        WHERE n.value_hash != o.value_hash
+        ON CONFLICT DO NOTHING';
+    GET DIAGNOSTICS inserted = ROW_COUNT;
+    IF inserted > 0 THEN
+        PERFORM pg_notify('paintdry_history', '');
+    END IF;
+
+    EXECUTE '
+        INSERT INTO changes(resource, module, attribute, old_value, new_value, timestamp)
+        SELECT n.resource, n.module, n.attribute, o.value, n.value, n.last_changed
+        FROM new_rows n JOIN old_rows o ON o.id = n.id
+        WHERE n.value_hash != o.value_hash
+        ON CONFLICT DO NOTHING';
+    GET DIAGNOSTICS inserted = ROW_COUNT;
+    IF inserted > 0 THEN
+        PERFORM pg_notify('paintdry_changes', '');
+    END IF;
+    RETURN NULL;
+END;
+$observations_updated_function$ LANGUAGE plpgsql;
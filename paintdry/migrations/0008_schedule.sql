@@ -0,0 +1,14 @@
+-- When each resource is due to be observed by its module again, so an
+-- update only sends requests for the resources which are due, instead of
+-- observing the whole inventory every time. Resources which are not in
+-- this table yet are due.
+CREATE TABLE IF NOT EXISTS schedule (
+    module TEXT NOT NULL,
+    resource TEXT NOT NULL,
+    -- Seconds, grows while the observations don't change:
+    interval_seconds INTEGER NOT NULL,
+    next_due TIMESTAMP WITHOUT TIME ZONE NOT NULL,
+    PRIMARY KEY (module, resource)
+);
+
+CREATE INDEX IF NOT EXISTS schedule_next_due_index ON schedule (next_due);
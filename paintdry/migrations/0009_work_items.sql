@@ -0,0 +1,24 @@
+-- Requests for the modules, queued by the updater (with work_queue in
+-- config.json) and run by any number of updater / worker processes.
+-- A worker claims items by setting leased_by and lease_expires, items
+-- whose lease expired without being completed are claimed again.
+-- Completed items are kept until the next update purges them, so the
+-- same request isn't queued twice in one update.
+CREATE TABLE IF NOT EXISTS work_items (
+    id BIGSERIAL PRIMARY KEY,
+    module TEXT NOT NULL,
+    -- Identifies the request (see request_key() in update.py):
+    key TEXT NOT NULL,
+    request JSONB NOT NULL,
+    -- Rounds of discovery which led to this request, see max_discovery_depth:
+    depth INTEGER NOT NULL DEFAULT 0,
+    leased_by TEXT,
+    lease_expires TIMESTAMP WITHOUT TIME ZONE,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    created TIMESTAMP WITHOUT TIME ZONE NOT NULL DEFAULT NOW(),
+    completed TIMESTAMP WITHOUT TIME ZONE,
+    CONSTRAINT work_items_constraint UNIQUE (module, key)
+);
+
+CREATE INDEX IF NOT EXISTS work_items_pending_index ON work_items (id)
+WHERE completed IS NULL;
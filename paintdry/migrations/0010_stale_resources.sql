@@ -0,0 +1,25 @@
+-- Resources which are no longer discovered (deleted repos, removed
+-- targets, ...) are marked stale after a number of updates, and are no
+-- longer observed. missed_updates counts the updates in a row in which
+-- the resource was observed, but not discovered again by its source.
+ALTER TABLE resources
+    ADD COLUMN IF NOT EXISTS missed_updates INTEGER NOT NULL DEFAULT 0,
+    ADD COLUMN IF NOT EXISTS stale TIMESTAMP WITHOUT TIME ZONE;
+
+-- Observations of stale resources, moved out of observations so they
+-- don't show up as current:
+CREATE TABLE IF NOT EXISTS observations_archive (
+    id UUID PRIMARY KEY,
+    resource TEXT NOT NULL,
+    module TEXT NOT NULL,
+    attribute TEXT NOT NULL,
+    value JSONB NOT NULL,
+    first_seen TIMESTAMP WITHOUT TIME ZONE,
+    last_changed TIMESTAMP WITHOUT TIME ZONE,
+    last_seen TIMESTAMP WITHOUT TIME ZONE,
+    severity TEXT NOT NULL DEFAULT '',
+    archived TIMESTAMP WITHOUT TIME ZONE NOT NULL DEFAULT NOW()
+);
+
+CREATE INDEX IF NOT EXISTS observations_archive_resource_index
+ON observations_archive (module, resource);
@@ -0,0 +1,11 @@
+-- seq is assigned when a row is inserted, not when it is committed, so a
+-- row can become visible after rows with a higher seq were already
+-- returned by rows_since(), and be skipped. Each row records the
+-- transaction which inserted it, and the feed holds back the rows of
+-- transactions which may still be running (see pg_snapshot_xmin()).
+-- Rows from before this migration have no xid, and come first.
+ALTER TABLE history ADD COLUMN IF NOT EXISTS xid xid8;
+ALTER TABLE history ALTER COLUMN xid SET DEFAULT pg_current_xact_id();
+ALTER TABLE changes ADD COLUMN IF NOT EXISTS xid xid8;
+ALTER TABLE changes ALTER COLUMN xid SET DEFAULT pg_current_xact_id();
+-- The indexes for rows_since() are built by 0014_feed_indexes.
@@ -0,0 +1,19 @@
+-- paintdry: no-transaction
+-- Trigram indexes, for substring search (LIKE '%x%'). Built outside of a
+-- transaction, so the API can keep reading and the updater keep writing
+-- while they're built. value #>> '{}' is the text of the JSONB values,
+-- strings without quotes, lists and objects as JSON. If this fails, drop
+-- the INVALID index it left behind before running it again.
+
+CREATE EXTENSION IF NOT EXISTS pg_trgm;
+
+CREATE INDEX CONCURRENTLY IF NOT EXISTS resources_search_index ON resources
+USING GIN (resource gin_trgm_ops, module gin_trgm_ops, source gin_trgm_ops);
+
+CREATE INDEX CONCURRENTLY IF NOT EXISTS observations_search_index ON observations
+USING GIN (resource gin_trgm_ops, module gin_trgm_ops, attribute gin_trgm_ops, (value #>> '{}') gin_trgm_ops, severity gin_trgm_ops);
+
+-- changes is partitioned, this is run as create_partitioned_index() by
+-- paintdry/migrate.py, one partition at a time:
+CREATE INDEX CONCURRENTLY IF NOT EXISTS changes_search_index ON changes
+USING GIN (resource gin_trgm_ops, module gin_trgm_ops, attribute gin_trgm_ops, (old_value #>> '{}') gin_trgm_ops, (new_value #>> '{}') gin_trgm_ops, severity gin_trgm_ops);
@@ -0,0 +1,15 @@
+-- paintdry: no-transaction
+-- Indexes on the partitions created by 0002_partition_history, built
+-- without blocking writes, one partition at a time, see
+-- create_partitioned_index() in paintdry/migrate.py.
+
+CREATE INDEX CONCURRENTLY IF NOT EXISTS history_seq_index ON history (seq);
+CREATE INDEX CONCURRENTLY IF NOT EXISTS changes_seq_index ON changes (seq);
+-- Default sort order of /api/history and /api/changes (keyset pagination):
+CREATE INDEX CONCURRENTLY IF NOT EXISTS history_timestamp_index ON history (timestamp, id);
+CREATE INDEX CONCURRENTLY IF NOT EXISTS changes_timestamp_index ON changes (timestamp, id);
+-- Latest change per attribute, for changes_severity (DISTINCT ON):
+CREATE INDEX CONCURRENTLY IF NOT EXISTS changes_latest_index ON changes (module, resource, attribute, timestamp DESC);
+-- Changes waiting to be classified by get_new_changes(), a small part of the table:
+CREATE INDEX CONCURRENTLY IF NOT EXISTS changes_unclassified_index ON changes (timestamp)
+WHERE severity IN ('', 'unknown');
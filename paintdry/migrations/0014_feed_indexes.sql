@@ -0,0 +1,7 @@
+-- paintdry: no-transaction
+-- Order of rows_since(), see 0011_feed_xid. Built without blocking writes,
+-- one partition at a time, see create_partitioned_index() in
+-- paintdry/migrate.py.
+
+CREATE INDEX CONCURRENTLY IF NOT EXISTS history_feed_index ON history (xid NULLS FIRST, seq);
+CREATE INDEX CONCURRENTLY IF NOT EXISTS changes_feed_index ON changes (xid NULLS FIRST, seq);
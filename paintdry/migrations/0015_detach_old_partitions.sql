@@ -0,0 +1,22 @@
+-- DROP TABLE on an attached partition takes an ACCESS EXCLUSIVE lock on
+-- the parent, which stalls the API and the feed until it's done. The old
+-- partitions are detached concurrently first, by maintain_partitions() in
+-- paintdry/database.py, since DETACH PARTITION ... CONCURRENTLY can't run
+-- in a transaction (or a function). This only finds them: the months
+-- older than keep_months, whether they're still attached, and whether an
+-- earlier detach was interrupted (and has to be finalized). Detached ones
+-- are left behind when the drop after the detach failed.
+DROP FUNCTION IF EXISTS drop_old_partitions(TEXT, INT);
+
+CREATE OR REPLACE FUNCTION old_partitions(parent TEXT, keep_months INT)
+RETURNS TABLE (partition TEXT, attached BOOLEAN, detach_pending BOOLEAN) AS $$
+    SELECT c.relname::TEXT, i.inhrelid IS NOT NULL, COALESCE(i.inhdetachpending, FALSE)
+    FROM pg_class c
+    LEFT JOIN pg_inherits i ON i.inhrelid = c.oid AND i.inhparent = parent::REGCLASS
+    WHERE c.relkind = 'r'
+    AND c.relnamespace = current_schema()::REGNAMESPACE
+    AND c.relname ~ ('^' || parent || '_[0-9]{4}_[0-9]{2}$')
+    AND to_date(right(c.relname, 7), 'YYYY_MM')
+        < date_trunc('month', NOW()) - make_interval(months => keep_months)
+    ORDER BY c.relname;
+$$ LANGUAGE sql;
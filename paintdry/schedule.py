@@ -0,0 +1,80 @@
+from paintdry.lib import Observation
+
+# Observations with these severities keep their resource on the shortest
+# interval, same as a change:
+URGENT_SEVERITIES = ("high", "critical")
+
+# max_interval, when not configured, is this many times the interval:
+DEFAULT_BACKOFF_LIMIT = 8
+
+
+class Scheduler:
+    """Decides which resources are observed in an update, and when each
+    of them is due next.
+
+    Each module has an interval in config.json (minutes, default 0 which
+    means every update). The interval of a resource doubles every time it
+    is observed without any changes, up to max_interval, and goes back to
+    the module's interval after a change or a high severity observation.
+    Resources whose requests failed keep their interval."""
+
+    def __init__(self, modules: dict, schedule: dict[tuple[str, str], dict]):
+        self._modules = modules
+        self._schedule = schedule
+        self._dispatched = set()
+        self._changed = set()
+        self._failed = set()
+
+    def intervals(self, module: str) -> tuple[int, int]:
+        """Shortest and longest interval of a module, in seconds."""
+        config = self._modules.get(module, {})
+        interval = config.get("interval", 0)
+        maximum = config.get("max_interval", interval * DEFAULT_BACKOFF_LIMIT)
+        return (interval * 60, max(interval, maximum) * 60)
+
+    def is_due(self, module: str, resource: str) -> bool:
+        entry = self._schedule.get((module, resource))
+        return entry is None or entry["due"]
+
+    def dispatched(self, module: str, resource: str):
+        self._dispatched.add((module, resource))
+
+    def failed(self, module: str, resource: str):
+        """The observation of a resource didn't complete, it wasn't
+        observed unchanged either."""
+        self._failed.add((module, resource))
+
+    def observed(
+        self, observations: list[Observation], changed: set[tuple[str, str]]
+    ) -> set[tuple[str, str]]:
+        """Record the observations of a batch of responses, changed are the
+        (module, resource) pairs with new or changed values. Returns the
+        pairs which go back to the shortest interval."""
+        changed = set(changed)
+        for observation in observations:
+            if observation.severity in URGENT_SEVERITIES:
+                changed.add((observation.module, observation.resource))
+        self._changed.update(changed)
+        return changed
+
+    def next_intervals(self) -> list[tuple[str, str, int]]:
+        """(module, resource, seconds) until the resources observed since
+        the last call are due again."""
+        intervals = []
+        for key in sorted(self._dispatched | self._changed | self._failed):
+            module, resource = key
+            shortest, longest = self.intervals(module)
+            entry = self._schedule.get(key)
+            if entry is None or key in self._changed:
+                interval = shortest
+            elif key in self._failed:
+                interval = min(max(entry["interval"], shortest), longest)
+            else:
+                interval = min(max(entry["interval"] * 2, shortest), longest)
+            if interval == 0 and (entry is None or entry["interval"] == 0):
+                continue  # Observed every update, nothing to store
+            intervals.append((module, resource, interval))
+        self._dispatched = set()
+        self._changed = set()
+        self._failed = set()
+        return intervals
@@ -1,24 +1,347 @@
+import os
+import sys
 import json
+import time
+import datetime
+import threading
+from collections import OrderedDict
 
-from flask import Flask, abort, send_from_directory, request
+from flask import Flask, Response, abort, send_from_directory, request
 from flask.helpers import redirect
+from werkzeug.http import is_resource_modified
 
-from paintdry.database import Database
-from paintdry.lib import get_config_filename
+import psycopg2
 
-database = Database()
+from paintdry.database import Database, FILTER_COLUMNS, listen
+from paintdry.lib import get_config_filename
 
 app = Flask(__name__)
 
+DIST_FOLDER = os.path.join(os.path.dirname(os.path.abspath(__file__)), "dist")
+# Vite puts content hashed file names in dist/assets, so they never change:
+ASSET_MAX_AGE = 365 * 24 * 60 * 60
+
+_database = None
+_database_pid = None
+_database_lock = threading.Lock()
+
+
+def get_database() -> Database:
+    """The connection pool for this process, created on first use so that
+    each server worker process gets its own connections (they must not be
+    shared across fork)."""
+    global _database, _database_pid
+    with _database_lock:
+        if _database is None or _database_pid != os.getpid():
+            _database = Database()
+            _database_pid = os.getpid()
+        return _database
+
+
+def close_database():
+    global _database
+    with _database_lock:
+        if _database is not None and _database_pid == os.getpid():
+            _database.pool.closeall()
+        _database = None
+
+
+# Server-Sent Events streams end after this many seconds, browsers reconnect
+# by themselves (with Last-Event-ID), which frees up the server thread:
+STREAM_DURATION = 300
+STREAM_KEEPALIVE = 15
+# Each stream holds a server thread for up to STREAM_DURATION, only this
+# many run at a time per process, so the other threads are left for the
+# API (see start_server()). Streams over the limit end right away, and
+# the browser tries again after STREAM_BUSY_RETRY milliseconds:
+MAX_STREAMS = int(os.getenv("PAINTDRY_WEB_STREAMS", "2"))
+STREAM_BUSY_RETRY = 30_000
+_stream_slots = threading.BoundedSemaphore(MAX_STREAMS)
+
+# Query parameters which turn a list endpoint into a paginated one:
+LIST_PARAMETERS = ("limit", "cursor", "sort", "since", "until", *FILTER_COLUMNS)
+MAX_LIMIT = 1000
+
+
+def stream_json_list(rows, chunk_size=500):
+    """Response with a JSON list, serialized a chunk of rows at a time, so
+    the whole table is never in memory at once."""
+
+    def generate():
+        separator = "["
+        chunk = []
+        for row in rows:
+            chunk.append(separator + app.json.dumps(row))
+            separator = ","
+            if len(chunk) >= chunk_size:
+                yield "".join(chunk)
+                chunk = []
+        chunk.append("[]" if separator == "[" else "]")
+        yield "".join(chunk)
+
+    return Response(generate(), mimetype="application/json")
+
+
+class ResponseCache:
+    """LRU of serialized JSON responses, each tagged with the version of
+    the table it was generated from, so entries go stale as soon as the
+    updater modifies the table. Holds at most max_size characters of
+    bodies (the JSON is ASCII, so that's bytes) per process."""
+
+    def __init__(self, max_size=64 * 1024 * 1024, max_entry_size=16 * 1024 * 1024):
+        self.max_size = max_size
+        self.max_entry_size = min(max_entry_size, max_size)
+        self.size = 0
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def _remove(self, key):
+        _, body = self.entries.pop(key)
+        self.size -= len(body)
+
+    def get(self, key, version):
+        with self.lock:
+            entry = self.entries.get(key, None)
+            if entry is None:
+                return None
+            if entry[0] != version:
+                self._remove(key)
+                return None
+            self.entries.move_to_end(key)
+            return entry[1]
+
+    def put(self, key, version, body):
+        if len(body) > self.max_entry_size:
+            return
+        with self.lock:
+            if key in self.entries:
+                self._remove(key)
+            self.entries[key] = (version, body)
+            self.size += len(body)
+            while self.size > self.max_size:
+                self._remove(next(iter(self.entries)))
+
+
+response_cache = ResponseCache(
+    max_size=int(os.getenv("PAINTDRY_WEB_CACHE_MB", "64")) * 1024 * 1024
+)
+
+
+def _cache_when_complete(chunks, key, table, version):
+    """Pass the chunks of a streamed response through, and cache the body
+    if it's small enough and the table wasn't modified while streaming."""
+    body = []
+    size = 0
+    for chunk in chunks:
+        yield chunk
+        if body is not None:
+            body.append(chunk)
+            size += len(chunk)
+            if size > response_cache.max_entry_size:
+                body = None
+    if body is not None and get_database().get_table_version(table)[0] == version:
+        response_cache.put(key, version, "".join(body))
+
+
+def _cache_key(table):
+    """Only the query parameters which list_table() looks at, in a fixed
+    order, so unknown or reordered parameters don't cache more copies."""
+    key = [table]
+    for name in LIST_PARAMETERS:
+        if name not in request.args:
+            continue
+        if name in FILTER_COLUMNS:
+            key.append((name, *sorted(set(request.args.getlist(name)))))
+        else:
+            key.append((name, request.args.get(name)))
+    return tuple(key)
+
+
+def cached_table_response(table, generate):
+    """Conditional GET for responses which only depend on the contents of
+    one table, answers If-None-Match with 304, or a cached body, before
+    calling generate() to run the query.
+
+    If-Modified-Since alone is not enough, Last-Modified is only precise
+    to the second, and the table can change more than once per second."""
+    version, updated = get_database().get_table_version(table)
+    etag = f"{table}-{version}"
+    key = _cache_key(table)
+    if not is_resource_modified(request.environ, etag=etag):
+        response = Response(status=304)
+    elif (body := response_cache.get(key, version)) is not None:
+        response = Response(body, mimetype="application/json")
+    else:
+        response = app.make_response(generate())
+        if response.status_code == 200 and response.is_streamed:
+            response.response = _cache_when_complete(
+                response.response, key, table, version
+            )
+        elif response.status_code == 200:
+            body = response.get_data(as_text=True)
+            if get_database().get_table_version(table)[0] == version:
+                response_cache.put(key, version, body)
+    response.set_etag(etag)
+    response.last_modified = updated
+    # Clients may keep it, but must check the ETag before using it:
+    response.cache_control.no_cache = True
+    return response
+
+
+class Notifier:
+    """Counts NOTIFYs from the update triggers, so that streams can wait
+    for new rows. One listening connection and thread per process."""
+
+    CHANNELS = ["paintdry_changes", "paintdry_history"]
+
+    def __init__(self):
+        self.condition = threading.Condition()
+        self.counter = 0
+        self.pid = None
+
+    def _run(self):
+        while True:
+            try:
+                for _ in listen(self.CHANNELS):
+                    with self.condition:
+                        self.counter += 1
+                        self.condition.notify_all()
+            except psycopg2.Error as e:
+                print(f"Lost LISTEN connection ({e}), reconnecting...")
+                time.sleep(2)
+
+    def current(self) -> int:
+        with self.condition:
+            if self.pid != os.getpid():
+                self.pid = os.getpid()
+                threading.Thread(target=self._run, daemon=True).start()
+            return self.counter
+
+    def wait(self, counter: int, timeout: float) -> bool:
+        """Wait until something was notified after current() returned
+        counter, returns False on timeout."""
+        with self.condition:
+            return self.condition.wait_for(lambda: self.counter != counter, timeout)
+
+
+notifier = Notifier()
+
+
+def _parse_limit():
+    limit = int(request.args.get("limit", 100))
+    if limit < 1 or limit > MAX_LIMIT:
+        raise ValueError(f"limit must be between 1 and {MAX_LIMIT}")
+    return limit
+
+
+def rows_since(table):
+    """?since=<next_cursor | id | timestamp>&limit=100"""
+    try:
+        return get_database().rows_since(
+            table, request.args.get("since", None), _parse_limit()
+        )
+    except ValueError as e:
+        abort(400, str(e))
+
+
+def stream_rows(table):
+    """Server-Sent Events with rows as they are added to the table, starting
+    after ?since=... or the Last-Event-ID of a previous stream."""
+    since = request.headers.get("Last-Event-ID", None)
+    since = since or request.args.get("since", None)
+    if not _stream_slots.acquire(blocking=False):
+        return _event_stream([f"retry: {STREAM_BUSY_RETRY}\n\n"])
+    database = get_database()
+    try:
+        counter = notifier.current()
+        page = database.rows_since(table, since, MAX_LIMIT)
+    except ValueError as e:
+        _stream_slots.release()
+        abort(400, str(e))
+    except Exception:
+        _stream_slots.release()
+        raise
+
+    def generate():
+        nonlocal page, counter
+        deadline = time.monotonic() + STREAM_DURATION
+        yield "retry: 2000\n\n"
+        while True:
+            for row in page["results"]:
+                data = app.json.dumps(row)
+                yield f"id: {row['cursor']}\nevent: {table}\ndata: {data}\n\n"
+            if len(page["results"]) < MAX_LIMIT:
+                if not notifier.wait(counter, STREAM_KEEPALIVE):
+                    yield ": keepalive\n\n"
+                if time.monotonic() > deadline:
+                    return
+            counter = notifier.current()
+            page = database.rows_since(table, page["next_cursor"], MAX_LIMIT)
+
+    response = _event_stream(generate())
+    response.call_on_close(_stream_slots.release)
+    return response
+
+
+def _event_stream(events):
+    response = Response(events, mimetype="text/event-stream")
+    response.cache_control.no_cache = True
+    # Don't let a reverse proxy buffer the stream:
+    response.headers["X-Accel-Buffering"] = "no"
+    return response
+
+
+def _parse_time(key):
+    value = request.args.get(key, None)
+    if value is None:
+        return None
+    return datetime.datetime.fromisoformat(value)
+
+
+def list_table(table, iter_all):
+    """List endpoint, paginated, filtered and sorted in the database when
+    any of the LIST_PARAMETERS are given, otherwise streams everything:
+
+    ?limit=100&cursor=<next_cursor>&sort=-timestamp&module=http&since=2025-01-01
+    """
+    if not any(key in request.args for key in LIST_PARAMETERS):
+        return stream_json_list(iter_all())
+    try:
+        limit = _parse_limit()
+        sort = request.args.get("sort", None)
+        descending = False
+        if sort and sort.startswith("-"):
+            sort = sort[1:]
+            descending = True
+        filters = {
+            key: request.args.getlist(key)
+            for key in FILTER_COLUMNS
+            if key in request.args
+        }
+        return get_database().list_rows(
+            table,
+            filters=filters,
+            sort=sort,
+            descending=descending,
+            limit=limit,
+            cursor=request.args.get("cursor", None),
+            since=_parse_time("since"),
+            until=_parse_time("until"),
+        )
+    except ValueError as e:
+        abort(400, str(e))
+
 
 @app.route("/api/resources")
 def api_resources():
-    return database.get_resources()
+    return cached_table_response(
+        "resources", lambda: list_table("resources", get_database().iter_resources)
+    )
 
 
 @app.route("/api/resources/<string:id>")
 def api_get_resource(id):
-    result = database.get_resource(id)
+    result = get_database().get_resource(id)
     if not result:
         abort(404)
     return result
@@ -33,12 +356,14 @@ def api_config():
 
 @app.route("/api/observations")
 def api_observations():
-    return database.get_observations()
+    return cached_table_response(
+        "observations", lambda: list_table("observations", get_database().iter_observations)
+    )
 
 
 @app.route("/api/observations/<string:id>")
 def api_get_observation(id):
-    result = database.get_observation(id)
+    result = get_database().get_observation(id)
     if not result:
         abort(404)
     return result
@@ -46,12 +371,24 @@ def api_get_observation(id):
 
 @app.route("/api/history")
 def api_history():
-    return database.get_history()
+    return cached_table_response(
+        "history", lambda: list_table("history", get_database().iter_history)
+    )
+
+
+@app.route("/api/history/since")
+def api_history_since():
+    return rows_since("history")
+
+
+@app.route("/api/history/stream")
+def api_history_stream():
+    return stream_rows("history")
 
 
 @app.route("/api/history/<string:id>")
 def api_get_history(id):
-    result = database.get_history(id)
+    result = get_database().get_history(id)
     if not result:
         abort(404)
     return result[0]
@@ -59,12 +396,24 @@ def api_get_history(id):
 
 @app.route("/api/changes")
 def api_changes():
-    return database.get_changes()
+    return cached_table_response(
+        "changes", lambda: list_table("changes", get_database().iter_changes)
+    )
+
+
+@app.route("/api/changes/since")
+def api_changes_since():
+    return rows_since("changes")
+
+
+@app.route("/api/changes/stream")
+def api_changes_stream():
+    return stream_rows("changes")
 
 
 @app.route("/api/changes/<string:id>")
 def api_get_changes(id):
-    result = database.get_changes(id)
+    result = get_database().get_changes(id)
     if not result:
         abort(404)
     return result[0]
@@ -76,7 +425,8 @@ def api_search():
         abort(404)
     search_string = request.json.get("search", "")
     page = request.json.get("page", 1)
-    return database.search(search_string, page)
+    estimate = request.json.get("estimate", False)
+    return get_database().search(search_string, page, estimate)
 
 
 @app.route("/")
@@ -87,15 +437,67 @@ def redirect_to_ui():
 @app.route("/ui/")
 @app.route("/ui/<path:path>")
 def ui(path=None):
-    return send_from_directory("dist", "index.html")
+    # Always revalidated, it's what points to the current hashed assets:
+    return send_from_directory(DIST_FOLDER, "index.html", max_age=0)
+
+
+@app.route("/assets/<path:path>")
+def assets(path):
+    response = send_from_directory(
+        os.path.join(DIST_FOLDER, "assets"), path, max_age=ASSET_MAX_AGE
+    )
+    response.cache_control.public = True
+    response.cache_control.immutable = True
+    return response
 
 
 @app.route("/<path:path>")
 def index(path=None):
     if not path or path == "/":
         path = "index.html"
-    return send_from_directory("dist", path)
+    return send_from_directory(DIST_FOLDER, path, max_age=0)
 
 
-def start_server(host, port):
+def start_dev_server(host, port):
+    """Flask's development server, for local testing."""
     app.run(host=host, port=port)
+
+
+def _worker_exit(server, worker):
+    close_database()
+
+
+def start_server(host, port):
+    """Production server, gunicorn with several worker processes, each with
+    a few threads and its own database connection pool.
+
+    PAINTDRY_WEB_WORKERS and PAINTDRY_WEB_THREADS override the defaults.
+    Send SIGHUP to the main process to gracefully reload the workers."""
+    try:
+        from gunicorn.app.base import BaseApplication
+    except ImportError:
+        print("gunicorn is not installed, install paintdry[serve] or use serve-dev")
+        sys.exit(1)
+
+    class Application(BaseApplication):
+        def load_config(self):
+            self.cfg.set("bind", f"{host}:{port}")
+            self.cfg.set(
+                "workers",
+                int(os.getenv("PAINTDRY_WEB_WORKERS", min(2 * os.cpu_count() + 1, 8))),
+            )
+            # An open /api/*/stream holds a thread, for up to STREAM_DURATION,
+            # at most MAX_STREAMS (PAINTDRY_WEB_STREAMS) of them per worker,
+            # keep it below the threads:
+            self.cfg.set("threads", int(os.getenv("PAINTDRY_WEB_THREADS", "4")))
+            self.cfg.set("worker_class", "gthread")
+            self.cfg.set("graceful_timeout", 30)
+            # Streamed list responses can take a while for big tables:
+            self.cfg.set("timeout", 120)
+            self.cfg.set("accesslog", "-")
+            self.cfg.set("worker_exit", _worker_exit)
+
+        def load(self):
+            return app
+
+    Application().run()
@@ -3,11 +3,16 @@ import sys
 import json
 import datetime
 import pathlib
+import selectors
+import socket
+from collections import Counter
 from time import sleep
-from subprocess import Popen, PIPE, STDOUT
+from subprocess import Popen, PIPE
 
 from paintdry.utils import JsonFile, ensure_folder, sha, timestamp
 from paintdry.database import Database
+from paintdry.schedule import Scheduler
+from paintdry.journal import Journal
 from paintdry.lib import (
     ModuleRequest,
     ModuleResponse,
@@ -21,6 +26,20 @@ from paintdry.lib import (
 )
 
 
+# Marks the end of a batch of requests / responses in worker mode,
+# same as in modules/modlib.py:
+END_OF_BATCH = {"operation": "end_of_batch"}
+
+# Module request / response files and caches:
+STATE_FOLDER = "/paintdry/mount-state"
+
+# Seconds between checks for work items still leased by other workers:
+WORK_POLL_INTERVAL = 5
+
+# Requests are queued in the work_items table this many at a time:
+ENQUEUE_BATCH_SIZE = 1000
+
+
 def now() -> int:
     return int(datetime.datetime.now().timestamp())
 
@@ -54,10 +73,73 @@ def response_to_change(response: ModuleResponse) -> Change:
     return Change(**data)
 
 
+def request_key(request: ModuleRequest) -> tuple:
+    """Identifies the work a request asks for, requests with the same key
+    (sent at different times) give the same responses. Discoveries echo
+    their source, which is part of the resources row, so the same resource
+    suggested by different sources are different requests."""
+    source = None
+    if request["operation"] == "discovery":
+        source = request.get("source")
+    return (
+        request["operation"],
+        request["module"],
+        request["resource"],
+        request.get("attribute"),
+        request.get("id"),
+        request.get("old_value"),
+        request.get("new_value"),
+        source,
+    )
+
+
+class RequestIndex:
+    """Requests already queued in this update, used to coalesce the same
+    resource being requested from config, the resources table and other
+    modules' discoveries."""
+
+    def __init__(self):
+        self._keys = set()
+        self.requested = Counter()
+        self.coalesced = Counter()
+
+    def add(self, requests: list[ModuleRequest]) -> list[ModuleRequest]:
+        """Returns the requests which were not queued before."""
+        fresh = []
+        for request in requests:
+            key = request_key(request)
+            self.requested[request["module"]] += 1
+            if key in self._keys:
+                self.coalesced[request["module"]] += 1
+                continue
+            self._keys.add(key)
+            fresh.append(request)
+        return fresh
+
+    def seed(self, keys: set[tuple]):
+        """Mark requests as done already, without counting them."""
+        self._keys.update(keys)
+
+    def print_summary(self):
+        for module in sorted(self.requested):
+            requested = self.requested[module]
+            coalesced = self.coalesced[module]
+            print(f"Requests for {module}: {requested}, coalesced: {coalesced}")
+        requested = sum(self.requested.values())
+        coalesced = sum(self.coalesced.values())
+        print(f"Coalesced {coalesced} of {requested} requests in this update")
+
+
 class Module:
-    def __init__(self, name, command, slow):
+    def __init__(self, name, command, slow, workers=None, index=None, retry_files=True):
         self.name = name
         self.slow = slow
+        self.workers = workers
+        self.index = index if index is not None else RequestIndex()
+        # Whether requests of a failed batch are written to request files,
+        # to be retried next update (otherwise the work queue retries them):
+        self.retry_files = retry_files
+        self.failed = False
         print(f"Starting '{name}' module")
         assert not " " in name
         assert not "/" in name
@@ -66,46 +148,127 @@ class Module:
         assert not "'" in name
         assert not '"' in name
         assert not "\n" in name
-        module_folder = f"/paintdry/mount-state/modules/{name}"
-        cache_folder = "/paintdry/mount-state/"
+        module_folder = f"{STATE_FOLDER}/modules/{name}"
+        cache_folder = f"{STATE_FOLDER}/"
         input_folder = f"{module_folder}/requests"
         output_folder = f"{module_folder}/responses"
         pathlib.Path(input_folder).mkdir(parents=True, exist_ok=True)
         pathlib.Path(output_folder).mkdir(parents=True, exist_ok=True)
         pathlib.Path(cache_folder).mkdir(parents=True, exist_ok=True)
-        command = f"cd '{module_folder}' && {command} '{input_folder}' '{output_folder}' '{cache_folder}'"
+        # Slow modules are run elsewhere, on the request files in input_folder,
+        # the rest run as a long-running worker process streaming over pipes:
+        command = f"cd '{module_folder}' && exec {command} worker '{cache_folder}'"
         self._command = command
         self._module_folder = module_folder
         self._input_folder = input_folder
         self._output_folder = output_folder
         self._cache_folder = cache_folder
         self._process = None
+        self._input = b""
+        self._output = b""
+        self._batch = []
+        self._batch_files = []
+        self._batch_backlog = []
+        self._responses = []
+        # Requests of the last batch which was completed:
+        self.completed = []
+        self._attempted_files = set()
+        # Request files written for the next update, see write_requests():
+        self._deferred_files = set()
         self._request_backlog = []
         self._request_counter = 0
 
     def get_cache_path(self):
         return self._cache_folder + "http_cache"
 
-    def _wait_process(self):
-        if self.slow:
-            return
+    @property
+    def running(self) -> bool:
+        """Whether a batch of requests is currently being handled."""
+        return bool(self._batch)
+
+    @property
+    def batch(self) -> list[ModuleRequest]:
+        return self._batch
+
+    @property
+    def stdin(self):
+        assert self._process is not None
+        return self._process.stdin
+
+    @property
+    def stdout(self):
+        assert self._process is not None
+        return self._process.stdout
+
+    def _request_files(self) -> set[str]:
+        with os.scandir(self._input_folder) as it:
+            return {
+                entry.name
+                for entry in it
+                if entry.is_file() and entry.name.endswith(".json")
+            }
+
+    def has_pending_requests(self) -> bool:
+        if self._request_backlog:
+            return True
+        # Request files which were part of a batch which failed are still
+        # there. Don't retry them until next update:
+        return bool(self._pending_files())
+
+    def _pending_files(self) -> set[str]:
+        return self._request_files() - self._attempted_files - self._deferred_files
+
+    def write_input(self) -> bool:
+        """Write as much of the batch to the worker as the pipe accepts,
+        returns False when everything is written."""
+        try:
+            n = os.write(self.stdin.fileno(), self._input)
+        except BlockingIOError:
+            return True
+        except BrokenPipeError:
+            self._input = b""  # Worker died, noticed by read_output()
+            return False
+        self._input = self._input[n:]
+        return bool(self._input)
+
+    def read_output(self) -> bool:
+        """Read available responses from the worker, returns False when the
+        batch is done (or the worker exited)."""
+        data = os.read(self.stdout.fileno(), 65536)
+        if not data:
+            self._stop_process()
+            return False
+        *lines, self._output = (self._output + data).split(b"\n")
+        for line in lines:
+            if not line.strip():
+                continue
+            response = json.loads(line)
+            if response == END_OF_BATCH:
+                return False
+            self._responses.append(response)
+        return True
+
+    def finish(self) -> list[ModuleResponse]:
+        """Finish the current batch, returning the responses."""
+        responses = self._responses
+        self.completed = []
         if self._process is None:
-            return
-
-        (out, err) = self._process.communicate()
-        out = out.strip()
-        if out:
-            print(f"Stdout from {self.name} module:")
-            print(out)
-        if err:
-            print(f"Stderr from {self.name} module:")
-            print(err)
-
-        r = self._process.wait()
-        if r != 0:
-            print(f"Module {self.name} exited with error: {r}")
-
-        self._process = None
+            # Worker exited without completing the batch, put the requests
+            # back into request files, to be retried next update:
+            print(f"Module {self.name} failed to complete batch")
+            self.failed = True
+            if self._batch_backlog and self.retry_files:
+                self._write_requests_with_checksum(self._batch_backlog)
+            self._attempted_files = self._request_files()
+        else:
+            for name in self._batch_files:
+                os.unlink(os.path.join(self._input_folder, name))
+            self.completed = self._batch
+        self._batch = []
+        self._batch_files = []
+        self._batch_backlog = []
+        self._responses = []
+        return responses
 
     def process_responses(self, callback):
         print(f"Processing responses for {self.name}")
@@ -118,34 +281,44 @@ class Module:
                 with open(entry.path, "r") as f:
                     data = json.loads(f.read())
                 assert type(data) is list
-                for response in data:
-                    callback(response)
+                callback(data)
                 print("Done processing response, deleting: " + entry.path)
                 os.unlink(entry.path)
         print(f"Done processing {n} responses for {self.name}")
 
-    def process_all_responses(self, callback):
-        if self.slow:
-            self.process_responses(callback)
-            return
-        self._wait_process()  # Finish current process
-        self.start()  # Start new one if more requests
-        self._wait_process()  # Finish last one
-        self.process_responses(callback)
-
     def _start_process(self):
-        if self.slow:
+        if self._process is not None:
             return
-        self._wait_process()
+        env = None
+        if self.workers:
+            env = {**os.environ, "PAINTDRY_MODULE_WORKERS": str(self.workers)}
         self._process = Popen(
             self._command,
             shell=True,
-            text=True,
-            encoding="utf-8",
             stdin=PIPE,
             stdout=PIPE,
-            stderr=STDOUT,
+            env=env,
         )
+        os.set_blocking(self._process.stdin.fileno(), False)
+        self._output = b""
+
+    def _stop_process(self):
+        if self._process is None:
+            return
+        try:
+            self._process.stdin.close()
+        except BrokenPipeError:
+            pass
+        r = self._process.wait()
+        if r != 0:
+            print(f"Module {self.name} exited with error: {r}")
+        self._process.stdout.close()
+        self._process = None
+        self._input = b""
+
+    def stop(self):
+        assert not self.running
+        self._stop_process()
 
     def _next_filename(self):
         name = f"{self._input_folder}/{now()}-{self._request_counter}.json"
@@ -153,52 +326,278 @@ class Module:
         return name
 
     def _dump_backlog(self):
-        self.write_requests(self._request_backlog)
+        if not self._request_backlog:
+            return
+        self._write_requests_with_checksum(self._request_backlog)
         self._request_backlog = []
 
+    def _read_request_files(self) -> list[ModuleRequest]:
+        requests = []
+        self._batch_files = []
+        for name in sorted(self._pending_files()):
+            with open(os.path.join(self._input_folder, name), "r") as f:
+                data = json.loads(f.read())
+            if type(data) is dict:
+                data = [data]
+            # Left over from a previous update, don't request them again:
+            fresh = self.index.add(data)
+            if not fresh:
+                continue  # Deleted once it's part of a batch which runs
+            requests.extend(fresh)
+            self._batch_files.append(name)
+        return requests
+
     def start(self):
-        # TODO check if process already exited so we can start another
-        if self._process:
+        """Send pending requests to the worker as one batch."""
+        if self.slow:
+            self._dump_backlog()
+            return
+        if self.running:
+            return
+        batch = self._read_request_files() + self._request_backlog
+        self._batch_backlog = self._request_backlog
+        self._request_backlog = []
+        if not batch:
             return
-        # if len(self._request_backlog) == 0:
-        #     return
-        self._dump_backlog()
         self._start_process()
-
-    def _write_requests_with_checksum(self, requests):
+        lines = [json.dumps(request) + "\n" for request in batch]
+        lines.append(json.dumps(END_OF_BATCH) + "\n")
+        self._input = "".join(lines).encode("utf-8")
+        self._batch = batch
+
+    def _write_requests_with_checksum(self, requests) -> str | None:
+        """Returns the name of the request file."""
+        if not requests:
+            return None
         folder = self._input_folder
-        data = json.loads(json.dumps(requests))
-        for element in data:
-            del element["timestamp"]
-        filename = sha(json.dumps(data))
-        path = folder + "/" + filename + ".json"
-        if os.path.exists(path):
-            return
-        dump_json_atomic(path, requests)
+        filename = sha(json.dumps([request_key(r) for r in requests])) + ".json"
+        path = folder + "/" + filename
+        if not os.path.exists(path):
+            dump_json_atomic(path, requests)
+        return filename
 
     def write_requests(self, requests: list[ModuleRequest]):
+        """Leave requests for the next update. They're not added to the
+        index, they haven't been done in this update."""
         # filename = self._next_filename()
         # dump_json_atomic(filename, requests)
-        self._write_requests_with_checksum(requests)
-
-    def send_requests(self, requests: list[ModuleRequest]):
+        filename = self._write_requests_with_checksum(requests)
+        if filename is not None:
+            self._deferred_files.add(filename)
+
+    def send_requests(self, requests: list[ModuleRequest], coalesce=True):
+        # Started by the Updater, which decides how many modules run at once
+        if coalesce:
+            requests = self.index.add(requests)
         self._request_backlog.extend(requests)
-        self.start()
 
 
 class Updater:
-    def __init__(self):
-        self.database = Database()
+    def __init__(self, work_queue=None, database=None):
+        config = JsonFile(get_config_filename())
+        # Minutes, last_seen of unchanged observations is only bumped when
+        # older than this, instead of rewriting every row on every update
+        resolution = config.get("last_seen_resolution", 60)
+        if database is None:
+            database = Database(maxconn=4, last_seen_resolution=resolution * 60)
+        self.database = database
         self.cache = {}
+        self.index = RequestIndex()
         self.modules = {}
         self.discovery_backlog = []
+        self.resource_backlog = []
+        # 0 means no limit on how many module processes run at the same time
+        self.max_running = config.get("max_concurrent_modules", 4)
+        # How many rounds of discovery to follow within one update
+        self.max_discovery_depth = config.get("max_discovery_depth", 5)
+        # Months of history / changes to keep, None keeps everything
+        self.retention_months = config.get("retention_months", None)
+        # Which resources are due for observation in this update:
+        self.scheduler = Scheduler(config["modules"], self.database.get_schedule())
+        # Resources which weren't discovered again in this many updates are
+        # marked stale, None keeps them forever:
+        self.stale_after = config.get("stale_after", None)
+        # Only report which resources would be marked stale:
+        self.stale_dry_run = config.get("stale_dry_run", False)
+        self.observed = []
+        # Sources (modules, config.json) whose discoveries ran / didn't run
+        # (not due, failed) in this update, see expire_resources():
+        self.discoveries_ran = set()
+        self.discoveries_missed = set()
+        # Queue requests in the work_items table, to be run by any number
+        # of updater / worker processes, instead of running them here:
+        if work_queue is None:
+            work_queue = config.get("work_queue", False)
+        self.work_queue = work_queue
+        self.worker_id = f"{socket.gethostname()}-{os.getpid()}"
+        # Minutes a worker has to finish the work items it claimed
+        self.work_lease = config.get("work_lease", 10)
+        self.work_batch_size = config.get("work_batch_size", 100)
+        # Discovery depth of the requests being queued
+        self.depth = 0
+        # Work items waiting to be queued, see flush_work():
+        self.work_backlog = []
+        # Progress of the update, set up in update()
+        self.journal = None
+        self.running = {}
+        self.selector = selectors.DefaultSelector()
 
     def send_requests(self, name: str, requests: list[ModuleRequest]):
         # TODO: get rid of this
         module = self.get_module(name)
         if not module:
             return
+        if self.work_queue and not module.slow:
+            self.enqueue_requests(requests)
+            return
         module.send_requests(requests)
+        self.start_module(module)
+
+    def enqueue_requests(self, requests: list[ModuleRequest]):
+        self.work_backlog.extend(
+            (r["module"], sha(json.dumps(request_key(r))), r, self.depth)
+            for r in self.index.add(requests)
+        )
+        if len(self.work_backlog) >= ENQUEUE_BATCH_SIZE:
+            self.flush_work()
+
+    def flush_work(self):
+        """Queue the requests collected by enqueue_requests(). The intervals
+        of the resources they observe are written first: workers claim the
+        items right away, and the interval a worker resets after a change
+        must not be overwritten by the doubled one."""
+        self.database.update_schedule(self.scheduler.next_intervals())
+        items = self.work_backlog
+        self.work_backlog = []
+        if not items:
+            return
+        queued = self.database.enqueue_work(items)
+        print(f"Queued {queued} of {len(items)} requests")
+
+    def process_work(self) -> int:
+        """Claim a batch of work items from the queue, run them and mark
+        them completed. Returns how many were claimed, 0 when there is
+        nothing left to do."""
+        lease = self.work_lease * 60
+        items = self.database.claim_work(self.worker_id, self.work_batch_size, lease)
+        if not items:
+            return 0
+        print(f"Claimed {len(items)} work item(s)")
+        ids = {}
+        depth = max(item[3] for item in items)
+        for id, name, request, _ in items:
+            module = self.get_module(name)
+            if not module:
+                continue  # Not configured here, retried elsewhere
+            module.failed = False
+            module.send_requests([ModuleRequest(**request)], coalesce=False)
+            ids.setdefault(name, []).append(id)
+        self.run_modules()
+        if depth < self.max_discovery_depth:
+            # Discovered resources are queued, for whichever worker is free:
+            self.depth = depth + 1
+            self.dispatch_discoveries()
+            self.depth = 0
+        else:
+            print(f"Reached max discovery depth ({depth}), continuing next update")
+            self.process_discovery_backlog()
+        self.flush_work()
+        # Work of failed modules is left to be claimed again when the
+        # lease expires:
+        done = [id for name, arr in ids.items() if not self.modules[name].failed for id in arr]
+        self.database.complete_work(done, self.worker_id)
+        return len(items)
+
+    def run(self):
+        """Run the requests sent so far, until no requests are pending."""
+        if self.work_queue:
+            self.flush_work()
+            self.run_work()
+            # Their intervals were doubled when they were queued:
+            for module, resource in self.database.failed_observations():
+                self.scheduler.failed(module, resource)
+        self.run_modules()
+
+    def run_work(self):
+        """Work on the queue until all of its items are done, including
+        the ones other workers are still working on."""
+        while True:
+            if self.process_work():
+                continue
+            pending = self.database.pending_work()
+            if not pending:
+                return
+            print(f"Waiting for {pending} work item(s) leased by other workers")
+            sleep(WORK_POLL_INTERVAL)
+
+    def start_module(self, module: Module):
+        if module.slow:
+            module.start()  # Only writes request files, processed elsewhere
+            return
+        if module.running:
+            return
+        if self.max_running and len(self.running) >= self.max_running:
+            return  # Started later by run_modules()
+        module.start()
+        if not module.running:
+            return  # Nothing to do
+        if self.journal:
+            self.journal.dispatch(module.name, [request_key(r) for r in module.batch])
+        self.running[module.name] = module
+        self.selector.register(module.stdout, selectors.EVENT_READ, module)
+        # Write what fits in the pipe now, so the worker can get started:
+        if module.write_input():
+            self.selector.register(module.stdin, selectors.EVENT_WRITE, module)
+
+    def start_modules(self):
+        for module in self.modules.values():
+            if module.slow or module.has_pending_requests():
+                self.start_module(module)
+
+    def run_modules(self):
+        """Run module workers concurrently until no requests are pending.
+
+        Responses are ingested as soon as each module finishes its batch,
+        and the freed up slot is used to start the next module."""
+        while True:
+            self.start_modules()
+            if not self.running:
+                return
+            for key, _ in self.selector.select():
+                module = key.data
+                if module.name not in self.running:
+                    continue  # Finished earlier in this loop
+                if key.events == selectors.EVENT_WRITE:
+                    if not module.write_input():
+                        self.selector.unregister(key.fileobj)
+                    continue
+                if module.read_output():
+                    continue
+                self._finish_module(module)
+
+    def _finish_module(self, module: Module):
+        for key in list(self.selector.get_map().values()):
+            if key.data is module:
+                self.selector.unregister(key.fileobj)
+        del self.running[module.name]
+        batch = module.batch
+        changed = self.process_response_batch(module.name, module.finish())
+        # The work queue retries failed batches, see run():
+        failed = not module.completed and not self.work_queue
+        for request in batch:
+            if request["operation"] == "discovery":
+                self.discovery_ran(module.name, request["source"], bool(module.completed))
+            if failed and request["operation"] == "observation":
+                self.scheduler.failed(module.name, request["resource"])
+        # After the responses are in the database, so the batch is redone
+        # if the update is interrupted before that:
+        if self.journal and module.completed:
+            keys = [request_key(r) for r in module.completed]
+            self.journal.complete(module.name, keys, changed)
+
+    def stop_modules(self):
+        for module in self.modules.values():
+            module.stop()
 
     def send_requests_auto(self, requests: list[ModuleRequest]):
         per_module = {}
@@ -207,10 +606,8 @@ class Updater:
                 per_module[request.module] = []
             per_module[request.module].append(request)
         for module, arr in per_module.items():
-            module = self.get_module(module)
-            assert module is not None
-            module.send_requests(arr)
-            module.start()
+            assert self.get_module(module) is not None
+            self.send_requests(module, arr)
 
     def get_module(self, name: str) -> Module | None:
         if not name in self.modules:
@@ -221,13 +618,19 @@ class Updater:
             module = config["modules"][name]
             command = module["command"]
             slow = module.get("slow", False)
-            self.modules[name] = Module(name, command, slow)
+            workers = module.get("workers", None)
+            self.modules[name] = Module(
+                name, command, slow, workers, self.index, not self.work_queue
+            )
         return self.modules[name]
 
-    def process_discovery_backlog(self):
-        print("Processing discovery backlog")
+    def _suggestion_requests(self) -> dict[str, list[ModuleRequest]]:
         modules = {}
         for discovery in self.discovery_backlog:
+            key = discovery.module + " - " + discovery.resource
+            if key in self.cache or "suggested - " + key in self.cache:
+                continue  # Already requested in this update
+            self.cache["suggested - " + key] = True
             request = ModuleRequest(
                 operation="discovery",
                 resource=discovery.resource,
@@ -238,13 +641,29 @@ class Updater:
             if not discovery.module in modules:
                 modules[discovery.module] = []
             modules[discovery.module].append(request)
+        self.discovery_backlog = []
+        return modules
+
+    def dispatch_discoveries(self):
+        # Observe resources which were accepted by their module:
+        resources = self.resource_backlog
+        self.resource_backlog = []
+        for resource in resources:
+            self.initiate_requests(resource)
+        # Let modules accept / reject resources suggested by other modules:
+        for name, requests in self._suggestion_requests().items():
+            if not self.get_module(name):
+                continue
+            self.send_requests(name, requests)
 
-        for name, requests in modules.items():
+    def process_discovery_backlog(self):
+        print("Processing discovery backlog")
+        for name, requests in self._suggestion_requests().items():
             module = self.get_module(name)
             if not module:
                 continue
             module.write_requests(requests)
-        self.discovery_backlog = []
+        self.resource_backlog = []  # In resources table, handled next update
 
     def send_request_for_resource(self, resource: Resource, module: str):
         print(f"Sending requests to '{module}' module for '{resource.resource}'")
@@ -281,6 +700,11 @@ class Updater:
         resource = Resource(identifier, module)
         if not self.get_module(module):
             sys.exit(f"Target '{module}' not supported!")
+        if not self.scheduler.is_due(module, identifier):
+            self.discoveries_missed.add(module)
+            return ([], [])
+        self.scheduler.dispatched(module, identifier)
+        self.observed.append((module, identifier))
         return self.send_request_for_resource(resource, module)
 
     def process_discovery(self, module: str, discovery: Discovery):
@@ -289,11 +713,13 @@ class Updater:
                 f"Discovery: {discovery.resource} for {discovery.module} suggested by {module}"
             )
             self.discovery_backlog.append(discovery)
+            if self.journal:
+                self.journal.suggest(discovery)
             return
         print(f"Discovery: {discovery.resource} accepted by {module}")
-        self.database.upsert_resource(
-            Resource.from_discovery(discovery), discovery.source
-        )
+        resource = Resource.from_discovery(discovery)
+        self.database.upsert_resource(resource, discovery.source)
+        self.resource_backlog.append(resource)
 
     def initiate_requests(self, entry: Resource):
         self._process(entry.resource, entry.module)
@@ -308,16 +734,17 @@ class Updater:
             source="config.json",
             timestamp=now(),
         )
-        module.send_requests([request])
+        self.send_requests(target.module, [request])
 
     def setup_requests(self):
-        for resource in self.database.get_resources():
+        for resource in self.database.get_live_resources():
             self.initiate_requests(resource)
 
     def process_response(self, module, response: ModuleResponse):
         if response["operation"] == "observation":
             observation = response_to_observation(response)
-            self.database.upsert_observations(observation)
+            changed = self.database.upsert_observations(observation)
+            self.scheduler.observed([observation], changed)
             return
         if response["operation"] == "discovery":
             discovery = response_to_discovery(response)
@@ -326,24 +753,47 @@ class Updater:
         assert response["operation"] == "change"
 
         change = response_to_change(response)
-        self.process_change(change)
+        self.database.update_changes([change])
         return
 
+    def process_response_batch(self, module, responses: list[ModuleResponse]):
+        # Observations and changes are the bulk of the responses, write
+        # them all at once:
+        observations = []
+        changes = []
+        for response in responses:
+            if response["operation"] == "observation":
+                observations.append(response_to_observation(response))
+                continue
+            if response["operation"] == "change":
+                changes.append(response_to_change(response))
+                continue
+            self.process_response(module, response)
+        changed = self.database.upsert_observations_batch(observations)
+        changed = self.scheduler.observed(observations, changed)
+        self.database.update_changes(changes)
+        return changed
+
     def process_responses(self):
         # (Non-blocking) Opportunistically process responses which are ready:
         for name, module in self.modules.items():
-            callback = lambda response: self.process_response(name, response)
+            callback = lambda responses: self.process_response_batch(name, responses)
             module.process_responses(callback)
-        # (Blocking) Wait for everything to finish:
-        for name, module in self.modules.items():
-            callback = lambda response: self.process_response(name, response)
-            module.process_all_responses(callback)
+        # (Blocking) Run modules until all requests are processed, and keep
+        # dispatching what they discover until nothing new is discovered:
+        depth = 0
+        while True:
+            self.run()
+            if not self.discovery_backlog and not self.resource_backlog:
+                break
+            if depth >= self.max_discovery_depth:
+                print(f"Reached max discovery depth ({depth}), continuing next update")
+                break
+            depth += 1
+            print(f"Dispatching discoveries (depth {depth})")
+            self.dispatch_discoveries()
         self.process_discovery_backlog()
 
-    def process_change(self, change: Change):
-        self.database.update_change(change)
-        return
-
     def process_changes(self):
         changes = self.database.get_new_changes()
         if not changes:
@@ -358,6 +808,36 @@ class Updater:
         self.send_requests_auto(requests)
         print(f"Done processing {len(changes)} new change(s).")
 
+    def discovery_ran(self, module: str, source: str, completed: bool):
+        """Record whether a discovery request to module, for a resource
+        discovered by source, ran to completion."""
+        if not completed:
+            # Neither the module's discoveries, nor the resources it was
+            # asked to accept from source, were seen in this update:
+            self.discoveries_missed.add(module)
+            if source:
+                self.discoveries_missed.add(source)
+            return
+        self.discoveries_ran.add(module)
+        if source == "config.json":
+            self.discoveries_ran.add(source)
+
+    def expire_resources(self, since):
+        if self.stale_after is None:
+            return
+        if self.work_queue:
+            # Run by any number of workers, the work items tell what ran:
+            for module, source, completed in self.database.work_discoveries():
+                self.discovery_ran(module, source, completed)
+        sources = self.discoveries_ran - self.discoveries_missed
+        stale = self.database.expire_resources(
+            self.observed, since, self.stale_after, self.stale_dry_run, sources
+        )
+        action = "Would mark" if self.stale_dry_run else "Marked"
+        for module, resource, observations in stale:
+            print(f"{action} {module} {resource} stale ({observations} observations)")
+        print(f"{action} {len(stale)} resource(s) stale")
+
     def update(self):
         clear_get_cache()
 
@@ -371,20 +851,61 @@ class Updater:
         # Setup snapshots
         snapshots = ensure_folder(os.path.join(state, "snapshots"))
 
-        # Prepare next snapshot
-        time = timestamp()
+        # Prepare next snapshot, or resume the one of an interrupted update
         try:
             seq = metadata["last_update"]["seq"] + 1
         except KeyError:
             seq = 1
-        snapshot_name = f"{str(seq).zfill(5)}-{time}"
+        unfinished = sorted(
+            name for name in os.listdir(snapshots)
+            if name.startswith(str(seq).zfill(5) + "-")
+        )
+        if unfinished:
+            snapshot_name = unfinished[-1]
+            time = snapshot_name.split("-", 1)[1]
+        else:
+            time = timestamp()
+            snapshot_name = f"{str(seq).zfill(5)}-{time}"
         self.snapshot = ensure_folder(os.path.join(snapshots, snapshot_name))
+        self.journal = Journal(self.snapshot)
+        if self.journal.resumed:
+            print(
+                f"Resuming interrupted update {snapshot_name}, "
+                + f"{len(self.journal.completed)} requests done, "
+                + f"{self.journal.in_flight()} in flight"
+            )
+            self.index.seed(self.journal.completed)
+            self.discovery_backlog.extend(self.journal.suggestions)
+            # The resources observed before the interruption are scheduled
+            # (and checked for GC) like the ones observed after it, the
+            # work queue has written their schedule after each batch:
+            for operation, module, resource, *_ in self.journal.completed:
+                if operation != "observation":
+                    continue
+                self.observed.append((module, resource))
+                if not self.work_queue:
+                    self.scheduler.dispatched(module, resource)
+            if not self.work_queue:
+                self.scheduler.observed([], self.journal.changed)
+
+        self.database.maintain_partitions(self.retention_months)
+        # Resources discovered before the interruption count as discovered
+        # in this update, so the start time is kept in the journal:
+        started = self.journal.started
+        if started is None:
+            started = self.database.now()
+            self.journal.start(started)
+        # The work items of an interrupted update are picked up again:
+        if self.work_queue and not self.journal.resumed:
+            unfinished = self.database.purge_work()
+            if unfinished:
+                print(f"Gave up on {unfinished} work item(s) in the previous update")
 
         # Start modules, letting them process pre-existing request files:
         for module in config["modules"]:
             module = self.get_module(module)
             assert module is not None
-            module.start()
+        self.start_modules()
 
         # Send change requests
         self.process_changes()
@@ -398,16 +919,19 @@ class Updater:
 
         # Send requests based on resources table:
         self.setup_requests()
-        for module in config["modules"]:
-            module = self.get_module(module)
-            assert module is not None
-            module.start()
+        self.start_modules()
         self.process_responses()
 
-        # Send change requests
+        # Send change requests, and wait for the severities to come back
         self.process_changes()
+        self.run()
+        self.stop_modules()
+        self.index.print_summary()
+        self.expire_resources(started)
+        self.database.update_schedule(self.scheduler.next_intervals())
 
         # Commit snapshot
+        self.journal.close()
         metadata["last_update"] = {"time": time, "name": snapshot_name, "seq": seq}
         metadata.save()
         metadata.save(os.path.join(self.snapshot, "metadata.json"))
@@ -423,3 +947,15 @@ def forever():
 def once():
     updater = Updater()
     updater.update()
+
+
+def worker():
+    """Run work items queued by updaters with work_queue enabled, any
+    number of these can run against the same database."""
+    while True:
+        updater = Updater(work_queue=True)
+        while updater.process_work():
+            pass
+        updater.stop_modules()
+        updater.database.pool.closeall()
+        sleep(10)
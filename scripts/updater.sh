@@ -2,14 +2,11 @@
 set -e
 set -x
 
-find /paintdry/mount-state/modules/ -name '*.json' -delete || true
-
-echo "Waiting for database to be ready and applying schema..."
-until psql -f schema.sql; do
-  echo "Schema application failed, retrying in 5 seconds..."
+echo "Waiting for database to be ready and applying migrations..."
+until python3 -m paintdry migrate; do
+  echo "Migrations failed, retrying in 5 seconds..."
   sleep 5
 done
-echo "Schema successfully applied!"
 
 while true; do
   echo "SELECT * FROM resources LIMIT 5;"
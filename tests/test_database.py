@@ -0,0 +1,393 @@
+import datetime
+import threading
+
+import psycopg2
+import pytest
+from psycopg2.extensions import TRANSACTION_STATUS_IDLE, TRANSACTION_STATUS_UNKNOWN
+
+from paintdry.database import Database, encode_cursor, decode_cursor, _to_json
+
+
+class QueryRecorder(Database):
+    """Database which records queries instead of running them."""
+
+    def __init__(self, rows=None):
+        self.queries = []
+        self.rows = rows or []
+
+    def _query(self, query, args=None):
+        self.queries.append((" ".join(query.split()), args))
+        return self.rows
+
+    def _iter_query(self, query, args=None):
+        return iter(self._query(query, args))
+
+    def _execute_autocommit(self, statement):
+        self.queries.append((statement, "autocommit"))
+
+
+class ConnectionFailure(psycopg2.OperationalError):
+    pgcode = "08006"
+
+
+class LockTimeout(psycopg2.OperationalError):
+    pgcode = "55P03"
+
+
+class FakeConnection:
+    def __init__(self, fail=False, error=None):
+        self.closed = 0
+        self.status = TRANSACTION_STATUS_IDLE
+        self.fail = fail
+        self.error = error
+        self.commits = 0
+        self.rollbacks = 0
+
+    def get_transaction_status(self):
+        return self.status
+
+    def cursor(self):
+        return FakeCursor(self)
+
+    def commit(self):
+        self.commits += 1
+
+    def rollback(self):
+        self.rollbacks += 1
+
+
+class FakeCursor:
+    def __init__(self, conn):
+        self.conn = conn
+        self.description = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+    def execute(self, query, args=None):
+        if self.conn.fail:
+            self.conn.closed = 2
+            raise psycopg2.OperationalError("server closed the connection")
+        if self.conn.error:
+            raise self.conn.error
+
+
+class FakePool:
+    def __init__(self, connections):
+        self.connections = connections
+        self.returned = []
+
+    def getconn(self):
+        return self.connections.pop(0)
+
+    def putconn(self, conn, close=False):
+        self.returned.append((conn, close))
+
+
+def pooled_database(connections):
+    database = Database.__new__(Database)
+    database.pool = FakePool(connections)
+    database._available = threading.BoundedSemaphore(2)
+    return database
+
+
+def test_connection_replaces_unhealthy_connections():
+    stale, fresh = FakeConnection(), FakeConnection()
+    stale.status = TRANSACTION_STATUS_UNKNOWN
+    database = pooled_database([stale, fresh])
+    assert database._query("SELECT 1") == []
+    assert database.pool.returned == [(stale, True), (fresh, False)]
+    assert fresh.commits == 1
+
+
+def test_query_retries_once_on_broken_connection():
+    broken, fresh = FakeConnection(fail=True), FakeConnection()
+    database = pooled_database([broken, fresh])
+    database._query("SELECT 1")
+    assert database.pool.returned == [(broken, True), (fresh, False)]
+
+    database = pooled_database([FakeConnection(fail=True), FakeConnection(fail=True)])
+    with pytest.raises(psycopg2.OperationalError):
+        database._query("SELECT 1")
+    assert all(close for _, close in database.pool.returned)
+
+
+def test_query_retries_only_connection_failures():
+    failed, fresh = FakeConnection(error=ConnectionFailure()), FakeConnection()
+    database = pooled_database([failed, fresh])
+    database._query("SELECT 1")
+    assert database.pool.returned == [(failed, True), (fresh, False)]
+
+    # The connection is fine, the statement failed:
+    timed_out = FakeConnection(error=LockTimeout())
+    database = pooled_database([timed_out, FakeConnection()])
+    with pytest.raises(LockTimeout):
+        database._query("SELECT 1")
+    assert database.pool.returned == [(timed_out, False)]
+    assert timed_out.rollbacks == 1
+
+
+def test_connection_rolls_back_on_error():
+    conn = FakeConnection()
+    database = pooled_database([conn])
+    with pytest.raises(ValueError):
+        with database._connection():
+            raise ValueError()
+    assert conn.rollbacks == 1 and conn.commits == 0
+    assert database.pool.returned == [(conn, False)]
+
+
+ID = "4f6c2b4e-7d3a-4c59-9a51-0e0b9d1d6b1a"
+
+
+def test_cursor_roundtrip():
+    timestamp = datetime.datetime(2025, 1, 2, 3, 4, 5)
+    cursor = encode_cursor("timestamp", timestamp, ID)
+    assert decode_cursor(cursor, "timestamp") == (timestamp, ID)
+    assert decode_cursor(encode_cursor("module", "dns", ID), "module") == ("dns", ID)
+    assert decode_cursor(encode_cursor("last_seen", None, ID), "last_seen") == (None, ID)
+
+
+@pytest.mark.parametrize(
+    "cursor, sort",
+    [
+        (encode_cursor("timestamp", "2025-01-01", ID)[0:-4], "timestamp"),
+        ("not base64 at all", "timestamp"),
+        (encode_cursor("timestamp", "2025-01-01", ID), "resource"),
+        (encode_cursor("timestamp", "yesterday", ID), "timestamp"),
+        (encode_cursor("timestamp", "2025-01-01", "1"), "timestamp"),
+        (encode_cursor("id", "1", ID), "id"),
+        (encode_cursor("module", None, ID), "module"),
+    ],
+)
+def test_decode_cursor_rejects_invalid_cursors(cursor, sort):
+    with pytest.raises(ValueError):
+        decode_cursor(cursor, sort)
+
+
+def test_list_rows_filters_and_sorts_in_sql():
+    database = QueryRecorder()
+    database.list_rows(
+        "changes",
+        filters={"module": ["http", "dns"], "severity": "high"},
+        sort="resource",
+        descending=True,
+        limit=10,
+    )
+    query, args = database.queries[0]
+    assert "WHERE module IN %s AND severity IN %s" in query
+    assert "ORDER BY resource DESC, id DESC LIMIT %s" in query
+    assert args == (("http", "dns"), ("high",), 11)
+
+
+def test_list_rows_next_cursor():
+    timestamp = datetime.datetime(2025, 1, 1)
+    ids = [f"00000000-0000-0000-0000-00000000000{i}" for i in range(3)]
+    rows = [(id, "r", "m", "a", "v", timestamp) for id in ids]
+    database = QueryRecorder(rows)
+    page = database.list_rows("history", limit=2)
+    assert len(page["results"]) == 2
+    assert decode_cursor(page["next_cursor"], "timestamp") == (timestamp, ids[1])
+
+    database.list_rows("history", limit=2, cursor=page["next_cursor"])
+    query, args = database.queries[1]
+    assert "WHERE (timestamp, id) > (%s, %s)" in query
+    assert args == (timestamp, ids[1], 3)
+
+    with pytest.raises(ValueError):
+        database.list_rows("history", sort="resource", cursor=page["next_cursor"])
+
+
+def test_list_rows_continues_into_null_sort_values():
+    # Last rows with a timestamp, then the ones without, ordered by id:
+    database = QueryRecorder([(ID, "r", "m", "a", "v", datetime.datetime(2025, 1, 1))])
+    cursor = encode_cursor("timestamp", datetime.datetime(2024, 1, 1), ID)
+    database.list_rows("history", limit=2, cursor=cursor)
+    assert len(database.queries) == 2
+    query, args = database.queries[1]
+    assert "WHERE timestamp IS NULL ORDER BY timestamp ASC, id ASC" in query
+    assert args == (2,)
+
+    null_id = "00000000-0000-0000-0000-000000000001"
+    database = QueryRecorder([(null_id, "r", "m", "a", "v", None)] * 3)
+    page = database.list_rows("history", limit=2, descending=True)
+    cursor = page["next_cursor"]
+    assert decode_cursor(cursor, "timestamp") == (None, null_id)
+    database.rows = []
+    database.list_rows("history", limit=2, descending=True, cursor=cursor)
+    assert "WHERE timestamp IS NULL AND id < %s" in database.queries[1][0]
+    assert "WHERE timestamp IS NOT NULL" in database.queries[2][0]
+
+
+def test_list_rows_rejects_unknown_columns():
+    database = QueryRecorder()
+    with pytest.raises(ValueError):
+        database.list_rows("history", sort="value")
+    with pytest.raises(ValueError):
+        database.list_rows("history", filters={"severity": "high"})
+    with pytest.raises(ValueError):
+        database.list_rows("history", filters={"1=1; --": "x"})
+
+
+def test_search_matches_ids_by_prefix():
+    database = QueryRecorder()
+    database.search("cfengine")
+    _, args = database.queries[0]
+    assert args["pattern"] == "%cfengine%"
+    assert (args["id_from"], args["id_to"]) == (None, None)
+
+    id = "4f6c2b4e-7d3a-4c59-9a51-0e0b9d1d6b1a"
+    database.search(id)
+    _, args = database.queries[1]
+    assert (args["id_from"], args["id_to"]) == (id, id)
+
+    database.search("4F6C2B4E-7d")
+    _, args = database.queries[2]
+    assert args["id_from"] == "4f6c2b4e-7d00-0000-0000-000000000000"
+    assert args["id_to"] == "4f6c2b4e-7dff-ffff-ffff-ffffffffffff"
+
+    # Not the start of a UUID, the dash is in the wrong place:
+    database.search("4f6c-2b4e")
+    _, args = database.queries[3]
+    assert (args["id_from"], args["id_to"]) == (None, None)
+
+
+def test_search_estimated_count():
+    database = QueryRecorder()
+    database._query = lambda query, args=None: (
+        [] if "EXPLAIN" not in query else [[[{"Plan": {"Plan Rows": 1234}}]]]
+    )
+    result = database.search("cfengine", estimate=True)
+    assert result["total_results"] == 1234
+    assert result["estimated"] is True
+
+
+def test_rows_since_sequence_number():
+    database = QueryRecorder(rows=[(None, 7, "a"), ("100", 8, "b")])
+    result = database.rows_since("changes", "6", limit=2)
+    query, args = database.queries[0]
+    assert "AND seq > %s" in query and "ORDER BY xid NULLS FIRST, seq" in query
+    assert args == (6, 2)
+    assert [row["cursor"] for row in result["results"]] == ["7", "100.8"]
+    assert result["next_cursor"] == "100.8"
+
+
+def test_rows_since_holds_back_running_transactions():
+    database = QueryRecorder(rows=[])
+    database.rows_since("history", "100.8")
+    query, args = database.queries[0]
+    assert "xid < pg_snapshot_xmin(pg_current_snapshot())" in query
+    assert "(xid, seq) > (%s::xid8, %s)" in query
+    assert args == ("100", 8, 100)
+
+
+def test_rows_since_timestamp_and_next_cursor():
+    database = QueryRecorder(rows=[(None, 7, "a")])
+    result = database.rows_since("history", "2025-01-02T03:04:05")
+    query, args = database.queries[0]
+    assert "AND timestamp >= %s" in query
+    assert args == (datetime.datetime(2025, 1, 2, 3, 4, 5), 100)
+    assert result["next_cursor"] == "7"
+
+    database = QueryRecorder(rows=[])
+    assert database.rows_since("history", "42")["next_cursor"] == "42"
+
+
+def test_rows_since_rejects_unknown_id():
+    database = QueryRecorder(rows=[])
+    with pytest.raises(ValueError):
+        database.rows_since("changes", "9a5c83a6-9d36-4a5c-a0c3-6a3bcd4e1cb5")
+
+
+def test_maintain_partitions():
+    database = QueryRecorder()
+    database.maintain_partitions()
+    assert [args for _, args in database.queries] == [("changes", 2), ("history", 2)]
+
+    database = QueryRecorder(
+        rows=[
+            ("changes_2020_01", True, False),
+            ("changes_2020_02", True, True),
+            ("changes_2020_03", False, False),
+        ]
+    )
+    database.maintain_partitions(retention_months=12)
+    changes = database.queries[1:7]
+    assert changes[0] == (
+        "SELECT partition, attached, detach_pending FROM old_partitions(%s, %s);",
+        ("changes", 12),
+    )
+    # Attached partitions are detached outside of a transaction first, so
+    # dropping them doesn't lock the parent table:
+    assert changes[1:6] == [
+        ("ALTER TABLE changes DETACH PARTITION changes_2020_01 CONCURRENTLY;", "autocommit"),
+        ("DROP TABLE IF EXISTS changes_2020_01;", None),
+        ("ALTER TABLE changes DETACH PARTITION changes_2020_02 FINALIZE;", "autocommit"),
+        ("DROP TABLE IF EXISTS changes_2020_02;", None),
+        ("DROP TABLE IF EXISTS changes_2020_03;", None),
+    ]
+    assert database.queries[7][0].startswith("DELETE FROM changes_default WHERE timestamp <")
+    assert database.queries[7][1] == (12,)
+
+
+def test_only_the_updater_skips_stale_resources():
+    database = QueryRecorder()
+    database.get_resources()
+    database.get_live_resources()
+    listed, live = [query for query, _ in database.queries]
+    assert "stale" not in listed
+    assert live.endswith("FROM resources WHERE stale IS NULL;")
+
+
+def test_claim_work_skips_locked_items():
+    database = QueryRecorder()
+    database.claim_work("host-1", limit=50, lease=600)
+    query, args = database.queries[0]
+    assert "FOR UPDATE SKIP LOCKED" in query
+    assert "RETURNING id, module, request, depth;" in query
+    assert args == ("host-1", 600, 3, 50)
+
+
+def test_complete_work_only_own_leases():
+    database = QueryRecorder()
+    database.complete_work([], "host-1")
+    assert database.queries == []
+    database.complete_work([1, 2], "host-1")
+    query, args = database.queries[0]
+    assert query.endswith("WHERE id = ANY(%s) AND leased_by = %s;")
+    assert args == ([1, 2], "host-1")
+
+
+def test_expire_resources_nothing_observed():
+    database = QueryRecorder()
+    assert database.expire_resources([], None, stale_after=3) == []
+    assert database.queries == []
+
+
+def test_expire_resources_no_source_ran():
+    database = QueryRecorder()
+    observed = [("dns", "example.com")]
+    assert database.expire_resources(observed, None, 3, sources=set()) == []
+    assert database.queries == []
+
+
+def test_to_json_stores_scalars_as_strings():
+    assert _to_json(["a", "b"]).adapted == ["a", "b"]
+    assert _to_json({"k": 1}).adapted == {"k": 1}
+    assert _to_json(200).adapted == "200"
+    assert _to_json(True).adapted == "true"
+    assert _to_json(None).adapted == ""
+    assert _to_json("text").adapted == "text"
+
+
+def test_to_json_parses_json_strings_like_migration():
+    # modgithub sends lists as json.dumps() strings, these were turned into
+    # JSONB lists by text_to_jsonb() in 0007_jsonb_values, new writes of the
+    # same value must be the same JSONB (and so get the same value_hash):
+    assert _to_json('["a", "b"]').adapted == ["a", "b"]
+    assert _to_json('{"k": 1}').adapted == {"k": 1}
+    assert _to_json('["a", "b"]').getquoted() == _to_json(["a", "b"]).getquoted()
+    assert _to_json("[not json").adapted == "[not json"
@@ -0,0 +1,50 @@
+import datetime
+
+from paintdry.journal import Journal
+from paintdry.lib import Discovery
+
+
+def test_new_journal(tmp_path):
+    journal = Journal(str(tmp_path))
+    assert not journal.resumed
+    assert journal.completed == set()
+    journal.close()
+
+
+def test_resume_journal(tmp_path):
+    journal = Journal(str(tmp_path))
+    a = ("observation", "dns", "a.example.com", None, None, None, None)
+    b = ("observation", "dns", "b.example.com", None, None, None, None)
+    journal.dispatch("dns", [a, b])
+    journal.complete("dns", [a])
+    journal.suggest(Discovery("b.example.com", "tls", "http"))
+    journal.close()
+    # Interrupted while writing the last line:
+    with open(journal.path, "a") as f:
+        f.write('{"event": "compl')
+
+    journal = Journal(str(tmp_path))
+    assert journal.resumed
+    assert journal.completed == {a}
+    assert journal.in_flight() == 1
+    [suggestion] = journal.suggestions
+    assert (suggestion.resource, suggestion.module) == ("b.example.com", "tls")
+    journal.complete("dns", [b])
+    journal.close()
+
+    assert Journal(str(tmp_path)).completed == {a, b}
+
+
+def test_resume_keeps_start_time_and_changes(tmp_path):
+    started = datetime.datetime(2025, 1, 2, 3, 4, 5)
+    a = ("observation", "dns", "a.example.com", None, None, None, None)
+    journal = Journal(str(tmp_path))
+    journal.start(started)
+    journal.dispatch("dns", [a])
+    journal.complete("dns", [a], {("dns", "a.example.com")})
+    journal.close()
+
+    journal = Journal(str(tmp_path))
+    assert journal.started == started
+    assert journal.changed == {("dns", "a.example.com")}
+    journal.close()
@@ -0,0 +1,103 @@
+import re
+
+from paintdry.migrate import NO_TRANSACTION, _execute, find_migrations, split_statements
+
+
+def test_split_statements():
+    sql = """
+    -- A comment; with a semicolon
+    CREATE INDEX CONCURRENTLY IF NOT EXISTS a ON b (c);
+    INSERT INTO t VALUES ('x;y', 'it''s');
+    CREATE FUNCTION f() RETURNS TRIGGER AS $f$
+    BEGIN
+        RETURN NULL;
+    END;
+    $f$ LANGUAGE plpgsql;
+    -- Trailing comment
+    """
+    statements = split_statements(sql)
+    assert len(statements) == 3
+    assert statements[0].endswith("CREATE INDEX CONCURRENTLY IF NOT EXISTS a ON b (c)")
+    assert statements[1] == "INSERT INTO t VALUES ('x;y', 'it''s')"
+    assert statements[2].startswith("CREATE FUNCTION f()")
+    assert statements[2].endswith("$f$ LANGUAGE plpgsql")
+
+
+def test_find_migrations(tmp_path):
+    for name in ("0002_b.sql", "0001_a.sql", "README.md", "0003_c.sql.orig"):
+        (tmp_path / name).write_text("")
+    migrations = find_migrations(str(tmp_path))
+    assert [(version, name) for version, name, _ in migrations] == [
+        (1, "0001_a"),
+        (2, "0002_b"),
+    ]
+
+
+def test_packaged_migrations():
+    migrations = find_migrations()
+    assert migrations[0][1] == "0001_initial"
+    assert [m[0] for m in migrations] == list(range(1, len(migrations) + 1))
+
+
+def test_search_indexes_are_not_built_in_a_transaction():
+    for _, name, path in find_migrations():
+        with open(path) as f:
+            sql = f.read()
+        if "gin_trgm_ops" in sql:
+            assert sql.startswith(NO_TRANSACTION), name
+
+
+def test_existing_tables_are_not_indexed_in_a_transaction():
+    # Indexing a table in a transaction blocks writes to it until the
+    # whole migration is done, tables created by the migration are empty:
+    for _, name, path in find_migrations():
+        with open(path) as f:
+            sql = f.read()
+        if sql.startswith(NO_TRANSACTION):
+            continue
+        created = set(re.findall(r"CREATE TABLE (?:IF NOT EXISTS )?(\w+)", sql))
+        indexed = set(re.findall(r"CREATE INDEX .*? ON (?:ONLY )?(\w+)", sql))
+        assert indexed <= created, name
+
+
+class FakeCursor:
+    """Records the statements, the partitioned tables have two partitions."""
+
+    def __init__(self):
+        self.statements = []
+        self.result = []
+
+    def execute(self, statement, params=None):
+        self.statements.append(statement)
+        if "relkind" in statement:
+            self.result = [(params[0] in ("history", "changes"),)]
+        elif "pg_inherits" in statement:
+            parent = params["parent"]
+            self.result = [(f"{parent}_2025_01",), (f"{parent}_2025_02",)]
+
+    def fetchone(self):
+        return self.result[0] if self.result else None
+
+    def fetchall(self):
+        return self.result
+
+
+def test_partitioned_tables_are_indexed_concurrently_per_partition():
+    cur = FakeCursor()
+    _execute(cur, "-- Comment\nCREATE INDEX CONCURRENTLY IF NOT EXISTS history_seq_index ON history (seq)")
+    created = [s for s in cur.statements if "relkind" not in s and "pg_inherits" not in s]
+    assert created == [
+        "CREATE INDEX IF NOT EXISTS history_seq_index ON ONLY history (seq);",
+        "CREATE INDEX CONCURRENTLY IF NOT EXISTS history_2025_01_seq_index ON history_2025_01 (seq);",
+        "ALTER INDEX history_seq_index ATTACH PARTITION history_2025_01_seq_index;",
+        "CREATE INDEX CONCURRENTLY IF NOT EXISTS history_2025_02_seq_index ON history_2025_02 (seq);",
+        "ALTER INDEX history_seq_index ATTACH PARTITION history_2025_02_seq_index;",
+    ]
+
+
+def test_other_tables_are_indexed_as_is():
+    cur = FakeCursor()
+    statement = "CREATE INDEX CONCURRENTLY IF NOT EXISTS a ON observations (b)"
+    _execute(cur, statement)
+    assert cur.statements[-1] == statement
+    assert not any("ON ONLY" in s for s in cur.statements)
@@ -0,0 +1,181 @@
+import time
+import threading
+
+from modlib import (
+    ModBase,
+    ttl_cache,
+    http_cache_ttl,
+)
+
+
+class ModSleepy(ModBase):
+    workers = 8
+
+    def __init__(self):
+        super().__init__()
+        self.lock = threading.Lock()
+        self.active = {}
+        self.max_active = {}
+        self.finished = []
+
+    def observation(self, request):
+        host = self.request_host(request)
+        with self.lock:
+            self.active[host] = self.active.get(host, 0) + 1
+            self.max_active[host] = max(self.max_active.get(host, 0), self.active[host])
+        time.sleep(0.05)
+        with self.lock:
+            self.active[host] -= 1
+            self.finished.append(request["resource"])
+        yield {"resource": request["resource"], "attribute": "a"}
+        yield {"resource": request["resource"], "attribute": "b"}
+
+
+def _requests(resources):
+    return [
+        {
+            "operation": "observation",
+            "resource": resource,
+            "module": "sleepy",
+            "timestamp": 1730241747,
+        }
+        for resource in resources
+    ]
+
+
+def test_handle_requests_keeps_order():
+    resources = [f"https://host{i}.example.com/" for i in range(16)]
+    results = ModSleepy().handle_requests(_requests(resources))
+    expected = [(r, a) for r in resources for a in ("a", "b")]
+    assert [(x["resource"], x["attribute"]) for x in results] == expected
+
+
+def test_handle_requests_concurrent():
+    resources = [f"https://host{i}.example.com/" for i in range(16)]
+    start = time.time()
+    ModSleepy().handle_requests(_requests(resources))
+    assert time.time() - start < 16 * 0.05
+
+
+def test_handle_requests_one_at_a_time_per_host():
+    resources = [f"https://example.com/{i}" for i in range(4)]
+    resources += [f"https://example.org/{i}" for i in range(4)]
+    module = ModSleepy()
+    module.handle_requests(_requests(resources))
+    assert module.max_active == {"example.com": 1, "example.org": 1}
+
+
+def test_handle_requests_other_hosts_not_stuck_behind_one_host():
+    resources = [f"https://example.com/{i}" for i in range(4)]
+    resources.append("https://example.org/")
+    module = ModSleepy()
+    module.workers = 2
+    module.handle_requests(_requests(resources))
+    # Handled by the thread which isn't busy with example.com:
+    assert module.finished.index("https://example.org/") < 2
+    assert module.max_active == {"example.com": 1, "example.org": 1}
+
+
+def test_handle_requests_single_worker():
+    module = ModSleepy()
+    module.workers = 1
+    results = module.handle_requests(_requests(["a.com", "b.com"]))
+    assert [x["resource"] for x in results] == ["a.com", "a.com", "b.com", "b.com"]
+
+
+def test_ttl_cache_expires():
+    calls = []
+
+    @ttl_cache(ttl=0.05)
+    def lookup(name):
+        calls.append(name)
+        return name.upper()
+
+    assert lookup("a") == "A"
+    assert lookup("a") == "A"
+    assert calls == ["a"]
+    time.sleep(0.06)
+    assert lookup("a") == "A"
+    assert calls == ["a", "a"]
+    info = lookup.cache_info()
+    assert (info["hits"], info["misses"]) == (1, 2)
+
+
+def test_ttl_cache_computes_a_missing_result_once():
+    calls = []
+    started = threading.Event()
+
+    @ttl_cache()
+    def lookup(name):
+        calls.append(name)
+        started.set()
+        time.sleep(0.05)
+        return name.upper()
+
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(lookup("a")))]
+    threads[0].start()
+    started.wait()
+    threads += [threading.Thread(target=lambda: results.append(lookup("a"))) for _ in range(3)]
+    threads += [threading.Thread(target=lambda: results.append(lookup("b")))]
+    for thread in threads[1:]:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert sorted(calls) == ["a", "b"]
+    assert sorted(results) == ["A", "A", "A", "A", "B"]
+    assert lookup.cache._computing == {}
+
+
+def test_ttl_cache_result_ttl_is_capped():
+    calls = []
+
+    # Like a response with Cache-Control: max-age=31536000
+    @ttl_cache(ttl=0.05, ttl_of=lambda result: 31536000)
+    def lookup(name):
+        calls.append(name)
+        return name
+
+    lookup("a")
+    time.sleep(0.06)
+    lookup("a")
+    assert calls == ["a", "a"]
+
+
+def test_ttl_cache_evicts_least_recently_used():
+    @ttl_cache(maxsize=2)
+    def lookup(name):
+        return name
+
+    lookup("a")
+    lookup("b")
+    lookup("a")
+    lookup("c")  # Evicts b
+    assert lookup.cache_info()["evictions"] == 1
+    lookup("a")
+    lookup("b")
+    assert lookup.cache_info()["hits"] == 2
+
+
+def test_ttl_cache_negative_results_expire_sooner():
+    calls = []
+
+    @ttl_cache(ttl=60, negative_ttl=0, is_negative=lambda result: not result)
+    def lookup(name):
+        calls.append(name)
+        return [] if name == "missing" else [name]
+
+    lookup("missing")
+    lookup("missing")
+    lookup("found")
+    lookup("found")
+    assert calls == ["missing", "missing", "found"]
+    assert lookup.cache_info()["negative"] == 2
+
+
+def test_http_cache_ttl():
+    assert http_cache_ttl({}, 300) == 300
+    assert http_cache_ttl({"Cache-Control": "public, max-age=60"}, 300) == 60.0
+    assert http_cache_ttl({"Cache-Control": "no-store"}, 300) == 0
+    assert http_cache_ttl({"Expires": "0"}, 300) == 0
+    assert http_cache_ttl({"Expires": "Wed, 21 Oct 2015 07:28:00 GMT"}, 300) == 0.0
@@ -61,3 +61,21 @@ def test_modcfechecksums():
     import modcfechecksums
 
     _convert_examples(modcfechecksums.ModCFEChecksums())
+
+
+def test_change_request_has_id_and_text_values():
+    from paintdry.lib import Change
+
+    change = Change(
+        resource="example.com",
+        module="dns",
+        attribute="ips",
+        old_value=["1.2.3.4"],
+        new_value="",
+        timestamp=1730241747,
+        id="9a5c83a6-9d36-4a5c-a0c3-6a3bcd4e1cb5",
+    )
+    request = change.to_request()
+    assert request["id"] == "9a5c83a6-9d36-4a5c-a0c3-6a3bcd4e1cb5"
+    assert request["old_value"] == '["1.2.3.4"]'
+    assert request["new_value"] == ""
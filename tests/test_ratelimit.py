@@ -0,0 +1,91 @@
+import time
+
+from ratelimit import TokenBucket, RateLimiter, parse_retry_after
+
+
+class FakeResponse:
+    def __init__(self, status_code=200, headers=None, from_cache=False):
+        self.status_code = status_code
+        self.headers = headers or {}
+        self.from_cache = from_cache
+
+
+def test_token_bucket_paces_requests():
+    bucket = TokenBucket(rate=10.0, burst=2)
+    assert bucket.take() == 0.0
+    assert bucket.take() == 0.0
+    assert 0.05 < bucket.take() <= 0.1
+
+
+def test_rate_limiter_hosts_are_independent():
+    limiter = RateLimiter(rate=2.0)
+    start = time.monotonic()
+    for i in range(10):
+        limiter.wait(f"host{i}.example.com")
+    assert time.monotonic() - start < 0.1
+
+
+def test_rate_limiter_refunds_cache_hits():
+    limiter = RateLimiter(rate=1.0)
+    start = time.monotonic()
+    for _ in range(5):
+        limiter.wait("example.com")
+        limiter.update("example.com", FakeResponse(from_cache=True))
+    assert time.monotonic() - start < 0.1
+
+
+def test_rate_limiter_respects_retry_after():
+    limiter = RateLimiter(rate=100.0)
+    limiter.update("example.com", FakeResponse(429, {"Retry-After": "0.2"}))
+    start = time.monotonic()
+    limiter.wait("example.com")
+    assert time.monotonic() - start >= 0.15
+
+
+def test_rate_limiter_backs_off_exponentially():
+    limiter = RateLimiter()
+    limiter.failure("example.com")
+    limiter.failure("example.com")
+    limiter.failure("example.com")
+    assert limiter._backoff["example.com"] == 4.0
+    limiter.success("example.com")
+    assert "example.com" not in limiter._backoff
+
+
+def test_rate_limiter_waits_for_github_reset():
+    limiter = RateLimiter(rate=100.0)
+    headers = {"X-RateLimit-Remaining": "0", "X-RateLimit-Reset": str(int(time.time()) + 60)}
+    limiter.update("api.github.com", FakeResponse(200, headers))
+    assert limiter._blocked_until["api.github.com"] - time.monotonic() > 50
+
+
+def test_parse_retry_after():
+    assert parse_retry_after("120") == 120.0
+    assert parse_retry_after(None) is None
+    assert parse_retry_after("garbage") is None
+    assert parse_retry_after("Wed, 21 Oct 2015 07:28:00 GMT") == 0.0
+
+
+def test_rate_limiter_github_403_waits_for_reset():
+    limiter = RateLimiter(rate=100.0)
+    reset = str(int(time.time()) + 3600)
+    headers = {"X-RateLimit-Remaining": "0", "X-RateLimit-Reset": reset}
+    limiter.update("api.github.com", FakeResponse(403, headers))
+    # The whole hour, not limited by max_backoff:
+    assert limiter._blocked_until["api.github.com"] - time.monotonic() > 3500
+    assert limiter._backoff["api.github.com"] == 1.0
+
+
+def test_rate_limiter_403_without_rate_limit_is_not_a_failure():
+    limiter = RateLimiter(rate=100.0)
+    limiter.update("example.com", FakeResponse(403, {"X-RateLimit-Remaining": "10"}))
+    assert "example.com" not in limiter._blocked_until
+    assert "example.com" not in limiter._backoff
+
+
+def test_rate_limiter_ignores_malformed_headers():
+    limiter = RateLimiter(rate=100.0)
+    headers = {"X-RateLimit-Remaining": "lots", "X-RateLimit-Reset": "soon"}
+    limiter.update("example.com", FakeResponse(200, headers))
+    limiter.update("example.com", FakeResponse(403, headers))
+    assert "example.com" not in limiter._blocked_until
@@ -0,0 +1,67 @@
+from paintdry.lib import Observation
+from paintdry.schedule import Scheduler
+
+MODULES = {
+    "dns": {"command": "moddns", "interval": 10},
+    "tls": {"command": "modtls", "interval": 10, "max_interval": 30},
+    "http": {"command": "modhttp"},
+}
+
+
+def observation(resource, module="dns", severity=""):
+    return Observation(resource, module, "a", "1", severity=severity)
+
+
+def test_unscheduled_resources_are_due():
+    scheduler = Scheduler(MODULES, {("dns", "b"): {"interval": 600, "due": False}})
+    assert scheduler.is_due("dns", "a")
+    assert not scheduler.is_due("dns", "b")
+
+
+def test_interval_backs_off_until_changed():
+    schedule = {
+        ("dns", "a"): {"interval": 600, "due": True},
+        ("dns", "b"): {"interval": 2400, "due": True},
+        ("tls", "c"): {"interval": 1200, "due": True},
+    }
+    scheduler = Scheduler(MODULES, schedule)
+    for module, resource in schedule:
+        scheduler.dispatched(module, resource)
+    scheduler.observed([observation("a"), observation("b")], {("dns", "b")})
+    assert scheduler.next_intervals() == [
+        ("dns", "a", 1200),
+        ("dns", "b", 600),
+        ("tls", "c", 1800),
+    ]
+
+
+def test_high_severity_tightens_interval():
+    scheduler = Scheduler(MODULES, {("dns", "a"): {"interval": 4800, "due": True}})
+    scheduler.dispatched("dns", "a")
+    scheduler.observed([observation("a", severity="high")], set())
+    assert scheduler.next_intervals() == [("dns", "a", 600)]
+
+
+def test_modules_without_interval_are_not_stored():
+    scheduler = Scheduler(MODULES, {})
+    scheduler.dispatched("http", "a")
+    scheduler.dispatched("dns", "a")
+    assert scheduler.next_intervals() == [("dns", "a", 600)]
+
+
+def test_failed_observations_keep_their_interval():
+    schedule = {
+        ("dns", "a"): {"interval": 1200, "due": True},
+        ("dns", "b"): {"interval": 1200, "due": True},
+    }
+    scheduler = Scheduler(MODULES, schedule)
+    scheduler.dispatched("dns", "a")
+    scheduler.failed("dns", "a")
+    # Only known to have failed after its interval was written:
+    scheduler.failed("dns", "b")
+    scheduler.failed("dns", "c")
+    assert scheduler.next_intervals() == [
+        ("dns", "a", 1200),
+        ("dns", "b", 1200),
+        ("dns", "c", 600),
+    ]
@@ -0,0 +1,188 @@
+import os
+import json
+import datetime
+
+import pytest
+
+from paintdry import server
+
+
+@pytest.fixture
+def client(tmp_path, monkeypatch):
+    (tmp_path / "assets").mkdir()
+    (tmp_path / "assets" / "index-abc123.js").write_text("console.log(1);")
+    (tmp_path / "index.html").write_text("<html></html>")
+    monkeypatch.setattr(server, "DIST_FOLDER", str(tmp_path))
+    return server.app.test_client()
+
+
+def test_hashed_assets_are_cached_forever(client):
+    response = client.get("/assets/index-abc123.js")
+    assert response.status_code == 200
+    assert response.cache_control.max_age == server.ASSET_MAX_AGE
+    assert response.cache_control.immutable
+    response.close()
+
+
+def test_index_is_revalidated(client):
+    for path in ("/ui/", "/ui/changes", "/index.html"):
+        response = client.get(path)
+        assert response.status_code == 200
+        assert response.cache_control.max_age == 0
+        response.close()
+
+
+def test_missing_asset(client):
+    assert client.get("/assets/missing.js").status_code == 404
+
+
+def test_database_is_not_created_on_import():
+    assert server._database is None
+
+
+class FakeDatabase:
+    def __init__(self):
+        self.version = 1
+        self.updated = datetime.datetime(2025, 1, 2, tzinfo=datetime.timezone.utc)
+        self.queries = 0
+
+    def get_table_version(self, table):
+        return (self.version, self.updated)
+
+    def rows_since(self, table, since, limit):
+        self.queries += 1
+        if since is None:
+            results = [
+                {"seq": 1, "id": "a", "cursor": "1"},
+                {"seq": 2, "id": "b", "cursor": "2"},
+            ]
+            return {"results": results, "limit": limit, "next_cursor": "2"}
+        return {"results": [], "limit": limit, "next_cursor": since}
+
+    def iter_changes(self):
+        self.queries += 1
+        yield {"id": "1", "version": self.version}
+
+
+@pytest.fixture
+def fake_database(monkeypatch):
+    database = FakeDatabase()
+    monkeypatch.setattr(server, "_database", database)
+    monkeypatch.setattr(server, "_database_pid", os.getpid())
+    monkeypatch.setattr(server, "response_cache", server.ResponseCache())
+    return database
+
+
+def test_list_responses_are_conditional(fake_database):
+    client = server.app.test_client()
+    response = client.get("/api/changes")
+    assert response.get_json() == [{"id": "1", "version": 1}]
+    etag = response.headers["ETag"]
+    assert response.last_modified == fake_database.updated
+
+    response = client.get("/api/changes", headers={"If-None-Match": etag})
+    assert response.status_code == 304
+    assert fake_database.queries == 1
+
+    # Served from the cache, while the table is unchanged:
+    assert client.get("/api/changes").get_json() == [{"id": "1", "version": 1}]
+    assert fake_database.queries == 1
+
+    fake_database.version = 2
+    response = client.get("/api/changes", headers={"If-None-Match": etag})
+    assert response.status_code == 200
+    assert response.get_json() == [{"id": "1", "version": 2}]
+    assert response.headers["ETag"] != etag
+    assert fake_database.queries == 2
+
+
+def test_response_cache_evicts_least_recently_used():
+    cache = server.ResponseCache(max_size=2)
+    cache.put("a", 1, "A")
+    cache.put("b", 1, "B")
+    assert cache.get("a", 1) == "A"
+    cache.put("c", 1, "C")
+    assert cache.get("b", 1) is None
+    assert cache.get("a", 1) == "A"
+    assert cache.get("a", 2) is None
+    assert cache.get("a", 1) is None
+    assert cache.size == 1
+
+
+def test_response_cache_limits_total_size():
+    cache = server.ResponseCache(max_size=10, max_entry_size=6)
+    cache.put("a", 1, "A" * 4)
+    cache.put("b", 1, "B" * 4)
+    cache.put("big", 1, "X" * 7)
+    assert cache.get("big", 1) is None
+    cache.put("c", 1, "C" * 6)
+    assert cache.get("a", 1) is None and cache.get("b", 1) == "B" * 4
+    cache.put("b", 1, "b")
+    assert cache.size == 7
+
+
+def test_list_cache_key_ignores_unknown_and_reordered_parameters(fake_database):
+    client = server.app.test_client()
+    for query in ("x=1", "x=2"):
+        assert client.get(f"/api/changes?{query}").get_json() == [{"id": "1", "version": 1}]
+    assert fake_database.queries == 1
+    with server.app.test_request_context("/api/changes?module=b&limit=5&module=a&x=1"):
+        first = server._cache_key("changes")
+    with server.app.test_request_context("/api/changes?limit=5&module=a&module=b"):
+        assert server._cache_key("changes") == first
+
+
+def test_if_modified_since_alone_is_not_trusted(fake_database):
+    client = server.app.test_client()
+    response = client.get("/api/changes")
+    last_modified = response.headers["Last-Modified"]
+    # Changed again within the same second:
+    fake_database.version = 2
+    response = client.get("/api/changes", headers={"If-Modified-Since": last_modified})
+    assert response.status_code == 200
+    assert response.get_json() == [{"id": "1", "version": 2}]
+
+
+def test_changes_stream(fake_database, monkeypatch):
+    monkeypatch.setattr(server, "STREAM_DURATION", 0)
+    monkeypatch.setattr(server.notifier, "current", lambda: 0)
+    monkeypatch.setattr(server.notifier, "wait", lambda counter, timeout: True)
+    response = server.app.test_client().get("/api/changes/stream")
+    assert response.mimetype == "text/event-stream"
+    events = response.get_data(as_text=True).split("\n\n")
+    event_id, event, data = events[1].split("\n")
+    assert (event_id, event) == ("id: 1", "event: changes")
+    assert json.loads(data.removeprefix("data: ")) == {"id": "a", "seq": 1, "cursor": "1"}
+    assert events[2].startswith("id: 2\n")
+    assert fake_database.queries == 1
+
+
+def test_stream_releases_its_slot(fake_database, monkeypatch):
+    monkeypatch.setattr(server, "STREAM_DURATION", 0)
+    monkeypatch.setattr(server, "_stream_slots", server.threading.BoundedSemaphore(1))
+    monkeypatch.setattr(server.notifier, "current", lambda: 0)
+    monkeypatch.setattr(server.notifier, "wait", lambda counter, timeout: True)
+    for _ in range(2):
+        response = server.app.test_client().get("/api/changes/stream")
+        assert response.get_data(as_text=True).startswith("retry: 2000\n\nid: 1\n")
+        response.close()
+
+
+def test_stream_when_all_slots_are_taken(fake_database, monkeypatch):
+    monkeypatch.setattr(server, "_stream_slots", server.threading.BoundedSemaphore(1))
+    server._stream_slots.acquire()
+    response = server.app.test_client().get("/api/changes/stream")
+    assert response.mimetype == "text/event-stream"
+    # Ends right away, the browser reconnects later:
+    assert response.get_data(as_text=True) == f"retry: {server.STREAM_BUSY_RETRY}\n\n"
+    assert fake_database.queries == 0
+
+
+def test_changes_stream_resumes_from_last_event_id(fake_database, monkeypatch):
+    monkeypatch.setattr(server, "STREAM_DURATION", 0)
+    monkeypatch.setattr(server.notifier, "current", lambda: 0)
+    monkeypatch.setattr(server.notifier, "wait", lambda counter, timeout: False)
+    response = server.app.test_client().get(
+        "/api/changes/stream", headers={"Last-Event-ID": "2"}
+    )
+    assert response.get_data(as_text=True) == "retry: 2000\n\n: keepalive\n\n"
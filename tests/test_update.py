@@ -0,0 +1,511 @@
+import os
+import sys
+import json
+import datetime
+
+import pytest
+
+from paintdry import update
+from paintdry.journal import Journal
+from paintdry.lib import ConfigTarget, ModuleRequest, Resource
+from paintdry.update import RequestIndex, Updater, request_key
+
+# Module worker which answers observations with the resource as the value,
+# confirms discoveries and discovers a child of each resource, and exits
+# without finishing the batch when it gets to the "crash" resource:
+ECHO_WORKER = """
+import sys, json
+for line in sys.stdin:
+    request = json.loads(line)
+    if request == {"operation": "end_of_batch"}:
+        print(json.dumps(request), flush=True)
+        continue
+    if request["resource"] == "crash":
+        sys.exit(1)
+    response = {**request}
+    if request["operation"] == "observation":
+        response["attribute"] = "echo"
+        response["value"] = request["resource"]
+        response["severity"] = ""
+    print(json.dumps(response))
+    if request["operation"] == "discovery":
+        response["resource"] = request["resource"] + "/child"
+        response["source"] = "echo"
+        print(json.dumps(response))
+"""
+
+
+class FakeDatabase:
+    """Records what the updater writes, and keeps work items in memory,
+    with a clock which only moves when told to."""
+
+    def __init__(self, schedule=None, resources=None):
+        self.clock = 0.0
+        self.schedule = schedule or {}
+        self.observations = []
+        self.upserts = 0
+        self.resources = []
+        self.existing = resources or []
+        self.items = {}
+        self.expired = None
+        self.intervals = []
+
+    def now(self):
+        return datetime.datetime(2025, 1, 1) + datetime.timedelta(seconds=self.clock)
+
+    def get_schedule(self):
+        return self.schedule
+
+    def maintain_partitions(self, retention_months):
+        pass
+
+    def get_new_changes(self):
+        return []
+
+    def get_live_resources(self):
+        return [Resource(resource, module) for module, resource in self.existing]
+
+    def expire_resources(self, observed, since, stale_after, dry_run, sources):
+        self.expired = (sorted(observed), sources)
+        self.since = since
+        return []
+
+    def update_schedule(self, intervals):
+        self.intervals.extend(intervals)
+
+    def upsert_observations_batch(self, observations):
+        self.upserts += 1
+        self.observations.extend(observations)
+        return set()
+
+    def update_changes(self, changes):
+        pass
+
+    def upsert_resource(self, resource, source):
+        self.resources.append((resource.module, resource.resource, source))
+
+    def enqueue_work(self, items):
+        queued = 0
+        for module, key, request, depth in items:
+            if (module, key) in [(i["module"], i["key"]) for i in self.items.values()]:
+                continue
+            self.items[len(self.items) + 1] = {
+                "module": module,
+                "key": key,
+                "request": json.loads(json.dumps(request)),
+                "depth": depth,
+                "leased_by": None,
+                "lease_expires": None,
+                "attempts": 0,
+                "completed": None,
+            }
+            queued += 1
+        return queued
+
+    def claim_work(self, worker, limit, lease):
+        claimed = []
+        for id, item in self.items.items():
+            if len(claimed) >= limit:
+                break
+            if item["completed"] is not None or item["attempts"] >= 3:
+                continue
+            if item["lease_expires"] is not None and item["lease_expires"] >= self.clock:
+                continue
+            item["leased_by"] = worker
+            item["lease_expires"] = self.clock + lease
+            item["attempts"] += 1
+            claimed.append((id, item["module"], item["request"], item["depth"]))
+        return claimed
+
+    def complete_work(self, ids, worker):
+        for id in ids:
+            if self.items[id]["leased_by"] == worker:
+                self.items[id]["completed"] = self.clock
+
+    def pending_work(self):
+        return sum(
+            1
+            for item in self.items.values()
+            if item["completed"] is None
+            and (item["attempts"] < 3 or item["lease_expires"] >= self.clock)
+        )
+
+    def purge_work(self):
+        return 0
+
+    def work_discoveries(self):
+        return []
+
+    def failed_observations(self):
+        return [
+            (item["module"], item["request"]["resource"])
+            for item in self.items.values()
+            if item["completed"] is None
+            and item["attempts"] >= 3
+            and item["request"]["operation"] == "observation"
+        ]
+
+    def observed(self):
+        return sorted(o.resource for o in self.observations)
+
+
+@pytest.fixture
+def state(tmp_path, monkeypatch):
+    """Config with an echo module, and module folders in tmp_path."""
+    monkeypatch.setattr(update, "STATE_FOLDER", str(tmp_path / "mount-state"))
+    monkeypatch.chdir(tmp_path)
+    worker = tmp_path / "echo_worker.py"
+    worker.write_text(ECHO_WORKER)
+    (tmp_path / "config").mkdir()
+    config = {
+        "targets": [],
+        "modules": {
+            "echo": {"command": f"{sys.executable} {worker}"},
+            "echo2": {"command": f"{sys.executable} {worker}"},
+        },
+        "max_discovery_depth": 2,
+        "stale_after": 2,
+    }
+    (tmp_path / "config" / "config.json").write_text(json.dumps(config) + "\n")
+    return tmp_path
+
+
+def make_request(operation="observation", resource="example.com", module="dns", **kwargs):
+    return ModuleRequest(
+        operation=operation,
+        resource=resource,
+        module=module,
+        timestamp=kwargs.pop("timestamp", 1),
+        **kwargs,
+    )
+
+
+def test_request_key_ignores_timestamp():
+    a = make_request("discovery", source="config.json", timestamp=1)
+    b = make_request("discovery", source="config.json", timestamp=2)
+    assert request_key(a) == request_key(b)
+    assert request_key(a) != request_key(make_request("observation"))
+
+
+def test_request_index_keeps_discoveries_from_different_sources():
+    # Each source has its own resources row, which needs its last_seen
+    # refreshed by a discovery response with that source:
+    index = RequestIndex()
+    a = make_request("discovery", source="config.json")
+    b = make_request("discovery", source="http")
+    assert index.add([a, b, a]) == [a, b]
+
+
+def test_request_index_coalesces_across_batches():
+    index = RequestIndex()
+    first = [make_request(), make_request("discovery", source="config.json")]
+    assert index.add(first) == first
+    second = [make_request(timestamp=5), make_request(resource="example.org")]
+    assert index.add(second) == [second[1]]
+    assert index.requested["dns"] == 4
+    assert index.coalesced["dns"] == 1
+
+
+def test_request_index_keeps_changes_apart_by_id():
+    index = RequestIndex()
+    a = make_request("change", attribute="a", old_value="1", new_value="2", id="x")
+    b = make_request("change", attribute="a", old_value="2", new_value="3", id="y")
+    assert index.add([a, b, a]) == [a, b]
+
+
+def test_request_index_seed():
+    index = RequestIndex()
+    request = make_request()
+    index.seed({request_key(request)})
+    assert index.add([request]) == []
+    assert index.requested["dns"] == 1
+
+
+def test_process_work_reclaims_expired_leases(state, monkeypatch):
+    database = FakeDatabase()
+    items = [
+        ("echo", resource, make_request(resource=resource, module="echo"), 0)
+        for resource in ("a", "b")
+    ]
+    database.enqueue_work(items)
+    # Claimed by a worker which crashed before completing them:
+    assert len(database.claim_work("crashed", 10, 600)) == 2
+
+    updater = Updater(work_queue=True, database=database)
+    assert updater.process_work() == 0
+    assert database.pending_work() == 2
+    # Waits for the lease to expire, then claims the items again:
+    monkeypatch.setattr(update, "sleep", lambda seconds: setattr(database, "clock", database.clock + seconds))
+    updater.run_work()
+    updater.stop_modules()
+    assert database.clock > 600
+    assert database.observed() == ["a", "b"]
+    for item in database.items.values():
+        assert item["completed"] is not None
+        assert item["attempts"] == 2
+        assert item["leased_by"] == updater.worker_id
+    assert database.pending_work() == 0
+
+
+def test_update_counts_misses_only_for_sources_which_ran(state):
+    resources = [("echo", "p"), ("echo", "q")]
+    database = FakeDatabase(resources=resources)
+    Updater(work_queue=False, database=database).update()
+    observed, sources = database.expired
+    assert ("echo", "p/child/child") in observed
+    assert sources == {"echo"}
+
+
+def test_update_no_misses_for_resources_skipped_by_schedule(state):
+    # p isn't due, so its children weren't looked for in this update:
+    schedule = {("echo", "p"): {"due": False, "interval": 3600}}
+    database = FakeDatabase(schedule=schedule, resources=[("echo", "p"), ("echo", "q")])
+    Updater(work_queue=False, database=database).update()
+    observed, sources = database.expired
+    assert ("echo", "p") not in observed
+    assert ("echo", "q/child") in observed
+    assert sources == set()
+
+
+def test_update_no_misses_after_failed_discovery(state):
+    database = FakeDatabase(resources=[("echo", "q"), ("echo", "crash")])
+    Updater(work_queue=False, database=database).update()
+    assert database.expired[1] == set()
+
+
+def test_resumed_update_keeps_start_time_and_schedule(state):
+    config = json.loads((state / "config" / "config.json").read_text())
+    config["modules"]["echo"]["interval"] = 60
+    (state / "config" / "config.json").write_text(json.dumps(config) + "\n")
+    # Interrupted after p was observed, and had changed:
+    started = datetime.datetime(2024, 12, 31)
+    snapshot = state / "state" / "snapshots" / "00001-2024-12-31T00:00:00"
+    snapshot.mkdir(parents=True)
+    journal = Journal(str(snapshot))
+    key = request_key(make_request(resource="p", module="echo"))
+    journal.start(started)
+    journal.dispatch("echo", [key])
+    journal.complete("echo", [key], {("echo", "p")})
+    journal.close()
+
+    schedule = {("echo", "p"): {"due": True, "interval": 7200}}
+    database = FakeDatabase(schedule=schedule, resources=[("echo", "p")])
+    updater = Updater(work_queue=False, database=database)
+    updater.update()
+    assert database.since == started
+    # Not doubled, p changed before the interruption:
+    assert ("echo", "p", 3600) in database.intervals
+    assert updater.index.coalesced["echo"] == 1
+
+
+def set_echo_interval(state, minutes):
+    config = json.loads((state / "config" / "config.json").read_text())
+    config["modules"]["echo"]["interval"] = minutes
+    (state / "config" / "config.json").write_text(json.dumps(config) + "\n")
+
+
+def test_failed_observations_keep_their_interval(state):
+    set_echo_interval(state, 60)
+    schedule = {
+        ("echo", "q"): {"due": True, "interval": 7200},
+        ("echo", "crash"): {"due": True, "interval": 7200},
+    }
+    database = FakeDatabase(schedule=schedule, resources=list(schedule))
+    Updater(work_queue=False, database=database).update()
+    assert ("echo", "q", 14400) in database.intervals
+    assert ("echo", "crash", 7200) in database.intervals
+
+
+def test_given_up_work_keeps_its_interval(state, monkeypatch):
+    set_echo_interval(state, 60)
+    schedule = {("echo", "crash"): {"due": True, "interval": 7200}}
+    database = FakeDatabase(schedule=schedule, resources=list(schedule))
+    monkeypatch.setattr(update, "sleep", lambda seconds: setattr(database, "clock", database.clock + seconds))
+    Updater(work_queue=True, database=database).update()
+    # Doubled when it was queued, then put back after the last attempt:
+    assert database.intervals.index(("echo", "crash", 14400)) == 0
+    assert database.intervals[-1] == ("echo", "crash", 7200)
+
+
+def test_work_is_queued_in_batches_after_its_intervals(state, monkeypatch):
+    set_echo_interval(state, 60)
+    schedule = {("echo", f"r{i}"): {"due": True, "interval": 7200} for i in range(5)}
+    database = FakeDatabase(schedule=schedule, resources=list(schedule))
+    writes = []
+    for name, method in (("schedule", "update_schedule"), ("enqueue", "enqueue_work")):
+        original = getattr(database, method)
+
+        def recording(items, name=name, original=original):
+            writes.append((name, len(items)))
+            return original(items)
+
+        monkeypatch.setattr(database, method, recording)
+    monkeypatch.setattr(update, "ENQUEUE_BATCH_SIZE", 4)
+    updater = Updater(work_queue=True, database=database)
+    updater.setup_requests()
+    updater.flush_work()
+    # A discovery and an observation per resource, the doubled intervals of
+    # the resources are written before their work items can be claimed:
+    assert writes == [
+        ("schedule", 2),
+        ("enqueue", 4),
+        ("schedule", 2),
+        ("enqueue", 4),
+        ("schedule", 1),
+        ("enqueue", 2),
+    ]
+    assert ("echo", "r0", 14400) in database.intervals
+    assert len(database.items) == 10
+
+
+def echo_requests(resources, operation="observation"):
+    return [make_request(operation, resource, module="echo") for resource in resources]
+
+
+def test_observations_upserted_once_per_batch(state):
+    database = FakeDatabase()
+    updater = Updater(work_queue=False, database=database)
+    resources = [f"r{i}" for i in range(50)]
+    updater.send_requests("echo", echo_requests(resources))
+    updater.run_modules()
+    updater.stop_modules()
+    assert database.upserts == 1
+    assert database.observed() == sorted(resources)
+
+
+@pytest.mark.parametrize("max_running, expected", [(0, 2), (1, 1)])
+def test_modules_run_concurrently_up_to_the_cap(state, monkeypatch, max_running, expected):
+    database = FakeDatabase()
+    updater = Updater(work_queue=False, database=database)
+    updater.max_running = max_running
+    most = 0
+    start_module = updater.start_module
+
+    def counting_start_module(module):
+        nonlocal most
+        start_module(module)
+        most = max(most, len(updater.running))
+
+    monkeypatch.setattr(updater, "start_module", counting_start_module)
+    for name in ("echo", "echo2"):
+        requests = [make_request(resource=f"{name}-{i}", module=name) for i in range(3)]
+        updater.send_requests(name, requests)
+    updater.run_modules()
+    updater.stop_modules()
+    assert most == expected
+    assert len(database.observations) == 6
+    assert not updater.running
+
+
+def test_discoveries_followed_up_to_max_depth(state):
+    database = FakeDatabase()
+    updater = Updater(work_queue=False, database=database)
+    updater.process_config_target(ConfigTarget("root", "echo"))
+    updater.process_responses()
+    updater.stop_modules()
+    # Each resource discovers a child, max_discovery_depth is 2:
+    assert database.observed() == ["root", "root/child", "root/child/child"]
+    accepted = [resource for _, resource, _ in database.resources]
+    assert accepted[-1] == "root/child/child/child"
+    # Left for the next update:
+    assert "root/child/child/child" not in [r for _, r in updater.observed]
+
+
+def test_module_batch_larger_than_the_pipe(state, monkeypatch):
+    database = FakeDatabase()
+    updater = Updater(work_queue=False, database=database)
+    writes = []
+    write_input = update.Module.write_input
+
+    def counting_write_input(module):
+        writes.append(len(module._input))
+        return write_input(module)
+
+    monkeypatch.setattr(update.Module, "write_input", counting_write_input)
+    # Well over the 64 KiB a pipe holds, so it's written in parts, as the
+    # worker reads it:
+    resources = [f"{i}-" + "x" * 200 for i in range(3000)]
+    updater.send_requests("echo", echo_requests(resources))
+    updater.run_modules()
+    updater.stop_modules()
+    assert len(writes) > 1
+    assert writes[0] > 3000 * 200
+    assert database.observed() == sorted(resources)
+
+
+def test_module_worker_handles_batches_until_stopped(state):
+    database = FakeDatabase()
+    updater = Updater(work_queue=False, database=database)
+    module = updater.get_module("echo")
+    updater.send_requests("echo", echo_requests(["a", "b"]))
+    updater.run_modules()
+    process = module._process
+    # END_OF_BATCH ended the batch, without the worker exiting:
+    assert process is not None and process.poll() is None
+    assert [r["resource"] for r in module.completed] == ["a", "b"]
+    updater.send_requests("echo", echo_requests(["c"]))
+    updater.run_modules()
+    assert module._process is process
+    assert [r["resource"] for r in module.completed] == ["c"]
+    assert database.upserts == 2
+    updater.stop_modules()
+    assert process.poll() == 0
+
+
+def test_module_crash_puts_batch_back_in_request_files(state):
+    database = FakeDatabase()
+    updater = Updater(work_queue=False, database=database)
+    module = updater.get_module("echo")
+    requests = echo_requests(["a", "crash", "b"])
+    updater.send_requests("echo", requests)
+    updater.run_modules()
+    assert module.failed
+    assert not updater.running
+    # Responses before the crash are kept:
+    assert database.observed() == ["a"]
+    # The whole batch is retried next update, not in this one:
+    saved = []
+    for path in (state / "mount-state" / "modules" / "echo" / "requests").iterdir():
+        saved.extend(json.loads(path.read_text()))
+    assert sorted(request_key(r) for r in saved) == sorted(request_key(r) for r in requests)
+    assert not module.has_pending_requests()
+    updater.stop_modules()
+
+
+def test_deferred_requests_are_kept_for_the_next_update(state):
+    database = FakeDatabase()
+    updater = Updater(work_queue=False, database=database)
+    module = updater.get_module("echo")
+    module.write_requests([make_request("discovery", "later", module="echo", source="other")])
+    # Another batch of the same module in this update leaves them alone:
+    updater.send_requests("echo", echo_requests(["now"]))
+    updater.run_modules()
+    updater.stop_modules()
+    assert database.observed() == ["now"]
+    assert len(os.listdir(module._input_folder)) == 1
+
+    database = FakeDatabase()
+    updater = Updater(work_queue=False, database=database)
+    updater.get_module("echo")
+    updater.start_modules()
+    updater.run_modules()
+    updater.stop_modules()
+    assert ("echo", "later", "other") in database.resources
+    assert os.listdir(module._input_folder) == []
+
+
+def test_request_files_which_add_nothing_are_left_alone(state):
+    database = FakeDatabase()
+    updater = Updater(work_queue=False, database=database)
+    module = updater.get_module("echo")
+    requests = echo_requests(["done"])
+    module.index.add(requests)  # Already done in this update
+    module._write_requests_with_checksum(requests)
+    module.start()
+    module.start()
+    assert not module.running
+    updater.send_requests("echo", echo_requests(["new"]))
+    updater.run_modules()
+    updater.stop_modules()
+    assert database.observed() == ["new"]
+    assert len(os.listdir(module._input_folder)) == 1